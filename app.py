@@ -1,11 +1,20 @@
 from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+from flask.cli import ScriptInfo
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
-from google.cloud import storage, vision
+from google.cloud import vision
+from google.oauth2 import service_account
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from werkzeug.utils import secure_filename
+from app.bibs import extract_bibs, parse_bib_list
+from app.clients import ClientRegistry, create_storage_client, create_vision_client, warm_up_vision
+from app.jobs import create_job_queue, job_handler, run_worker
+from sqlalchemy import exists
+import click
 import os
+import sys
 
 # Initialize extensions
 db = SQLAlchemy()
@@ -20,17 +29,23 @@ def create_app(config_class=Config):
     db.init_app(app)
     login.init_app(app)
 
-    # Initialize GCS client
+    # GCS and Vision clients are built lazily in each process, so none is
+    # shared across gunicorn's fork
+    clients = ClientRegistry()
+    gcs_credentials = None
     if os.path.exists(app.config['GCS_CREDENTIALS_JSON']):
-        gcs_client = storage.Client.from_service_account_json(app.config['GCS_CREDENTIALS_JSON'])
-    else:
-        gcs_client = storage.Client()
-
-    # Initialize Vision client
-    vision_client = vision.ImageAnnotatorClient()
+        gcs_credentials = service_account.Credentials.from_service_account_file(app.config['GCS_CREDENTIALS_JSON'])
+    clients.register('gcs_bucket', lambda: create_storage_client(
+        gcs_credentials, getattr(gcs_credentials, 'project_id', None), app.config['STORAGE_POOL_SIZE'],
+    ).bucket(app.config['GCS_BUCKET_NAME']))
+    clients.register('vision', lambda: create_vision_client(app.config['GRPC_KEEPALIVE_MS'],
+                                                            app.config['GRPC_KEEPALIVE_TIMEOUT_MS']),
+                     warm_up=warm_up_vision)
+    app.config['clients'] = clients
+    vision_client = clients.proxy('vision')
 
     # Get or create bucket
-    gcs_bucket = gcs_client.bucket(app.config['GCS_BUCKET_NAME'])
+    gcs_bucket = clients.proxy('gcs_bucket')
     if not gcs_bucket.exists():
         gcs_bucket.create()
 
@@ -42,6 +57,7 @@ def create_app(config_class=Config):
         upload_time = db.Column(db.DateTime, default=datetime.utcnow)
         marathon_id = db.Column(db.Integer, db.ForeignKey('marathons.id'), nullable=True)
         detected_numbers = db.Column(db.String(255), nullable=True)
+        status = db.Column(db.String(20), nullable=False, default='queued')
 
     class Marathon(db.Model):
         __tablename__ = 'marathons'
@@ -52,9 +68,18 @@ def create_app(config_class=Config):
         is_active = db.Column(db.Boolean, default=True)
 
     class RunnerNumber(db.Model):
+        # One row per bib detected in an image; the composite indexes serve
+        # exact-match search within a marathon and across all marathons
         __tablename__ = 'runner_numbers'
-        number = db.Column(db.String(50), primary_key=True)
-        image_id = db.Column(db.Integer, db.ForeignKey('images.id'), nullable=False)
+        __table_args__ = (
+            db.Index('ix_runner_numbers_marathon_number', 'marathon_id', 'number', 'image_id', unique=True),
+            db.Index('ix_runner_numbers_number_image', 'number', 'image_id'),
+            db.Index('ix_runner_numbers_image_id', 'image_id'),
+        )
+        id = db.Column(db.Integer, primary_key=True)
+        marathon_id = db.Column(db.Integer, db.ForeignKey('marathons.id'), nullable=True)
+        number = db.Column(db.String(20), nullable=False)
+        image_id = db.Column(db.Integer, db.ForeignKey('images.id', ondelete='CASCADE'), nullable=False)
 
     class Cart(db.Model):
         __tablename__ = 'carts'
@@ -87,12 +112,68 @@ def create_app(config_class=Config):
         remember = BooleanField('Remember Me')
         submit = SubmitField('Login')
 
+    # Durable queue for post-upload OCR and indexing, apart from the package
+    # app's queue so neither worker claims the other's jobs
+    job_queue = create_job_queue({**app.config, 'JOB_QUEUE_PATH': app.config['SQL_JOB_QUEUE_PATH']})
+
+    # Sends Vision requests while the upload to storage is in progress
+    ocr_pool = ThreadPoolExecutor(max_workers=8)
+
+    def extract_numbers(response):
+        if response.error.message:
+            raise RuntimeError(f"Vision API error: {response.error.message}")
+        texts = response.text_annotations
+        return extract_bibs(texts[0].description) if texts else []
+
+    def index_numbers(image_record, numbers):
+        """Replace the image's runner_numbers rows with one bulk insert; the caller commits."""
+        image_record.detected_numbers = ','.join(numbers)
+        RunnerNumber.query.filter_by(image_id=image_record.id).delete(synchronize_session=False)
+        if numbers:
+            db.session.execute(RunnerNumber.__table__.insert(), [
+                {'marathon_id': image_record.marathon_id, 'number': number, 'image_id': image_record.id}
+                for number in numbers
+            ])
+
+    @job_handler('sql_process_image')
+    def process_image(payload):
+        image_record = Image.query.get(payload['image_id'])
+        if image_record is None:
+            return
+        image_record.status = 'processing'
+        db.session.commit()
+
+        # Create Vision API image
+        image = vision.Image()
+        image.source.image_uri = f"gs://{app.config['GCS_BUCKET_NAME']}/{image_record.filename}"
+
+        # Perform text detection
+        response = vision_client.text_detection(image=image)
+        index_numbers(image_record, extract_numbers(response))
+        image_record.status = 'indexed'
+        db.session.commit()
+
+    def mark_failed(payload, error):
+        Image.query.filter_by(id=payload['image_id']).update({'status': 'failed'})
+        db.session.commit()
+
+    process_image.on_failure = mark_failed
+
     @app.cli.command()
     def init_db():
         with app.app_context():
             db.create_all()
         print('Database tables created successfully')
 
+    @app.cli.command()
+    @click.option('--concurrency', type=int, default=None)
+    @click.option('--once', is_flag=True)
+    def worker(concurrency, once):
+        processed = run_worker(app, job_queue,
+                               concurrency=concurrency or app.config['WORKER_CONCURRENCY'],
+                               once=once)
+        print(f'Processed {processed} jobs')
+
     @app.template_filter('time_ago')
     def time_ago_filter(dt):
         now = datetime.now(datetime.utcnow().astimezone().tzinfo)
@@ -164,36 +245,52 @@ def create_app(config_class=Config):
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             blob = gcs_bucket.blob(filename)
-            blob.upload_from_file(file)
-            
-            # Create Vision API image
-            image = vision.Image()
-            image.source.image_uri = f"gs://{app.config['GCS_BUCKET_NAME']}/{filename}"
-            
-            # Perform text detection
-            response = vision_client.text_detection(image=image)
-            texts = response.text_annotations
-            
-            detected_numbers = []
-            if texts:
-                # Extract numbers from detected text
-                import re
-                text = texts[0].description
-                numbers = re.findall(r'\d+', text)
-                detected_numbers = ','.join(numbers)
-            
+
+            if app.config['INLINE_OCR']:
+                # Read once, then upload and OCR the same bytes concurrently
+                data = file.read()
+                ocr_future = ocr_pool.submit(vision_client.text_detection,
+                                             image=vision.Image(content=data))
+                blob.upload_from_string(data, content_type=file.content_type)
+                try:
+                    numbers = extract_numbers(ocr_future.result())
+                except Exception as e:
+                    app.logger.error(f"Inline OCR failed for {filename}, deferring to the worker: {e}")
+                    numbers = None
+                if numbers is not None:
+                    new_image = Image(
+                        filename=filename,
+                        marathon_id=request.form.get('marathon_id'),
+                        status='indexed'
+                    )
+                    db.session.add(new_image)
+                    # Assigns new_image.id for the runner_numbers rows
+                    db.session.flush()
+                    index_numbers(new_image, numbers)
+                    db.session.commit()
+                    return jsonify({
+                        'message': 'File uploaded successfully',
+                        'image_id': new_image.id,
+                        'status': new_image.status
+                    }), 200
+            else:
+                blob.upload_from_file(file)
+
+            # OCR and indexing run in the worker
             new_image = Image(
                 filename=filename,
                 marathon_id=request.form.get('marathon_id'),
-                detected_numbers=detected_numbers
+                status='queued'
             )
             db.session.add(new_image)
             db.session.commit()
+            job_queue.enqueue('sql_process_image', {'image_id': new_image.id})
             
             return jsonify({
                 'message': 'File uploaded successfully',
-                'image_id': new_image.id
-            }), 200
+                'image_id': new_image.id,
+                'status': new_image.status
+            }), 202
 
         return jsonify({'error': 'Invalid file type'}), 400
 
@@ -208,13 +305,13 @@ def create_app(config_class=Config):
         
         if marathon_id:
             query = query.filter_by(marathon_id=marathon_id)
-        if search_numbers:
-            numbers = [n.strip() for n in search_numbers.split(',')]
-            from sqlalchemy import or_
-            query = query.filter(or_(*[
-                Image.detected_numbers.ilike(f'%{number}%') 
-                for number in numbers
-            ]))
+        numbers = parse_bib_list(search_numbers)
+        if numbers:
+            # Exact bib match through the runner_numbers index
+            match = exists().where(RunnerNumber.image_id == Image.id, RunnerNumber.number.in_(numbers))
+            if marathon_id:
+                match = match.where(RunnerNumber.marathon_id == marathon_id)
+            query = query.filter(match)
         
         images = query.order_by(Image.upload_time.desc()).paginate(
             page=page, per_page=24, error_out=False)
@@ -273,4 +370,9 @@ def load_user(user_id):
 
 if __name__ == '__main__':
     app = create_app()
-    app.run(debug=True)
+    if len(sys.argv) > 1:
+        # `python app.py worker` / `python app.py init-db`: the flask command
+        # cannot load this module, the app/ package shadows it
+        app.cli.main(args=sys.argv[1:], obj=ScriptInfo(create_app=lambda: app))
+    else:
+        app.run(debug=True)
@@ -1,7 +1,7 @@
 from flask import Flask, redirect, url_for
 from config import Config
 import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from firebase_admin import credentials
 import pyrebase
 import logging
 import os
@@ -15,6 +15,54 @@ def create_app(config_class=Config):
                 template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates'))
     app.config.from_object(config_class)
 
+    # Request and external-call timings for /metrics and Server-Timing
+    from app import metrics
+    metrics.init_app(app)
+
+    # Host-wide rate limits for Vision and Storage calls, shared by every process
+    from app.quota import GovernedBucket, QuotaGovernor
+    app.config['quota'] = QuotaGovernor.from_config(app.config)
+
+    # Google clients, built lazily in each process so none cross gunicorn's fork
+    from app.clients import (ClientRegistry, create_firestore_client, create_storage_client,
+                             create_vision_client, warm_up_bucket, warm_up_firestore, warm_up_vision)
+    from app.ocr import BatchingOCR
+    clients = app.config['clients'] = ClientRegistry()
+    clients.register('vision', lambda: create_vision_client(app.config['GRPC_KEEPALIVE_MS'],
+                                                            app.config['GRPC_KEEPALIVE_TIMEOUT_MS']),
+                     warm_up=warm_up_vision)
+    clients.register('ocr_batcher', lambda: BatchingOCR(
+        clients.get('vision'),
+        batch_size=app.config['OCR_BATCH_SIZE'],
+        max_wait=app.config['OCR_BATCH_MAX_WAIT'],
+        max_in_flight=app.config['OCR_MAX_IN_FLIGHT'],
+        governor=app.config['quota'],
+    ))
+
+    # Durable queue for post-upload processing (OCR, indexing)
+    from app.jobs import create_job_queue
+    from app import ingest  # noqa: F401 - registers the job handlers
+    app.config['job_queue'] = create_job_queue(app.config)
+
+    # Content hash -> stored blob / OCR result, shared by all local processes
+    from app.ocr_cache import ContentHashCache
+    app.config['ocr_cache'] = ContentHashCache(app.config['OCR_CACHE_PATH'],
+                                               app.config['OCR_CACHE_MAX_ENTRIES'])
+
+    # Marathon lists read on nearly every page view
+    from app.marathon_cache import MarathonCache
+    app.config['marathon_cache'] = MarathonCache(ttl=app.config['MARATHON_CACHE_TTL'],
+                                                 listen=app.config['MARATHON_CACHE_LISTENER'])
+
+    # Per-marathon bib index for fuzzy search, loaded on first use
+    from app.bib_index import BibIndexRegistry
+    app.config['bib_index'] = BibIndexRegistry(refresh_interval=app.config['BIB_INDEX_REFRESH'],
+                                               max_marathons=app.config['BIB_INDEX_MAX_MARATHONS'])
+
+    # Rendered gallery results, invalidated by the marathon gallery version
+    from app.page_cache import create_page_cache
+    app.config['page_cache'] = create_page_cache(app.config)
+
     try:
         # Initialize Firebase Admin SDK if not already initialized
         if not firebase_admin._apps:
@@ -32,13 +80,17 @@ def create_app(config_class=Config):
             })
             logger.info("Firebase Admin SDK initialized successfully")
         
-        # Initialize Firestore
-        db = firestore.client()
-        logger.info("Firestore initialized successfully")
-        
-        # Initialize Firebase Storage bucket
-        bucket = storage.bucket(os.environ.get('FIREBASE_STORAGE_BUCKET'))
-        logger.info("Firebase Storage initialized successfully")
+        # Firestore and the Storage bucket use the Admin SDK's credentials;
+        # the clients themselves are only created on first use in each process
+        firebase_app = firebase_admin.get_app()
+        google_credentials = firebase_app.credential.get_credential()
+        clients.register('firestore', lambda: create_firestore_client(google_credentials, firebase_app.project_id),
+                         warm_up=warm_up_firestore)
+        clients.register('storage', lambda: create_storage_client(
+            google_credentials, firebase_app.project_id, app.config['STORAGE_POOL_SIZE'],
+        ).bucket(os.environ.get('FIREBASE_STORAGE_BUCKET')), warm_up=warm_up_bucket)
+        db = clients.proxy('firestore')
+        bucket = clients.proxy('storage')
         
         # Initialize Firebase for client-side operations
         if not all(app.config['FIREBASE_CONFIG'].values()):
@@ -68,6 +120,18 @@ def create_app(config_class=Config):
         app.config['db'] = None
         app.config['storage'] = None
 
+    # Local stand-in for the GCS bucket, including signed URL uploads
+    if app.config['STORAGE_BACKEND'] == 'fake':
+        from app.fakes import FakeBucket
+        from app.fake_gcs import bp as fake_gcs_bp
+        app.config['storage'] = FakeBucket(app.config['FAKE_STORAGE_DIR'], app.config['FAKE_STORAGE_URL'],
+                                           app.config['SECRET_KEY'])
+        app.register_blueprint(fake_gcs_bp)
+        logger.info(f"Using fake storage bucket in {app.config['FAKE_STORAGE_DIR']}")
+
+    if app.config.get('storage') is not None:
+        app.config['storage'] = GovernedBucket(app.config['storage'], app.config['quota'])
+
     # Register blueprints
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
@@ -75,6 +139,9 @@ def create_app(config_class=Config):
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp)
 
+    from app.commands import register_commands
+    register_commands(app)
+
     @app.route('/')
     def index():
         return redirect(url_for('main.index'))
@@ -1,11 +1,75 @@
 from functools import wraps
 from flask import session, redirect, url_for, current_app, request
 from firebase_admin import auth
+from cachetools import TLRUCache
+import hashlib
+import threading
 import time
 import logging
 
+from app.metrics import TOKEN_CACHE, TOKEN_CACHE_ENTRIES, span
+
 logger = logging.getLogger(__name__)
 
+# Decoded ID-token claims keyed by the token's SHA-256, kept until shortly
+# before the token's own exp. Per process; sized on first use. Hits and
+# misses are exported at /metrics.
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        skew = current_app.config['AUTH_TOKEN_CACHE_SKEW']
+        _token_cache = TLRUCache(
+            maxsize=current_app.config['AUTH_TOKEN_CACHE_SIZE'],
+            ttu=lambda _key, claims, _now: claims.get('exp', 0) - skew,
+            timer=time.time,
+        )
+    return _token_cache
+
+
+def verify_token(token):
+    """Verify a Firebase ID token, reusing the decoded claims of recently verified tokens.
+
+    With AUTH_CHECK_REVOKED the cache is bypassed and every call asks Firebase
+    whether the token has been revoked.
+    """
+    if current_app.config['AUTH_CHECK_REVOKED']:
+        with span('auth.verify_token'):
+            return auth.verify_id_token(token, check_revoked=True)
+
+    key = _token_key(token)
+    with _token_cache_lock:
+        cache = _get_token_cache()
+        claims = cache.get(key)
+        if claims is not None:
+            TOKEN_CACHE.labels('hit').inc()
+            return claims
+        TOKEN_CACHE.labels('miss').inc()
+
+    with span('auth.verify_token'):
+        claims = auth.verify_id_token(token)
+    with _token_cache_lock:
+        cache[key] = claims
+        TOKEN_CACHE_ENTRIES.set(len(cache))
+    return claims
+
+
+def invalidate_token(token):
+    if not token:
+        return
+    with _token_cache_lock:
+        if _token_cache is not None and _token_cache.pop(_token_key(token), None) is not None:
+            TOKEN_CACHE.labels('invalidation').inc()
+            TOKEN_CACHE_ENTRIES.set(len(_token_cache))
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -21,11 +85,12 @@ def login_required(f):
                 session.clear()
                 return redirect(url_for('auth.login', next=request.url))
             
-            decoded_token = auth.verify_id_token(session['token'])
+            decoded_token = verify_token(session['token'])
             
             # Check if token is expired
             if 'exp' in decoded_token and decoded_token['exp'] < time.time():
                 logger.info("Token expired")
+                invalidate_token(session['token'])
                 session.clear()
                 return redirect(url_for('auth.login', next=request.url))
             
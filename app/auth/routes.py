@@ -1,5 +1,7 @@
 from flask import render_template, redirect, url_for, flash, request, session, current_app
 from . import bp
+from app.auth.middleware import invalidate_token
+from app.metrics import span
 from firebase_admin import auth as admin_auth
 from firebase_admin.auth import UserNotFoundError
 from google.cloud import firestore
@@ -26,7 +28,8 @@ def login():
             logger.info(f"Attempting to log in user: {email}")
             # Sign in with Firebase
             auth = current_app.config['auth']
-            user = auth.sign_in_with_email_and_password(email, password)
+            with span('auth.sign_in'):
+                user = auth.sign_in_with_email_and_password(email, password)
             logger.info(f"Firebase auth successful for user: {email}")
             
             # Store the user's information in the session
@@ -60,6 +63,7 @@ def login():
 
 @bp.route('/logout')
 def logout():
+    invalidate_token(session.get('token'))
     session.clear()
     flash('You have been logged out.')
     return redirect(url_for('main.index'))
@@ -93,15 +97,17 @@ def register():
             safe_config['apiKey'] = '***' if 'apiKey' in safe_config else 'Not set'
             logger.info(json.dumps(safe_config, indent=2))
             
-            user = auth.create_user_with_email_and_password(email, password)
+            with span('auth.create_user'):
+                user = auth.create_user_with_email_and_password(email, password)
             logger.info(f"User created successfully in Firebase: {email}")
             
             # Store user data in Firestore
             user_ref = current_app.config['db'].collection('users').document(user['localId'])
-            user_ref.set({
-                'email': email,
-                'created_at': firestore.SERVER_TIMESTAMP
-            })
+            with span('firestore.create_user'):
+                user_ref.set({
+                    'email': email,
+                    'created_at': firestore.SERVER_TIMESTAMP
+                })
             logger.info(f"User data stored in Firestore: {email}")
             
             flash('Registration successful. Please log in.')
@@ -0,0 +1,35 @@
+# Firestore rejects write batches with more than 500 operations
+MAX_BATCH_WRITES = 500
+
+
+class BatchWriter:
+    """Queue document writes and commit them in batches of at most ``size`` operations.
+
+    Call it like the batch method to use: ``write('update', ref, data)``.
+    ``on_commit(committed)`` is called after each batch with the running
+    total of committed writes. Call ``flush`` at the end.
+    """
+
+    def __init__(self, db, size=MAX_BATCH_WRITES, on_commit=None):
+        self.db = db
+        self.size = min(size, MAX_BATCH_WRITES)
+        self.on_commit = on_commit
+        self.batch = db.batch()
+        self.pending = 0
+        self.committed = 0
+
+    def __call__(self, method, *args, **kwargs):
+        getattr(self.batch, method)(*args, **kwargs)
+        self.pending += 1
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.batch.commit()
+        self.committed += self.pending
+        self.batch = self.db.batch()
+        self.pending = 0
+        if self.on_commit:
+            self.on_commit(self.committed)
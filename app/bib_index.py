@@ -0,0 +1,226 @@
+from cachetools import LRUCache
+from datetime import datetime, timedelta, timezone
+import bisect
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Pairs of digits OCR commonly confuses; a substitution along one of these
+# ranks above any other single edit
+CONFUSABLE_DIGITS = {frozenset(pair) for pair in ('83', '17', '06', '08', '56', '49')}
+
+EXACT_SCORE = 1.0
+CONFUSION_SCORE = 0.8
+EDIT_SCORE = 0.5
+
+# Image fields the index is built from
+INDEX_FIELDS = ['bib_numbers', 'upload_time']
+
+# Refreshes re-read a little before the previous one started, so writes whose
+# server timestamp lags our clock are not missed; re-adding a bib is a no-op.
+WATERMARK_OVERLAP = timedelta(seconds=60)
+
+
+def edit_distance(a, b):
+    """Levenshtein distance between two short strings."""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def match_score(query, bib):
+    """Rank a fuzzy match: exact, a known OCR digit confusion, or any other edit."""
+    if query == bib:
+        return EXACT_SCORE
+    if len(query) == len(bib):
+        diffs = [frozenset(pair) for pair in zip(query, bib) if pair[0] != pair[1]]
+        if len(diffs) == 1 and diffs[0] in CONFUSABLE_DIGITS:
+            return CONFUSION_SCORE
+    return EDIT_SCORE
+
+
+class BKTree:
+    """Burkhard-Keller tree of strings under edit distance; insert-only."""
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, word):
+        if self._root is None:
+            self._root = (word, {})
+            self._size = 1
+            return True
+        node = self._root
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance == 0:
+                return False
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                self._size += 1
+                return True
+            node = child
+
+    def search(self, word, max_distance):
+        """Return ``(word, distance)`` for every stored word within ``max_distance``."""
+        if self._root is None:
+            return []
+        results = []
+        stack = [self._root]
+        while stack:
+            candidate, children = stack.pop()
+            distance = edit_distance(word, candidate)
+            if distance <= max_distance:
+                results.append((candidate, distance))
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+class MarathonBibIndex:
+    """In-memory bib -> image ids index of one marathon.
+
+    A BK-tree serves fuzzy lookups and a sorted array of the distinct bibs
+    serves prefix (typeahead) lookups.
+
+    The first ``refresh`` reads every image of the marathon; later ones only
+    read images whose ``indexed_at`` is past the previous watermark, so
+    photos indexed by the worker show up without a rebuild.
+    """
+
+    def __init__(self, marathon_id):
+        self.marathon_id = marathon_id
+        self.images_by_bib = {}
+        self.bibs_by_image = {}
+        self.upload_times = {}
+        self.tree = BKTree()
+        self.sorted_bibs = []
+        self.watermark = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.refreshed_at is not None
+
+    def refresh(self, db, interval):
+        if self.loaded and time.monotonic() - self.refreshed_at < interval:
+            return
+        # One reader per marathon; concurrent callers wait for it instead of
+        # each querying Firestore
+        with self._refresh_lock:
+            if self.loaded and time.monotonic() - self.refreshed_at < interval:
+                return
+            started = datetime.now(timezone.utc)
+            query = db.collection('images').where('marathon_id', '==', self.marathon_id)
+            if self.watermark is not None:
+                query = query.where('indexed_at', '>', self.watermark)
+            docs = [(doc.id, doc.to_dict()) for doc in query.select(INDEX_FIELDS).stream()]
+            for image_id, data in docs:
+                self.update_image(image_id, data.get('bib_numbers') or [], data.get('upload_time'))
+            self.watermark = started - WATERMARK_OVERLAP
+            self.refreshed_at = time.monotonic()
+            logger.info(f"Refreshed bib index for marathon {self.marathon_id}: {len(docs)} images read, "
+                        f"{len(self.images_by_bib)} bibs")
+
+    def update_image(self, image_id, bibs, upload_time=None):
+        """Set the bibs of one image, replacing whatever it was indexed under before."""
+        with self._lock:
+            for bib in set(self.bibs_by_image.get(image_id, ())) - set(bibs):
+                images = self.images_by_bib.get(bib)
+                if images:
+                    images.discard(image_id)
+                    if not images:
+                        del self.images_by_bib[bib]
+                        del self.sorted_bibs[bisect.bisect_left(self.sorted_bibs, bib)]
+            for bib in bibs:
+                if bib not in self.images_by_bib:
+                    self.images_by_bib[bib] = set()
+                    bisect.insort(self.sorted_bibs, bib)
+                self.images_by_bib[bib].add(image_id)
+                self.tree.add(bib)
+            self.bibs_by_image[image_id] = list(bibs)
+            if isinstance(upload_time, datetime):
+                self.upload_times[image_id] = upload_time
+
+    def prefix_search(self, prefix, limit=10):
+        """Return up to ``limit`` ``(bib, photo_count)`` pairs for bibs starting with ``prefix``, in bib order."""
+        results = []
+        with self._lock:
+            position = bisect.bisect_left(self.sorted_bibs, prefix)
+            while position < len(self.sorted_bibs) and len(results) < limit:
+                bib = self.sorted_bibs[position]
+                if not bib.startswith(prefix):
+                    break
+                results.append((bib, len(self.images_by_bib[bib])))
+                position += 1
+        return results
+
+    def fuzzy_search(self, numbers, max_distance=1):
+        """Return ``(image_id, score, matched_bib)`` for images within ``max_distance`` of any number.
+
+        Best score first, newest first among equal scores.
+        """
+        best = {}
+        with self._lock:
+            for number in numbers:
+                for bib, _ in self.tree.search(number, max_distance):
+                    # The tree keeps bibs whose last image was re-indexed elsewhere
+                    images = self.images_by_bib.get(bib)
+                    if not images:
+                        continue
+                    score = match_score(number, bib)
+                    for image_id in images:
+                        if image_id not in best or score > best[image_id][0]:
+                            best[image_id] = (score, bib)
+            oldest = datetime.min.replace(tzinfo=timezone.utc)
+            ranked = sorted(best.items(),
+                            key=lambda item: (item[1][0], self.upload_times.get(item[0], oldest)),
+                            reverse=True)
+        return [(image_id, score, bib) for image_id, (score, bib) in ranked]
+
+
+class BibIndexRegistry:
+    """Lazily loaded ``MarathonBibIndex`` per marathon, bounded to the most recently used ones."""
+
+    def __init__(self, refresh_interval=30, max_marathons=64):
+        self.refresh_interval = refresh_interval
+        self._indexes = LRUCache(maxsize=max_marathons)
+        self._lock = threading.Lock()
+
+    def get(self, db, marathon_id):
+        with self._lock:
+            index = self._indexes.get(marathon_id)
+            if index is None:
+                index = self._indexes[marathon_id] = MarathonBibIndex(marathon_id)
+        index.refresh(db, self.refresh_interval)
+        return index
+
+    def update_image(self, marathon_id, image_id, bibs, upload_time=None):
+        """Apply a newly indexed image to an already loaded index; unloaded ones pick it up on load."""
+        with self._lock:
+            index = self._indexes.get(marathon_id)
+        if index is not None and index.loaded:
+            index.update_image(image_id, bibs, upload_time or datetime.now(timezone.utc))
+
+    def stats(self):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        return {
+            'marathons': len(indexes),
+            'bibs': sum(len(index.images_by_bib) for index in indexes),
+            'images': sum(len(index.bibs_by_image) for index in indexes),
+        }
@@ -0,0 +1,195 @@
+from cachetools import TTLCache
+import logging
+import numpy as np
+import string
+import threading
+
+from app.bibs import extract_bibs, unique_bibs
+
+logger = logging.getLogger(__name__)
+
+# Per-candidate feature weights; a bib printed large, alone on its line and
+# on the marathon's registration list scores close to 1. The sum is then
+# scaled by the size gate below, so no mix of the other features can carry
+# a token printed too small to be a bib. Tuned with benchmarks/bib_scoring.py.
+WEIGHTS = {
+    'height': 0.35,
+    'aspect': 0.15,
+    'digits': 0.2,
+    'registered': 0.3,
+    'crowding': -0.3,
+}
+
+# Glyph height as a fraction of the frame height: at or below MIN a token
+# gets no credit for size, at or above FULL it gets all of it
+MIN_REL_HEIGHT = 0.005
+FULL_REL_HEIGHT = 0.03
+
+# Size gate multiplying the whole score: 0 at or below MIN_REL_HEIGHT (years,
+# prices and sponsor numbers in the background), 1 from GATE_REL_HEIGHT up
+GATE_REL_HEIGHT = 0.01
+
+# Width / height of a single digit; the range printed digits fall in
+ASPECT_RANGE = (0.25, 1.1)
+
+# Score by digit count (index); bibs are mostly 2-5 digits
+DIGIT_SCORES = np.array([0.0, 0.3, 1.0, 1.0, 1.0, 0.8, 0.5])
+MAX_DIGITS = len(DIGIT_SCORES) - 1
+
+# Credit for the registered feature when a marathon has no registration list;
+# low enough that aspect, digits and this prior stay below the default
+# threshold without any credit for size
+UNKNOWN_REGISTERED = 0.3
+
+# Another token within this many of the candidate's heights on its line
+# counts as a neighbour; clock times, phone numbers and dates have several
+NEIGHBOUR_GAP = 0.5
+MAX_NEIGHBOURS = 2
+
+# marathon_bibs/<marathon_id> holds the registered bibs as {'bibs': [...]};
+# apart from the marathon doc so cached marathon lists stay small
+REGISTERED_BIBS_COLLECTION = 'marathon_bibs'
+
+_registered_cache = TTLCache(maxsize=256, ttl=300)
+_registered_lock = threading.Lock()
+
+
+def get_registered_bibs(db, marathon_id):
+    """The marathon's registered bibs as a frozenset, or None when it has no list (cached per process)."""
+    if not marathon_id:
+        return None
+    with _registered_lock:
+        if marathon_id in _registered_cache:
+            return _registered_cache[marathon_id]
+    doc = db.collection(REGISTERED_BIBS_COLLECTION).document(marathon_id).get()
+    bibs = frozenset(doc.to_dict().get('bibs') or []) if doc.exists else None
+    with _registered_lock:
+        _registered_cache[marathon_id] = bibs or None
+    return bibs or None
+
+
+def set_registered_bibs(db, marathon_id, bibs):
+    bibs = unique_bibs(bibs)
+    db.collection(REGISTERED_BIBS_COLLECTION).document(marathon_id).set({'bibs': bibs})
+    with _registered_lock:
+        _registered_cache.pop(marathon_id, None)
+    return bibs
+
+
+def score_candidates(words, boxes, offsets, frames, registered=None):
+    """Score every numeric token of a batch of images at once.
+
+    Takes the columnar layout of ``OCRArchive``: flat ``words`` and
+    ``boxes`` (x0, y0, x1, y1) for all images, image ``i`` owning
+    ``offsets[i]:offsets[i + 1]``, and each image's ``frames`` (width,
+    height; 0 when unknown, in which case the lowest word edge stands in).
+    Returns a dict of arrays with one entry per candidate: ``image``,
+    ``word`` (index into ``words``), ``bib`` (normalized), ``score`` and the
+    features it was computed from.
+    """
+    words = np.asarray(words, dtype=str)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    frames = np.asarray(frames, dtype=np.float64).reshape(-1, 2)
+    n_images = len(offsets) - 1
+    word_image = np.repeat(np.arange(n_images), np.diff(offsets))
+
+    tokens = np.char.strip(words, string.punctuation)
+    digits = np.char.str_len(tokens)
+    is_candidate = np.char.isdigit(tokens) & (digits <= MAX_DIGITS)
+    candidate = np.flatnonzero(is_candidate)
+    image = word_image[candidate]
+    digits = digits[candidate]
+
+    bibs = np.char.lstrip(tokens[candidate], '0')
+    bibs = np.where(np.char.str_len(bibs) == 0, '0', bibs)
+
+    x0, y0, x1, y1 = boxes[candidate].T
+    height = y1 - y0
+    width = x1 - x0
+
+    frame_height = frames[:, 1].copy()
+    lowest = np.zeros(n_images)
+    np.maximum.at(lowest, word_image, boxes[:, 3])
+    frame_height = np.where(frame_height > 0, frame_height, lowest)
+    rel_height = np.divide(height, frame_height[image], out=np.zeros_like(height), where=frame_height[image] > 0)
+    tallest = np.zeros(n_images)
+    np.maximum.at(tallest, image, height)
+    to_tallest = np.divide(height, tallest[image], out=np.zeros_like(height), where=tallest[image] > 0)
+    height_score = (0.5 * np.clip((rel_height - MIN_REL_HEIGHT) / (FULL_REL_HEIGHT - MIN_REL_HEIGHT), 0, 1)
+                    + 0.5 * to_tallest)
+
+    glyph_aspect = np.divide(width, height * digits, out=np.zeros_like(width), where=height > 0)
+    aspect_score = ((glyph_aspect >= ASPECT_RANGE[0]) & (glyph_aspect <= ASPECT_RANGE[1])).astype(np.float64)
+
+    if registered:
+        registered_score = np.isin(bibs, np.array(list(registered), dtype=str)).astype(np.float64)
+    else:
+        registered_score = np.full(len(candidate), UNKNOWN_REGISTERED)
+
+    # Neighbours: every (candidate, other word of the same image) pair whose
+    # boxes share most of the candidate's line and lie within NEIGHBOUR_GAP
+    # heights of each other horizontally
+    counts = np.diff(offsets)[image]
+    pair_candidate = np.repeat(np.arange(len(candidate)), counts)
+    pair_word = (np.repeat(offsets[image], counts)
+                 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    other = boxes[pair_word]
+    gap = NEIGHBOUR_GAP * height[pair_candidate]
+    vertical = np.minimum(y1[pair_candidate], other[:, 3]) - np.maximum(y0[pair_candidate], other[:, 1])
+    horizontal = (np.minimum(x1[pair_candidate] + gap, other[:, 2])
+                  - np.maximum(x0[pair_candidate] - gap, other[:, 0]))
+    is_neighbour = ((pair_word != candidate[pair_candidate]) & (vertical >= 0.5 * height[pair_candidate])
+                    & (horizontal > 0) & (height[pair_candidate] > 0))
+    neighbours = np.bincount(pair_candidate[is_neighbour], minlength=len(candidate))
+    crowding = np.minimum(neighbours, MAX_NEIGHBOURS) / MAX_NEIGHBOURS
+
+    size_gate = np.clip((rel_height - MIN_REL_HEIGHT) / (GATE_REL_HEIGHT - MIN_REL_HEIGHT), 0, 1)
+    score = size_gate * (WEIGHTS['height'] * height_score + WEIGHTS['aspect'] * aspect_score
+                         + WEIGHTS['digits'] * DIGIT_SCORES[digits] + WEIGHTS['registered'] * registered_score
+                         + WEIGHTS['crowding'] * crowding)
+    return {
+        'image': image,
+        'word': candidate,
+        'bib': bibs,
+        'score': score,
+        'rel_height': rel_height,
+        'size_gate': size_gate,
+        'glyph_aspect': glyph_aspect,
+        'digits': digits,
+        'registered': registered_score,
+        'neighbours': neighbours,
+    }
+
+
+def has_layout(boxes, offsets):
+    """Per image of a columnar batch, whether any of its words carries a non-empty box."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    word_image = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    boxed = (boxes[:, 2] > boxes[:, 0]) | (boxes[:, 3] > boxes[:, 1])
+    return np.bincount(word_image[boxed], minlength=len(offsets) - 1) > 0
+
+
+def select_bibs(texts, words, boxes, offsets, frames, threshold, registered=None):
+    """Return the bibs to index for each image of a columnar batch, in reading order.
+
+    Candidates scoring below ``threshold`` are dropped; an image with word
+    boxes gets only what scoring keeps, even if that is nothing. Images
+    without any (text-only OCR such as the fake Vision client), and every
+    image when ``threshold`` is 0 or less, fall back to all numbers in
+    their OCR text.
+    """
+    n_images = len(offsets) - 1
+    if threshold <= 0 or not len(words):
+        return [extract_bibs(str(text)) for text in texts]
+
+    candidates = score_candidates(words, boxes, offsets, frames, registered)
+    keep = candidates['score'] >= threshold
+    image = candidates['image']
+    scorable = has_layout(boxes, offsets)
+
+    selected = [[] for _ in range(n_images)]
+    for i, bib in zip(image[keep].tolist(), candidates['bib'][keep].tolist()):
+        selected[i].append(bib)
+    return [unique_bibs(bibs) if scorable[i] else extract_bibs(str(texts[i])) for i, bibs in enumerate(selected)]
@@ -0,0 +1,45 @@
+import re
+
+# Runner numbers are typically 1-6 digits
+BIB_PATTERN = re.compile(r'\b\d{1,6}\b')
+
+
+def normalize_bib(value):
+    """Return the canonical form of a bib: digits only, no leading zeros."""
+    digits = ''.join(ch for ch in str(value) if ch.isdigit())
+    if not digits:
+        return ''
+    return digits.lstrip('0') or '0'
+
+
+def unique_bibs(values):
+    """Normalize an iterable of raw bibs, dropping blanks and duplicates but keeping order."""
+    seen = set()
+    bibs = []
+    for value in values:
+        bib = normalize_bib(value)
+        if bib and bib not in seen:
+            seen.add(bib)
+            bibs.append(bib)
+    return bibs
+
+
+def extract_bibs(text):
+    """Pull candidate runner numbers out of OCR text."""
+    if not text:
+        return []
+    return unique_bibs(BIB_PATTERN.findall(text))
+
+
+def parse_bib_list(value):
+    """Parse a comma separated string (search box, legacy detected_numbers) or a list of bibs."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return unique_bibs(value)
+
+
+def chunked(values, size):
+    """Split a list into consecutive slices of at most ``size`` items."""
+    return [values[i:i + size] for i in range(0, len(values), size)]
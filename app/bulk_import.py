@@ -0,0 +1,226 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from google.cloud import vision
+import hashlib
+import json
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+import time
+
+from app.derivatives import derivative_urls, render_derivatives, upload_derivatives
+from app.ingest import cached_ocr, create_image_doc, get_ocr_batcher, record_ocr
+from app.preprocess import parse_crop, prepare_for_ocr
+from app.uploads import allowed_file, new_object_name
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.foteam-import.jsonl'
+
+
+def iter_photos(directory):
+    """Yield paths of importable photos under ``directory``, reading one directory listing at a time."""
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file() and allowed_file(entry.name):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+class ImportManifest:
+    """Append-only JSON-lines log of imported files, so a killed import can resume.
+
+    Files are identified by relative path, size and mtime; a file that
+    changed since it was imported is imported again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._done.add(json.loads(line)['key'])
+                    except (ValueError, KeyError):
+                        # A line cut short when the previous run was killed
+                        continue
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(relpath, stat):
+        return f'{relpath}:{stat.st_size}:{int(stat.st_mtime)}'
+
+    def __len__(self):
+        return len(self._done)
+
+    def done(self, key):
+        return key in self._done
+
+    def record(self, key, **fields):
+        with self._lock:
+            self._file.write(json.dumps({'key': key, **fields}) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._done.add(key)
+
+    def close(self):
+        self._file.close()
+
+
+def prepare_photo(path, widths, quality, ocr_max_edge, ocr_crop, ocr_quality):
+    """CPU stage, run in a worker process: hash the file, render its derivatives and its OCR copy."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    ocr_input = prepare_for_ocr(source, ocr_max_edge, ocr_crop, ocr_quality)
+    return {
+        'sha256': hashlib.sha256(source).hexdigest(),
+        'derivatives': list(render_derivatives(source, widths, quality)),
+        'ocr_content': ocr_input.content,
+        'ocr_transform': ocr_input.transform(),
+    }
+
+
+class PhotoImporter:
+    """Import a directory of photos into a marathon.
+
+    Files are hashed and their derivatives rendered in a process pool; the
+    uploads, the OCR calls (batched across threads by the shared
+    BatchingOCR) and the Firestore writes run in a thread pool. At most
+    ``max_in_flight`` files are held in memory at once.
+    """
+
+    def __init__(self, app, directory, marathon_id, user_id=None, processes=None, upload_threads=16,
+                 manifest_path=None, progress_interval=5.0, echo=print):
+        self.app = app
+        self.directory = os.path.abspath(directory)
+        self.marathon_id = marathon_id
+        self.user_id = user_id
+        self.processes = processes or os.cpu_count() or 1
+        self.upload_threads = upload_threads
+        self.max_in_flight = self.processes * 2 + upload_threads
+        self.manifest = ImportManifest(manifest_path or os.path.join(self.directory, MANIFEST_NAME))
+        self.progress_interval = progress_interval
+        self.echo = echo
+        self.counts = {'seen': 0, 'skipped': 0, 'imported': 0, 'queued': 0, 'failed': 0}
+        self._counts_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._counts_lock:
+            self.counts[name] += 1
+
+    def run(self):
+        config = self.app.config
+        prepare_args = (config['DERIVATIVE_WIDTHS'], config['DERIVATIVE_QUALITY'], config['OCR_MAX_EDGE'],
+                        parse_crop(config['OCR_CROP']), config['OCR_JPEG_QUALITY'])
+        self._started = self._last_report = time.monotonic()
+        preparing = {}
+        finishing = {}
+
+        # Spawned, not forked: the parent holds gRPC channels and threads
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(self.processes, mp_context=context) as pool, \
+                    ThreadPoolExecutor(self.upload_threads) as uploader:
+                for path in iter_photos(self.directory):
+                    relpath = os.path.relpath(path, self.directory)
+                    key = ImportManifest.key(relpath, os.stat(path))
+                    self._count('seen')
+                    if self.manifest.done(key):
+                        self._count('skipped')
+                        continue
+                    preparing[pool.submit(prepare_photo, path, *prepare_args)] = (path, relpath, key)
+                    while len(preparing) + len(finishing) >= self.max_in_flight:
+                        self._advance(preparing, finishing, uploader)
+                while preparing or finishing:
+                    self._advance(preparing, finishing, uploader)
+        finally:
+            self.manifest.close()
+        self._report()
+        return self.counts
+
+    def _advance(self, preparing, finishing, uploader):
+        done, _ = wait(list(preparing) + list(finishing), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in preparing:
+                path, relpath, key = preparing.pop(future)
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    logger.error(f"Error preparing {relpath}: {str(e)}")
+                    self._count('failed')
+                    continue
+                finishing[uploader.submit(self._finish, path, relpath, key, prepared)] = relpath
+            else:
+                relpath = finishing.pop(future)
+                try:
+                    self._count(future.result())
+                except Exception as e:
+                    logger.error(f"Error importing {relpath}: {str(e)}")
+                    self._count('failed')
+        if time.monotonic() - self._last_report >= self.progress_interval:
+            self._report()
+
+    def _finish(self, path, relpath, key, prepared):
+        """I/O stage, run in the thread pool: upload, OCR and store one photo. Returns its outcome."""
+        with self.app.app_context():
+            bucket = self.app.config['storage']
+            ocr_cache = self.app.config['ocr_cache']
+            sha256 = prepared['sha256']
+            cached = ocr_cache.get(sha256)
+
+            bib_numbers, ocr = cached_ocr(cached, self.marathon_id)
+            ocr_future = None
+            if bib_numbers is None:
+                # Sent while the uploads below run
+                ocr_future = get_ocr_batcher().submit(vision.Image(content=prepared['ocr_content']))
+
+            if cached:
+                blob_path, url = cached['blob_path'], cached['url']
+                derivatives = derivative_urls(bucket, blob_path, self.app.config['DERIVATIVE_WIDTHS'])
+            else:
+                blob = bucket.blob(new_object_name(path))
+                blob.upload_from_filename(path, content_type=mimetypes.guess_type(path)[0] or 'image/jpeg',
+                                          predefined_acl='publicRead')
+                blob_path, url = blob.name, blob.public_url
+                derivatives = upload_derivatives(bucket, blob_path, prepared['derivatives'])
+
+            if ocr_future is not None:
+                try:
+                    bib_numbers, ocr = record_ocr(ocr_future.result(), prepared['ocr_transform'], blob_path,
+                                                  self.marathon_id)
+                except Exception as e:
+                    logger.error(f"OCR failed for {relpath}, leaving it to the worker: {str(e)}")
+            if cached:
+                if ocr_future is not None and bib_numbers is not None:
+                    ocr_cache.set_bib_numbers(sha256, bib_numbers, self.marathon_id, ocr)
+            else:
+                ocr_cache.put(sha256, blob_path, url, bib_numbers, self.marathon_id, ocr)
+
+            # Without bibs the doc is queued and the worker retries OCR, reusing
+            # the derivatives uploaded here
+            image_ref, status = create_image_doc(
+                blob_path, url, self.marathon_id, self.user_id, content_hash=sha256, bib_numbers=bib_numbers,
+                derivatives=derivatives, ocr=ocr)
+            self.manifest.record(key, path=relpath, sha256=sha256, image_id=image_ref.id, status=status)
+            return 'imported' if bib_numbers is not None else 'queued'
+
+    def _report(self):
+        self._last_report = time.monotonic()
+        with self._counts_lock:
+            counts = dict(self.counts)
+        elapsed = self._last_report - self._started
+        processed = counts['imported'] + counts['queued']
+        self.echo(f"{counts['seen']} seen, {counts['skipped']} already imported, {counts['imported']} imported, "
+                  f"{counts['queued']} queued for OCR, {counts['failed']} failed "
+                  f"in {elapsed:.0f}s ({processed / elapsed if elapsed else 0:.1f} photos/s)")
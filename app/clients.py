@@ -0,0 +1,131 @@
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import firestore, storage, vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+import google.auth
+import grpc
+import logging
+import os
+import requests
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds a warm-up waits for the Vision channel to connect
+WARM_UP_TIMEOUT = 10
+
+
+class ClientRegistry:
+    """Google API clients created lazily, once per process.
+
+    gRPC channels and HTTP connection pools must not cross a fork, so
+    nothing is built in the gunicorn master: each worker creates its
+    clients on first use, and a fork drops whatever the parent had built
+    (without closing it, which would disturb the parent). ``warm_up``
+    builds and connects them ahead of the first request.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._warm_ups = {}
+        self._clients = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget)
+
+    def register(self, name, factory, warm_up=None):
+        """Register ``factory()`` to build client ``name``; ``warm_up(client)`` makes it connect."""
+        self._factories[name] = factory
+        if warm_up:
+            self._warm_ups[name] = warm_up
+
+    def get(self, name):
+        if self._pid == os.getpid():
+            client = self._clients.get(name)
+            if client is not None:
+                return client
+        with self._lock:
+            if self._pid != os.getpid():
+                self._forget()
+            if name not in self._clients:
+                self._clients[name] = self._factories[name]()
+                logger.info(f"Created {name} client in process {os.getpid()}")
+            return self._clients[name]
+
+    def proxy(self, name):
+        return ClientProxy(self, name)
+
+    def _forget(self):
+        self._clients = {}
+        self._pid = os.getpid()
+        # The parent's lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+
+    def warm_up(self, names=None):
+        """Build the clients (all registered ones by default) and open their connections; errors are logged."""
+        for name in names or list(self._factories):
+            try:
+                client = self.get(name)
+                if name in self._warm_ups:
+                    self._warm_ups[name](client)
+            except Exception as e:
+                logger.error(f"Error warming up {name} client: {str(e)}")
+
+
+class ClientProxy:
+    """Stands in for a registry client; attribute access resolves the current process's instance."""
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
+
+    def __repr__(self):
+        return f'<ClientProxy {self._name}>'
+
+
+def create_vision_client(keepalive_ms=30000, keepalive_timeout_ms=10000):
+    """Vision client on a channel with keepalive pings, so idle workers do not find it silently dropped."""
+    options = [
+        ('grpc.keepalive_time_ms', keepalive_ms),
+        ('grpc.keepalive_timeout_ms', keepalive_timeout_ms),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+        # Batches of inline images exceed gRPC's 4 MB default
+        ('grpc.max_send_message_length', -1),
+        ('grpc.max_receive_message_length', -1),
+    ]
+    channel = ImageAnnotatorGrpcTransport.create_channel(options=options)
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+
+def warm_up_vision(client):
+    # Connects (DNS, TLS, HTTP/2) without a billable request
+    grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=WARM_UP_TIMEOUT)
+
+
+def create_storage_client(credentials=None, project=None, pool_size=32):
+    """Storage client whose HTTP session keeps up to ``pool_size`` connections open for concurrent uploads."""
+    if credentials is None:
+        credentials, default_project = google.auth.default(scopes=storage.Client.SCOPE)
+        project = project or default_project
+    session = AuthorizedSession(with_scopes_if_required(credentials, storage.Client.SCOPE))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+def warm_up_bucket(bucket):
+    # A metadata lookup of a missing object: cheap, but opens a pooled connection
+    bucket.blob('.warm-up').exists()
+
+
+def create_firestore_client(credentials=None, project=None):
+    return firestore.Client(project=project, credentials=credentials)
+
+
+def warm_up_firestore(client):
+    list(client.collection('marathons').limit(1).select([]).stream())
@@ -0,0 +1,198 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import logging
+
+from app.batch_writes import BatchWriter
+from app.bib_scoring import set_registered_bibs
+from app.bibs import parse_bib_list
+from app.bulk_import import MANIFEST_NAME, PhotoImporter
+from app.jobs import run_worker
+from app.marathon_stats import rebuild_marathon_stats
+from app.ocr_store import export_marathon_archive
+from app.reprocess import OCRReprocessor
+
+logger = logging.getLogger(__name__)
+
+
+@click.command('backfill-bibs')
+@click.option('--batch-size', default=400, show_default=True,
+              help='Number of document updates per write batch.')
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing.')
+@with_appcontext
+def backfill_bibs(batch_size, dry_run):
+    """Populate the bib_numbers array on image docs from detected_numbers."""
+    db = current_app.config.get('db')
+    if not db:
+        raise click.ClickException('Database connection is not configured.')
+
+    scanned = updated = 0
+    write = BatchWriter(db, batch_size, on_commit=lambda _: click.echo(f'Scanned {scanned} images, updated {updated}'))
+
+    docs = db.collection('images').select(['detected_numbers', 'bib_numbers']).stream()
+    for doc in docs:
+        scanned += 1
+        data = doc.to_dict()
+        bib_numbers = parse_bib_list(data.get('detected_numbers'))
+        if data.get('bib_numbers') == bib_numbers:
+            continue
+
+        updated += 1
+        if not dry_run:
+            write('update', doc.reference, {'bib_numbers': bib_numbers})
+    write.flush()
+
+    verb = 'would update' if dry_run else 'updated'
+    click.echo(f'Scanned {scanned} images, {verb} {updated}')
+
+
+@click.command('worker')
+@click.option('--concurrency', type=int, default=None,
+              help='Jobs processed in parallel (defaults to WORKER_CONCURRENCY).')
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help='Seconds to sleep when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit when no jobs are ready instead of polling.')
+@with_appcontext
+def worker(concurrency, poll_interval, once):
+    """Process queued post-upload jobs (OCR, indexing)."""
+    app = current_app._get_current_object()
+    queue = app.config['job_queue']
+    concurrency = concurrency or app.config['WORKER_CONCURRENCY']
+    if app.config['CLIENT_WARMUP']:
+        app.config['clients'].warm_up()
+    click.echo(f'Worker started with concurrency {concurrency}, queue {queue.stats()}')
+    try:
+        processed = run_worker(app, queue, concurrency=concurrency,
+                               poll_interval=poll_interval, once=once)
+    except KeyboardInterrupt:
+        click.echo('Worker interrupted')
+        return
+    click.echo(f'Processed {processed} jobs, queue {queue.stats()}')
+
+
+@click.command('ocr-cache-stats')
+@with_appcontext
+def ocr_cache_stats():
+    """Show size and hit/miss counters of the content-hash OCR cache."""
+    for name, value in current_app.config['ocr_cache'].stats().items():
+        click.echo(f'{name}: {value}')
+
+
+@click.command('quota-stats')
+@with_appcontext
+def quota_stats():
+    """Show the host's Vision and Storage quota buckets: tokens, calls in flight and backoff."""
+    for name, value in current_app.config['quota'].stats().items():
+        click.echo(f'{name}: {value}')
+
+
+@click.command('rebuild-marathon-stats')
+@click.option('--marathon', 'marathon_ids', multiple=True,
+              help='Marathon id to rebuild (repeatable); defaults to every marathon.')
+@with_appcontext
+def rebuild_stats(marathon_ids):
+    """Recompute the per-marathon stats counters from the image docs."""
+    db = current_app.config.get('db')
+    if not db:
+        raise click.ClickException('Database connection is not configured.')
+
+    marathon_ids = marathon_ids or [doc.id for doc in db.collection('marathons').select([]).stream()]
+    for marathon_id in marathon_ids:
+        totals = rebuild_marathon_stats(db, marathon_id, current_app.config['MARATHON_STATS_SHARDS'])
+        click.echo(f"{marathon_id}: {totals['images']} photos, {totals['indexed']} indexed, "
+                   f"{totals['failed']} failed, {totals['distinct_bibs']} distinct bibs")
+
+
+@click.command('import-photos')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--marathon', 'marathon_id', required=True, help='Marathon the photos belong to.')
+@click.option('--user-id', default=None, help='User id recorded as the uploader.')
+@click.option('--processes', type=int, default=None,
+              help='Processes hashing files and rendering derivatives (default: CPU count).')
+@click.option('--upload-threads', type=int, default=16, show_default=True,
+              help='Threads uploading files and waiting on OCR.')
+@click.option('--manifest', default=None,
+              help=f'Checkpoint file (default: <directory>/{MANIFEST_NAME}).')
+@with_appcontext
+def import_photos(directory, marathon_id, user_id, processes, upload_threads, manifest):
+    """Bulk import a directory of photos (e.g. an SD card dump) into a marathon; re-run to resume."""
+    db = current_app.config.get('db')
+    if not db or not current_app.config.get('storage'):
+        raise click.ClickException('Database or storage is not configured.')
+    if not db.collection('marathons').document(marathon_id).get(field_paths=[]).exists:
+        raise click.ClickException(f'Marathon {marathon_id} not found.')
+
+    importer = PhotoImporter(current_app._get_current_object(), directory, marathon_id, user_id=user_id,
+                             processes=processes, upload_threads=upload_threads, manifest_path=manifest,
+                             echo=click.echo)
+    counts = importer.run()
+    if counts['failed']:
+        raise click.ClickException(f"{counts['failed']} files failed; re-run the command to retry them.")
+
+
+@click.command('reprocess-ocr')
+@click.option('--marathon', 'marathon_id', required=True, help='Marathon whose photos are reprocessed.')
+@click.option('--reuse-text', is_flag=True,
+              help='Re-extract bibs from stored OCR output; only photos without it are sent to Vision.')
+@click.option('--archive', type=click.Path(exists=True, dir_okay=False),
+              help='With --reuse-text, an export-ocr archive of the marathon to re-extract from locally.')
+@click.option('--concurrency', type=int, default=32, show_default=True,
+              help='Photos downloaded and OCR\'d in parallel.')
+@click.option('--page-size', type=int, default=300, show_default=True,
+              help='Image docs read per page.')
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing.')
+@with_appcontext
+def reprocess_ocr(marathon_id, reuse_text, archive, concurrency, page_size, dry_run):
+    """Re-run bib detection over every photo of a marathon."""
+    if not current_app.config.get('db'):
+        raise click.ClickException('Database connection is not configured.')
+
+    counts = OCRReprocessor(current_app._get_current_object(), marathon_id, reuse_text=reuse_text,
+                            concurrency=concurrency, page_size=page_size, dry_run=dry_run, archive=archive,
+                            echo=click.echo).run()
+    if dry_run:
+        click.echo(f"Dry run: {counts['changed']} of {counts['images']} images would change")
+    if counts['failed']:
+        raise click.ClickException(f"{counts['failed']} images failed; re-run the command to retry them.")
+
+
+@click.command('export-ocr')
+@click.option('--marathon', 'marathon_id', required=True, help='Marathon whose OCR annotations are exported.')
+@click.option('--output', type=click.Path(dir_okay=False), required=True, help='Archive file to write (.npz).')
+@click.option('--concurrency', type=int, default=32, show_default=True, help='Annotations downloaded in parallel.')
+@with_appcontext
+def export_ocr(marathon_id, output, concurrency):
+    """Collect a marathon's stored OCR annotations into one columnar archive for offline re-extraction."""
+    db = current_app.config.get('db')
+    if not db:
+        raise click.ClickException('Database connection is not configured.')
+
+    archived, missing = export_marathon_archive(db, current_app.config['storage'], marathon_id, output,
+                                                concurrency=concurrency)
+    click.echo(f"Archived {archived} images to {output}; {missing} have no stored annotation")
+
+
+@click.command('import-bibs')
+@click.argument('bibs_file', type=click.File('r'))
+@click.option('--marathon', 'marathon_id', required=True, help='Marathon the bibs are registered for.')
+@with_appcontext
+def import_bibs(bibs_file, marathon_id):
+    """Store a marathon's registered bibs (whitespace or comma separated), used to score OCR candidates."""
+    db = current_app.config.get('db')
+    if not db:
+        raise click.ClickException('Database connection is not configured.')
+
+    bibs = set_registered_bibs(db, marathon_id, bibs_file.read().replace(',', ' ').split())
+    click.echo(f"Registered {len(bibs)} bibs for marathon {marathon_id}")
+
+
+def register_commands(app):
+    app.cli.add_command(backfill_bibs)
+    app.cli.add_command(worker)
+    app.cli.add_command(ocr_cache_stats)
+    app.cli.add_command(quota_stats)
+    app.cli.add_command(rebuild_stats)
+    app.cli.add_command(import_photos)
+    app.cli.add_command(reprocess_ocr)
+    app.cli.add_command(export_ocr)
+    app.cli.add_command(import_bibs)
@@ -0,0 +1,66 @@
+from PIL import Image, ImageOps
+import io
+import logging
+import posixpath
+
+logger = logging.getLogger(__name__)
+
+# Pillow format name, file extension and content type of each variant
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+}
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def derivative_path(blob_path, width, fmt):
+    """Blob path of a derivative, next to the original: images/<stem>_w<width>.<ext>."""
+    directory, name = posixpath.split(blob_path)
+    stem = name.rsplit('.', 1)[0]
+    return posixpath.join(directory, f'{stem}_w{width}.{FORMATS[fmt][1]}')
+
+
+def derivative_urls(bucket, blob_path, widths):
+    """Public URLs of every derivative of ``blob_path``, keyed by format and then width."""
+    return {
+        fmt: {str(width): bucket.blob(derivative_path(blob_path, width, fmt)).public_url for width in widths}
+        for fmt in FORMATS
+    }
+
+
+def render_derivatives(source, widths, quality=82):
+    """Yield ``(width, fmt, bytes)`` for every requested width and format.
+
+    Originals smaller than a width are re-encoded at their own size, never
+    upscaled, so every derivative path always exists.
+    """
+    with Image.open(io.BytesIO(source)) as original:
+        # Let the JPEG decoder do most of the downscaling for us
+        original.draft('RGB', (max(widths), max(widths)))
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    for width in sorted(widths, reverse=True):
+        resized = image.copy()
+        resized.thumbnail((width, width), Image.LANCZOS)
+        for fmt, (pil_format, _, _) in FORMATS.items():
+            out = io.BytesIO()
+            resized.save(out, pil_format, quality=quality, optimize=True)
+            yield width, fmt, out.getvalue()
+
+
+def upload_derivatives(bucket, blob_path, rendered):
+    """Upload ``(width, fmt, bytes)`` variants of ``blob_path``; return their URLs as stored on the image doc."""
+    urls = {fmt: {} for fmt in FORMATS}
+    for width, fmt, data in rendered:
+        blob = bucket.blob(derivative_path(blob_path, width, fmt))
+        blob.cache_control = CACHE_CONTROL
+        blob.upload_from_string(data, content_type=FORMATS[fmt][2], predefined_acl='publicRead')
+        urls[fmt][str(width)] = blob.public_url
+    logger.info(f"Created {sum(len(v) for v in urls.values())} derivatives for {blob_path}")
+    return urls
+
+
+def create_derivatives(bucket, blob_path, source, widths, quality=82):
+    """Render and upload thumbnails/previews of ``source``; return their URLs as stored on the image doc."""
+    return upload_derivatives(bucket, blob_path, render_derivatives(source, widths, quality))
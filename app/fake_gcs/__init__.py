@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint('fake_gcs', __name__, url_prefix='/_fake_gcs')
+
+from app.fake_gcs import routes
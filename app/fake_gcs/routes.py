@@ -0,0 +1,86 @@
+from flask import request, current_app, send_file, abort
+from . import bp
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+METADATA_PREFIX = 'x-goog-meta-'
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (?:\*|(\d+)-(\d+))/(\d+)$')
+
+
+def _resume_incomplete(received):
+    headers = {'Range': f'bytes=0-{received - 1}'} if received else {}
+    return '', 308, headers
+
+
+@bp.route('/_resumable/<path:name>', methods=['PUT'])
+def resumable_upload(name):
+    """Minimal implementation of the GCS resumable upload protocol (chunk PUTs and status queries)."""
+    bucket = current_app.config['storage']
+    if not bucket.verify('PUT', name, request.args, {}):
+        return {'error': 'SignatureDoesNotMatch'}, 403
+
+    blob = bucket.blob(name)
+    part_path = blob.local_path + '.part'
+    session_path = blob.local_path + '.session.json'
+    if not os.path.exists(session_path):
+        return ('', 200) if blob.exists() else ({'error': 'No such upload'}, 404)
+
+    match = _CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return {'error': 'Invalid Content-Range'}, 400
+    received = os.path.getsize(part_path)
+
+    if match.group(1) is not None:
+        start, end, total = (int(value) for value in match.groups())
+        if start > received:
+            return _resume_incomplete(received)
+        with open(part_path, 'r+b') as part:
+            part.seek(start)
+            part.truncate()
+            part.write(request.get_data()[:end - start + 1])
+        received = os.path.getsize(part_path)
+    else:
+        total = int(match.group(3))
+
+    if received < total:
+        return _resume_incomplete(received)
+
+    with open(session_path) as session_file:
+        session_info = json.load(session_file)
+    os.replace(part_path, blob.local_path)
+    os.remove(session_path)
+    blob.metadata = session_info.get('metadata')
+    blob.content_type = session_info.get('content_type')
+    blob.patch()
+    return '', 200
+
+
+@bp.route('/<path:name>', methods=['PUT'])
+def put_object(name):
+    bucket = current_app.config['storage']
+    if not bucket.verify('PUT', name, request.args, request.headers):
+        logger.warning(f"Rejected fake GCS upload with a bad signature for {name}")
+        return {'error': 'SignatureDoesNotMatch'}, 403
+
+    blob = bucket.blob(name)
+    blob.metadata = {
+        header[len(METADATA_PREFIX):].lower(): value
+        for header, value in request.headers.items()
+        if header.lower().startswith(METADATA_PREFIX)
+    }
+    blob.upload_from_file(request.stream, content_type=request.headers.get('Content-Type'))
+    return '', 200
+
+
+@bp.route('/<path:name>', methods=['GET'])
+def get_object(name):
+    bucket = current_app.config['storage']
+    blob = bucket.get_blob(name)
+    if blob is None:
+        abort(404)
+    return send_file(os.path.abspath(blob.local_path), mimetype=blob.content_type)
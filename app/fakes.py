@@ -0,0 +1,190 @@
+from google.cloud import vision
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+
+
+def fake_text_for(image):
+    """Deterministic OCR text for an image, derived from its URI or content."""
+    key = image.source.image_uri.encode('utf-8') if image.source.image_uri else bytes(image.content)
+    bib = zlib.crc32(key) % 10000
+    return f"RUN 2026\n{bib}\nFINISH"
+
+
+class FakeVisionClient:
+    """Offline stand-in for ``vision.ImageAnnotatorClient``.
+
+    Each call sleeps ``call_latency`` plus ``per_image_latency`` for every
+    image in it, roughly modelling a gRPC round trip plus server-side work,
+    and returns responses shaped like the real API's.
+    """
+
+    def __init__(self, call_latency=0.15, per_image_latency=0.02, text_for=fake_text_for):
+        self.call_latency = call_latency
+        self.per_image_latency = per_image_latency
+        self.text_for = text_for
+        self.calls = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def _annotate(self, image):
+        text = self.text_for(image)
+        annotations = [vision.EntityAnnotation(description=text)]
+        annotations += [vision.EntityAnnotation(description=word) for word in text.split()]
+        return vision.AnnotateImageResponse(text_annotations=annotations)
+
+    def _record(self, images):
+        with self._lock:
+            self.calls += 1
+            self.images += images
+        time.sleep(self.call_latency + self.per_image_latency * images)
+
+    def text_detection(self, image, **kwargs):
+        self._record(1)
+        return self._annotate(image)
+
+    def batch_annotate_images(self, requests, **kwargs):
+        self._record(len(requests))
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self._annotate(request.image) for request in requests])
+
+
+class FakeBucket:
+    """Local-directory stand-in for a ``google.cloud.storage`` bucket.
+
+    Blob data lives under ``root`` with metadata in ``<name>.meta.json``
+    sidecars. Signed URLs point at the ``fake_gcs`` blueprint, which checks
+    an HMAC signature the same way GCS checks a V4 signature: method, object,
+    expiry, content type and every signed header must match.
+    """
+
+    def __init__(self, root, base_url, secret_key, name='fake-bucket'):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        self.secret_key = secret_key.encode('utf-8')
+        self.name = name
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        blob = FakeBlob(self, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def sign(self, method, name, expires, content_type, headers):
+        message = '\n'.join([method, name, str(expires), content_type or '',
+                              json.dumps(sorted(headers.items()))])
+        return hmac.new(self.secret_key, message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def verify(self, method, name, args, request_headers):
+        """Check a request against the signature in its query string ``args``."""
+        try:
+            expires = int(args['expires'])
+        except (KeyError, ValueError):
+            return False
+        if expires < time.time():
+            return False
+        signed = [header for header in args.get('headers', '').split(',') if header]
+        headers = {header: request_headers.get(header, '') for header in signed}
+        expected = self.sign(method, name, expires, request_headers.get('Content-Type'), headers)
+        return hmac.compare_digest(expected, args.get('signature', ''))
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.cache_control = None
+        self.size = None
+
+    @property
+    def local_path(self):
+        path = os.path.normpath(os.path.join(self.bucket.root, self.name))
+        if not path.startswith(os.path.normpath(self.bucket.root) + os.sep):
+            raise ValueError(f"Invalid object name: {self.name}")
+        return path
+
+    @property
+    def public_url(self):
+        return f"{self.bucket.base_url}/{self.name}"
+
+    def exists(self):
+        return os.path.exists(self.local_path)
+
+    def reload(self):
+        with open(self.local_path + '.meta.json') as meta_file:
+            meta = json.load(meta_file)
+        self.metadata = meta.get('metadata')
+        self.content_type = meta.get('content_type')
+        self.cache_control = meta.get('cache_control')
+        self.size = os.path.getsize(self.local_path)
+
+    def patch(self):
+        with open(self.local_path + '.meta.json', 'w') as meta_file:
+            json.dump({'metadata': self.metadata, 'content_type': self.content_type,
+                       'cache_control': self.cache_control}, meta_file)
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        with open(self.local_path, 'wb') as out:
+            shutil.copyfileobj(file_obj, out)
+        self.content_type = content_type or self.content_type
+        self.size = os.path.getsize(self.local_path)
+        self.patch()
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, 'rb') as file_obj:
+            self.upload_from_file(file_obj, content_type=content_type)
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        with open(self.local_path, 'wb') as out:
+            out.write(data)
+        self.content_type = content_type or self.content_type
+        self.size = len(data)
+        self.patch()
+
+    def download_as_bytes(self, **kwargs):
+        with open(self.local_path, 'rb') as data:
+            return data.read()
+
+    def make_public(self):
+        pass
+
+    def create_resumable_upload_session(self, content_type=None, size=None, origin=None, **kwargs):
+        """Start a resumable upload served by the fake_gcs blueprint; mirrors the GCS session protocol."""
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        with open(self.local_path + '.session.json', 'w') as session_file:
+            json.dump({'content_type': content_type, 'size': size, 'metadata': self.metadata}, session_file)
+        open(self.local_path + '.part', 'wb').close()
+        expires = int(time.time() + 7 * 24 * 3600)
+        query = {
+            'expires': expires,
+            'headers': '',
+            'signature': self.bucket.sign('PUT', self.name, expires, None, {}),
+        }
+        return f"{self.bucket.base_url}/_resumable/{self.name}?{urlencode(query)}"
+
+    def generate_signed_url(self, expiration, method='GET', content_type=None, headers=None, **kwargs):
+        headers = {header.lower(): value for header, value in (headers or {}).items()}
+        expires = int(time.time() + expiration.total_seconds())
+        query = {
+            'expires': expires,
+            'headers': ','.join(sorted(headers)),
+            'signature': self.bucket.sign(method, self.name, expires, content_type, headers),
+        }
+        return f"{self.public_url}?{urlencode(query)}"
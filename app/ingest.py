@@ -0,0 +1,289 @@
+from flask import current_app
+from google.cloud import vision
+from firebase_admin import firestore
+import logging
+import posixpath
+
+from app.bib_scoring import get_registered_bibs
+from app.bibs import extract_bibs
+from app.derivatives import create_derivatives
+from app.jobs import job_handler
+from app.marathon_stats import create_image, fail_image, index_image
+from app.metrics import span
+from app.ocr_store import annotation_from_response, bibs_from_annotation, load_annotation, save_annotation
+from app.preprocess import OCRInput, parse_crop, prepare_for_ocr
+from app.quota import Throttled
+
+logger = logging.getLogger(__name__)
+
+# Values of the per-image ``status`` field
+STATUS_QUEUED = 'queued'
+STATUS_PROCESSING = 'processing'
+STATUS_INDEXED = 'indexed'
+STATUS_FAILED = 'failed'
+
+def get_ocr_batcher():
+    # One per process, sharing the process's Vision channel
+    return current_app.config['clients'].get('ocr_batcher')
+
+
+def text_from_response(response):
+    texts = response.text_annotations
+    return texts[0].description if texts else ''
+
+
+def bibs_from_response(response):
+    return extract_bibs(text_from_response(response))
+
+
+def registered_bibs(marathon_id):
+    """The marathon's registered bibs for candidate scoring, or None; a failed read only loses that feature."""
+    try:
+        return get_registered_bibs(current_app.config['db'], marathon_id)
+    except Exception as e:
+        logger.error(f"Error loading registered bibs of marathon {marathon_id}: {str(e)}")
+        return None
+
+
+def record_ocr(response, transform, blob_path, marathon_id):
+    """Extract bibs from a Vision response and keep its raw output, so they can be re-derived offline.
+
+    Numbers in the photo are scored on their word boxes and only likely
+    bibs are kept (BIB_SCORE_THRESHOLD). The compact annotation (words,
+    boxes, confidences) is saved beside the photo; returns the bibs and the
+    fields to store on the image doc. A failed annotation upload is logged
+    and only loses the boxes; a throttled one is raised so the job is
+    requeued.
+    """
+    annotation = annotation_from_response(response, transform)
+    record = {'ocr_text': annotation['text'], 'ocr_transform': transform}
+    try:
+        record['ocr_annotation'] = save_annotation(current_app.config['storage'], blob_path, annotation)
+    except Throttled:
+        raise
+    except Exception as e:
+        logger.error(f"Error saving OCR annotation for {blob_path}: {str(e)}")
+    bibs = bibs_from_annotation(annotation, current_app.config['BIB_SCORE_THRESHOLD'], registered_bibs(marathon_id))
+    return bibs, record
+
+
+def cached_ocr(cached, marathon_id):
+    """Bibs and OCR fields to reuse from a content-hash cache entry for a copy uploaded to ``marathon_id``.
+
+    Bibs scored for another marathon are rescored from the stored annotation
+    against this marathon's registration list. Returns ``(None, None)`` when
+    nothing can be reused and the photo needs OCR; a throttled annotation
+    read is raised.
+    """
+    if not cached or cached['bib_numbers'] is None:
+        return None, None
+    ocr = cached.get('ocr')
+    if cached.get('marathon_id') == marathon_id:
+        return cached['bib_numbers'], ocr
+    if not (ocr or {}).get('ocr_annotation'):
+        return None, None
+    try:
+        with span('ocr.rescore'):
+            annotation = load_annotation(current_app.config['storage'], ocr['ocr_annotation'])
+    except Throttled:
+        raise
+    except Exception as e:
+        logger.error(f"Error loading cached OCR annotation {ocr['ocr_annotation']}: {str(e)}")
+        return None, None
+    bibs = bibs_from_annotation(annotation, current_app.config['BIB_SCORE_THRESHOLD'], registered_bibs(marathon_id))
+    return bibs, ocr
+
+
+def prepare_ocr_input(content):
+    """Downscale/crop image bytes per OCR_MAX_EDGE and OCR_CROP before they go to Vision.
+
+    Images Pillow cannot decode are sent as they are and left for Vision to judge.
+    """
+    try:
+        with span('ocr.prepare'):
+            return prepare_for_ocr(content, current_app.config['OCR_MAX_EDGE'],
+                                   crop=parse_crop(current_app.config['OCR_CROP']),
+                                   quality=current_app.config['OCR_JPEG_QUALITY'])
+    except Exception as e:
+        logger.error(f"Error preparing image for OCR, sending it unchanged: {str(e)}")
+        return OCRInput(content)
+
+
+def detect_bibs(content, blob_path, marathon_id):
+    """OCR the bytes of the photo at ``blob_path`` (reduced, sent inline, batched with concurrent callers).
+
+    Returns what ``record_ocr`` does.
+    """
+    ocr_input = prepare_ocr_input(content)
+    with span('ocr.wait'):
+        response = get_ocr_batcher().detect_text(vision.Image(content=ocr_input.content))
+    return record_ocr(response, ocr_input.transform(), blob_path, marathon_id)
+
+
+def upload_and_detect(blob, data, content_type, marathon_id):
+    """Upload ``data`` to ``blob`` while OCR runs on a reduced copy of the same bytes.
+
+    Latency is max(upload, OCR) instead of their sum. Returns the detected
+    bibs and OCR record, or ``(None, None)`` when OCR failed and should be
+    left to the worker; storage errors are raised.
+    """
+    ocr_input = prepare_ocr_input(data)
+    # The batcher sends the Vision request from its own thread
+    ocr_future = get_ocr_batcher().submit(vision.Image(content=ocr_input.content))
+    blob.upload_from_string(data, content_type=content_type)
+    try:
+        # Only the part of OCR the upload did not already cover
+        with span('ocr.wait'):
+            response = ocr_future.result()
+        return record_ocr(response, ocr_input.transform(), blob.name, marathon_id)
+    except Exception as e:
+        logger.error(f"Inline OCR failed for {blob.name}, deferring to the worker: {str(e)}")
+        return None, None
+
+
+def enqueue_image_processing(image_id, blob_path, content_hash=None, marathon_id=None, derivatives=None):
+    queue = current_app.config['job_queue']
+    with span('queue.enqueue'):
+        return queue.enqueue('process_image', {
+            'image_id': image_id,
+            'blob_path': blob_path,
+            'content_hash': content_hash,
+            'marathon_id': marathon_id,
+            'derivatives': derivatives,
+        })
+
+
+def _payload_marathon_id(payload):
+    # Jobs queued before marathon_id was part of the payload
+    if 'marathon_id' in payload:
+        return payload['marathon_id']
+    doc = current_app.config['db'].collection('images').document(payload['image_id']).get(
+        field_paths=['marathon_id'])
+    return doc.to_dict().get('marathon_id') if doc.exists else None
+
+
+def find_image_doc(blob_path, user_id):
+    """The doc ``user_id`` already created for ``blob_path``, as ``(ref, status)``, or None.
+
+    Lets upload completion endpoints be retried without creating a second doc.
+    """
+    query = (current_app.config['db'].collection('images')
+             .where('filename', '==', posixpath.basename(blob_path))
+             .where('user_id', '==', user_id)
+             .select(['status']).limit(1))
+    for doc in query.stream():
+        return doc.reference, doc.to_dict().get('status', STATUS_INDEXED)
+    return None
+
+
+def create_image_doc(blob_path, url, marathon_id, user_id, content_hash=None, bib_numbers=None,
+                     derivatives=None, ocr=None):
+    """Store the image doc for an uploaded blob and queue its processing.
+
+    When ``bib_numbers`` is already known (inline OCR, or a duplicate of a
+    processed photo) the doc is written as indexed. A job is queued unless
+    ``derivatives`` are passed in too; it publishes the blob, renders any
+    derivatives not passed in and runs any OCR still missing. Returns the doc
+    reference and its status.
+    """
+    status = STATUS_QUEUED if bib_numbers is None else STATUS_INDEXED
+    image_data = {
+        'filename': posixpath.basename(blob_path),
+        'url': url,
+        'marathon_id': marathon_id,
+        'detected_numbers': ','.join(bib_numbers or []),
+        'bib_numbers': bib_numbers or [],
+        'content_hash': content_hash,
+        'status': status,
+        'upload_time': firestore.SERVER_TIMESTAMP,
+        'user_id': user_id,
+    }
+    if derivatives:
+        image_data['derivatives'] = derivatives
+    if ocr:
+        image_data.update(ocr)
+    if status == STATUS_INDEXED:
+        image_data['indexed_at'] = firestore.SERVER_TIMESTAMP
+
+    db = current_app.config['db']
+    image_ref = db.collection('images').document()
+    with span('firestore.create_image'):
+        create_image(db, image_ref, image_data, current_app.config['MARATHON_STATS_SHARDS'])
+    logger.info(f"Successfully stored image data in Firestore for {blob_path}")
+    if status == STATUS_INDEXED:
+        current_app.config['bib_index'].update_image(marathon_id, image_ref.id, bib_numbers)
+
+    if derivatives is None or status != STATUS_INDEXED:
+        enqueue_image_processing(image_ref.id, blob_path, content_hash, marathon_id, derivatives)
+    return image_ref, status
+
+
+@job_handler('process_image')
+def process_image(payload):
+    """Publish an uploaded blob, OCR it and index the detected bibs on its image doc."""
+    db = current_app.config['db']
+    bucket = current_app.config['storage']
+    image_ref = db.collection('images').document(payload['image_id'])
+    marathon_id = _payload_marathon_id(payload)
+
+    # Bibs are already known when OCR ran inline at upload time or a copy of
+    # the same photo finished OCR while this job was queued.
+    content_hash = payload.get('content_hash')
+    ocr_cache = current_app.config['ocr_cache']
+    cached = ocr_cache.get(content_hash, count=False) if content_hash else None
+    bib_numbers, ocr = cached_ocr(cached, marathon_id)
+    if bib_numbers is None:
+        with span('firestore.update_status'):
+            image_ref.update({'status': STATUS_PROCESSING})
+
+    blob = bucket.blob(payload['blob_path'])
+    blob.make_public()
+    source = blob.download_as_bytes()
+
+    # Thumbnails are a nice-to-have: the gallery falls back to the original.
+    # Throttled uploads are not failures, so they requeue the job instead.
+    # Bulk import uploads them itself and passes them along.
+    derivatives = payload.get('derivatives')
+    if derivatives is None:
+        try:
+            with span('derivatives'):
+                derivatives = create_derivatives(bucket, blob.name, source,
+                                                 current_app.config['DERIVATIVE_WIDTHS'],
+                                                 current_app.config['DERIVATIVE_QUALITY'])
+        except Throttled:
+            raise
+        except Exception as e:
+            logger.error(f"Error creating derivatives for {blob.name}: {str(e)}")
+
+    if bib_numbers is None:
+        # The bytes are already here, so send them inline rather than making
+        # Vision fetch the object from the bucket again. Errors for this image
+        # alone are raised so the job gets retried.
+        bib_numbers, ocr = detect_bibs(source, blob.name, marathon_id)
+        if content_hash:
+            ocr_cache.set_bib_numbers(content_hash, bib_numbers, marathon_id, ocr)
+    logger.info(f"Detected numbers in image {payload['image_id']}: {bib_numbers}")
+
+    update = {
+        'url': blob.public_url,
+        'detected_numbers': ','.join(bib_numbers),
+        'bib_numbers': bib_numbers,
+        'status': STATUS_INDEXED,
+        'processed_at': firestore.SERVER_TIMESTAMP,
+        'indexed_at': firestore.SERVER_TIMESTAMP,
+    }
+    if derivatives:
+        update['derivatives'] = derivatives
+    if ocr:
+        update.update(ocr)
+    with span('firestore.index_image'):
+        index_image(db, image_ref, marathon_id, update, bib_numbers, current_app.config['MARATHON_STATS_SHARDS'])
+
+
+def _mark_failed(payload, error):
+    db = current_app.config['db']
+    fail_image(db, db.collection('images').document(payload['image_id']), _payload_marathon_id(payload),
+               {'status': STATUS_FAILED, 'error': error}, current_app.config['MARATHON_STATS_SHARDS'])
+
+
+process_image.on_failure = _mark_failed
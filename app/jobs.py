@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from app.metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Job handlers, keyed by job kind. Registered with @job_handler.
+HANDLERS = {}
+
+# Queue implementations, keyed by the JOB_QUEUE_BACKEND config value.
+QUEUE_BACKENDS = {}
+
+
+def job_handler(kind):
+    """Register ``func(payload)`` as the handler for jobs of ``kind``."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def queue_backend(name):
+    def decorator(cls):
+        QUEUE_BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+class RetryLater(Exception):
+    """Raised by a handler to requeue its job after ``delay`` seconds without using up an attempt."""
+
+    def __init__(self, message='', delay=0):
+        super().__init__(message)
+        self.delay = delay
+
+
+class Job:
+    def __init__(self, id, kind, payload, attempts):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} attempt={self.attempts}>'
+
+
+class JobQueue:
+    """Interface every queue backend implements.
+
+    The local SQLite backend pulls jobs with ``claim``; push-based backends
+    (Cloud Tasks, Pub/Sub push subscriptions) only need ``enqueue`` and can
+    deliver jobs to an HTTP handler that calls ``run_job`` directly.
+    """
+
+    def enqueue(self, kind, payload, delay=0):
+        raise NotImplementedError
+
+    def claim(self, limit, lease_seconds):
+        raise NotImplementedError
+
+    def complete(self, job):
+        raise NotImplementedError
+
+    def retry(self, job, delay, error):
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        raise NotImplementedError
+
+    def defer(self, job, delay, error):
+        """Requeue ``job`` like ``retry`` but give back the attempt it was claimed with."""
+        raise NotImplementedError
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config)
+
+    def stats(self):
+        return {}
+
+
+@queue_backend('sqlite')
+class SQLiteJobQueue(JobQueue):
+    """Durable queue stored in a local SQLite file, shared by all processes on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_at REAL NOT NULL,
+                    locked_until REAL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at)')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['JOB_QUEUE_PATH'])
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, payload, delay=0):
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO jobs (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(payload), now + delay, now))
+            return cursor.lastrowid
+
+    def claim(self, limit, lease_seconds):
+        now = time.time()
+        with self._connect() as conn:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers
+            # can never claim the same row.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('''
+                    SELECT id, kind, payload, attempts FROM jobs
+                    WHERE (status = 'queued' AND run_at <= ?)
+                       OR (status = 'running' AND locked_until < ?)
+                    ORDER BY run_at
+                    LIMIT ?
+                ''', (now, now, limit)).fetchall()
+                for row in rows:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ? WHERE id = ?",
+                        (now + lease_seconds, row['id']))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [Job(row['id'], row['kind'], json.loads(row['payload']), row['attempts'] + 1) for row in rows]
+
+    def complete(self, job):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL WHERE id = ?",
+                         (job.id,))
+
+    def retry(self, job, delay, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', locked_until = NULL, run_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, job.id))
+
+    def defer(self, job, delay, error):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), locked_until = NULL, "
+                "run_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, job.id))
+
+    def fail(self, job, error):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ? WHERE id = ?",
+                         (error, job.id))
+
+    def purge(self, older_than):
+        """Delete finished jobs older than ``older_than`` seconds."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE status = 'done' AND created_at < ?",
+                         (time.time() - older_than,))
+
+    def stats(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+
+def create_job_queue(config):
+    backend = config['JOB_QUEUE_BACKEND']
+    if backend not in QUEUE_BACKENDS:
+        raise ValueError(f"Unknown job queue backend: {backend}")
+    return QUEUE_BACKENDS[backend].from_config(config)
+
+
+def backoff_delay(attempts, base, cap):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** (attempts - 1)))
+
+
+def run_job(app, queue, job):
+    handler = HANDLERS.get(job.kind)
+    if handler is None:
+        logger.error(f"No handler registered for job kind {job.kind}")
+        queue.fail(job, f'No handler for {job.kind}')
+        return
+
+    max_attempts = app.config['JOB_MAX_ATTEMPTS']
+    try:
+        with app.app_context(), span(f'job.{job.kind}'):
+            handler(job.payload)
+        queue.complete(job)
+    except RetryLater as e:
+        # Throttled, not broken: wait it out however often it happens
+        delay = max(e.delay, backoff_delay(job.attempts, app.config['JOB_RETRY_BASE_DELAY'],
+                                           app.config['JOB_RETRY_MAX_DELAY']))
+        logger.warning(f"{job!r} deferred ({e}), retrying in {delay:.1f}s")
+        queue.defer(job, delay, f'{type(e).__name__}: {e}')
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        if job.attempts >= max_attempts:
+            logger.exception(f"{job!r} failed permanently")
+            queue.fail(job, error)
+            on_failure = getattr(handler, 'on_failure', None)
+            if on_failure:
+                with app.app_context():
+                    on_failure(job.payload, error)
+        else:
+            delay = backoff_delay(job.attempts, app.config['JOB_RETRY_BASE_DELAY'],
+                                  app.config['JOB_RETRY_MAX_DELAY'])
+            logger.warning(f"{job!r} failed ({error}), retrying in {delay:.1f}s")
+            queue.retry(job, delay, error)
+
+
+def run_worker(app, queue, concurrency=4, poll_interval=1.0, once=False, stop_event=None):
+    """Drain ``queue`` with ``concurrency`` threads until stopped (or empty when ``once``)."""
+    stop_event = stop_event or threading.Event()
+    lease_seconds = app.config['JOB_LEASE_SECONDS']
+    processed = 0
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while not stop_event.is_set():
+            free_slots = concurrency - len(in_flight)
+            jobs = queue.claim(free_slots, lease_seconds) if free_slots else []
+            for job in jobs:
+                in_flight.add(executor.submit(run_job, app, queue, job))
+
+            if not in_flight:
+                if once:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            done, in_flight = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            processed += len(done)
+            if done:
+                logger.info(f"Processed {processed} jobs, {len(in_flight)} in flight")
+
+        wait(in_flight)
+        processed += len(in_flight)
+
+    return processed
@@ -1,16 +1,30 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, session, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, session, current_app, jsonify
 from . import bp
 from app.auth.middleware import login_required
 from datetime import datetime
-from google.cloud import vision
+import hashlib
 import uuid
 import logging
 from google.api_core import exceptions
 from firebase_admin import storage, firestore
+from app.bibs import normalize_bib, parse_bib_list, chunked
+from app.ingest import cached_ocr, create_image_doc, find_image_doc, upload_and_detect, STATUS_INDEXED
+from app.derivatives import derivative_urls
+from app.ocr_cache import save_with_hash
+from app.uploads import allowed_file, new_object_name, signed_upload, UPLOADER_METADATA_KEY
+from app.resumable import (ResumableUploadError, encode_upload_token, decode_upload_token, start_session,
+                           save_session_url, load_session_url, delete_session_url, query_offset, put_chunk)
+from app.pagination import encode_page_token, decode_page_token, sort_key
+from app.marathon_stats import get_marathon_stats, get_marathon_version
+from app.metrics import span
+from app.quota import Throttled
 import os
 
 logger = logging.getLogger(__name__)
 
+# Fields gallery.html renders; everything else stays on the server
+GALLERY_FIELDS = ['url', 'derivatives', 'detected_numbers', 'upload_time', 'status']
+
 def handle_api_error(e, api_name):
     error_msg = str(e)
     if "API has not been used" in error_msg or "disabled" in error_msg:
@@ -20,6 +34,10 @@ def handle_api_error(e, api_name):
         flash(f"An error occurred while accessing {api_name}. Please try again later.", "error")
         logger.error(f"Error accessing {api_name}: {error_msg}")
 
+def throttled_response(e):
+    # The upload page retries failed requests with backoff
+    return {'error': 'Storage is busy, please retry'}, 503, {'Retry-After': str(max(1, round(e.delay)))}
+
 @bp.route('/')
 def index():
     if 'user_id' in session:
@@ -35,12 +53,16 @@ def manage_marathons():
             flash("Database connection is not configured. Please check your Firebase settings.", "error")
             return redirect(url_for('main.index'))
 
-        marathons_ref = current_app.config['db'].collection('marathons')
-        marathons = [
-            {**doc.to_dict(), 'id': doc.id} 
-            for doc in marathons_ref.where('user_id', '==', session['user_id']).stream()
-        ]
-        return render_template('manage_marathons.html', marathons=marathons)
+        with span('firestore.marathons'):
+            marathons = current_app.config['marathon_cache'].for_user(current_app.config['db'], session['user_id'])
+        stats = {}
+        try:
+            with span('firestore.marathon_stats'):
+                stats = get_marathon_stats(current_app.config['db'], [marathon['id'] for marathon in marathons],
+                                           current_app.config['MARATHON_STATS_SHARDS'])
+        except Exception as e:
+            logger.error(f"Error fetching marathon stats: {str(e)}")
+        return render_template('manage_marathons.html', marathons=marathons, stats=stats)
     except exceptions.PermissionDenied as e:
         handle_api_error(e, "Cloud Firestore API")
         return redirect(url_for('main.index'))
@@ -67,14 +89,16 @@ def create_marathon():
     try:
         # Create marathon document in Firestore
         marathon_ref = current_app.config['db'].collection('marathons').document()
-        marathon_ref.set({
-            'name': name,
-            'event_date': datetime.strptime(event_date, '%Y-%m-%d'),
-            'location': location,
-            'is_active': True,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'user_id': session['user_id']
-        })
+        with span('firestore.create_marathon'):
+            marathon_ref.set({
+                'name': name,
+                'event_date': datetime.strptime(event_date, '%Y-%m-%d'),
+                'location': location,
+                'is_active': True,
+                'created_at': firestore.SERVER_TIMESTAMP,
+                'user_id': session['user_id']
+            })
+        current_app.config['marathon_cache'].invalidate(session['user_id'])
         flash('Marathon created successfully')
     except exceptions.PermissionDenied as e:
         handle_api_error(e, "Cloud Firestore API")
@@ -94,7 +118,8 @@ def update_marathon(marathon_id):
     try:
         # Get the marathon document
         marathon_ref = current_app.config['db'].collection('marathons').document(marathon_id)
-        marathon = marathon_ref.get()
+        with span('firestore.get_marathon'):
+            marathon = marathon_ref.get()
 
         if not marathon.exists:
             flash('Marathon not found')
@@ -106,13 +131,15 @@ def update_marathon(marathon_id):
             return redirect(url_for('main.manage_marathons'))
 
         # Update the marathon
-        marathon_ref.update({
-            'name': request.form.get('name'),
-            'event_date': datetime.strptime(request.form.get('event_date'), '%Y-%m-%d'),
-            'location': request.form.get('location'),
-            'is_active': 'is_active' in request.form,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
+        with span('firestore.update_marathon'):
+            marathon_ref.update({
+                'name': request.form.get('name'),
+                'event_date': datetime.strptime(request.form.get('event_date'), '%Y-%m-%d'),
+                'location': request.form.get('location'),
+                'is_active': 'is_active' in request.form,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+        current_app.config['marathon_cache'].invalidate(session['user_id'])
         flash('Marathon updated successfully')
     except exceptions.PermissionDenied as e:
         handle_api_error(e, "Cloud Firestore API")
@@ -131,13 +158,12 @@ def upload_image():
                 flash("Database connection is not configured. Please check your Firebase settings.", "error")
                 return redirect(url_for('main.index'))
 
-            # Get active marathons from Firestore
-            marathons_ref = current_app.config['db'].collection('marathons')
-            marathons = [
-                {**doc.to_dict(), 'id': doc.id} 
-                for doc in marathons_ref.where('is_active', '==', True).stream()
-            ]
-            return render_template('upload.html', marathons=marathons)
+            # Get active marathons (cached; invalidated on marathon writes)
+            with span('firestore.marathons'):
+                marathons = current_app.config['marathon_cache'].active(current_app.config['db'])
+            return render_template('upload.html', marathons=marathons,
+                                   upload_mode=current_app.config['UPLOAD_MODE'],
+                                   upload_concurrency=current_app.config['UPLOAD_CONCURRENCY'])
         except exceptions.PermissionDenied as e:
             handle_api_error(e, "Cloud Firestore API")
             return redirect(url_for('main.index'))
@@ -154,98 +180,432 @@ def upload_image():
         return {'error': 'No selected file'}, 400
 
     if file and allowed_file(file.filename):
+        temp_path = None
         try:
             # Generate unique filename
             filename = str(uuid.uuid4()) + '.' + file.filename.rsplit('.', 1)[1].lower()
             
-            # Save file temporarily
-            temp_path = os.path.join('/tmp', filename)
-            file.save(temp_path)
+            inline_ocr = current_app.config['INLINE_OCR']
+            if inline_ocr:
+                # Read the file once into memory for both storage and Vision
+                with span('upload.read'):
+                    data = file.read()
+                    content_hash = hashlib.sha256(data).hexdigest()
+            else:
+                # Save file temporarily, hashing the bytes as they are read
+                temp_path = os.path.join('/tmp', filename)
+                with span('upload.spool'):
+                    content_hash = save_with_hash(file.stream, temp_path)
             
             # Get the storage bucket
             bucket = current_app.config.get('storage')
             if not bucket:
                 logger.error("Storage bucket not configured")
                 return {'error': 'Storage not configured'}, 500
-            
-            try:
-                # Upload to Firebase Storage
-                blob = bucket.blob(f'images/{filename}')
-                
-                # Upload the file with appropriate content type
-                with open(temp_path, 'rb') as temp_file:
-                    blob.upload_from_file(
-                        temp_file,
-                        content_type=file.content_type
-                    )
-                
-                # Clean up temporary file
-                os.remove(temp_path)
-                
-                # Make the blob publicly accessible
-                blob.make_public()
-                
-                # Get the public URL
-                image_url = blob.public_url
-            except Exception as storage_error:
-                logger.error(f"Storage error: {str(storage_error)}")
-                if os.path.exists(temp_path):
+
+            # Identical bytes were uploaded before: reuse that blob, and its
+            # OCR result if the first copy has already been processed.
+            marathon_id = request.form.get('marathon_id')
+            ocr_cache = current_app.config['ocr_cache']
+            cached = ocr_cache.get(content_hash)
+            bib_numbers = ocr_record = None
+            if cached:
+                if temp_path:
                     os.remove(temp_path)
-                return {'error': f'Storage error: {str(storage_error)}'}, 500
-            
-            # Create Vision API image
-            image = vision.Image()
-            image.source.image_uri = image_url
-            
-            # Perform text detection
-            detected_numbers = ''
-            try:
-                vision_client = vision.ImageAnnotatorClient()
-                response = vision_client.text_detection(image=image)
-                texts = response.text_annotations
-                
-                if texts:
-                    import re
-                    text = texts[0].description
-                    # Look for patterns that match runner numbers (typically 1-6 digits)
-                    numbers = re.findall(r'\b\d{1,6}\b', text)
-                    detected_numbers = ','.join(numbers)
-                    logger.info(f"Detected numbers in image {filename}: {detected_numbers}")
-            except Exception as vision_error:
-                logger.error(f"Vision API error for {filename}: {str(vision_error)}")
-                logger.exception("Full traceback for Vision API error:")
-            
-            # Store image data in Firestore
-            image_data = {
-                'filename': filename,
-                'url': image_url,
-                'marathon_id': request.form.get('marathon_id'),
-                'detected_numbers': detected_numbers,
-                'upload_time': firestore.SERVER_TIMESTAMP,
-                'user_id': session['user_id']
-            }
+                blob_path = cached['blob_path']
+                image_url = cached['url']
+                logger.info(f"Reusing stored blob {blob_path} for duplicate upload {file.filename}")
+                try:
+                    bib_numbers, ocr_record = cached_ocr(cached, marathon_id)
+                except Throttled as e:
+                    return throttled_response(e)
+            else:
+                try:
+                    # Upload to Firebase Storage
+                    blob = bucket.blob(f'images/{filename}')
+                    
+                    if inline_ocr:
+                        # Storage upload and OCR of the same buffer run concurrently
+                        bib_numbers, ocr_record = upload_and_detect(blob, data, file.content_type, marathon_id)
+                    else:
+                        # Upload the file with appropriate content type
+                        with open(temp_path, 'rb') as temp_file:
+                            blob.upload_from_file(
+                                temp_file,
+                                content_type=file.content_type
+                            )
+                        
+                        # Clean up temporary file
+                        os.remove(temp_path)
+                    
+                    # The public URL is deterministic; the worker makes the blob
+                    # public once it has been processed.
+                    blob_path = blob.name
+                    image_url = blob.public_url
+                except Throttled as e:
+                    logger.warning(f"Storage throttled for {filename}: {str(e)}")
+                    if temp_path and os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    return throttled_response(e)
+                except Exception as storage_error:
+                    logger.error(f"Storage error: {str(storage_error)}")
+                    if temp_path and os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    return {'error': f'Storage error: {str(storage_error)}'}, 500
+                ocr_cache.put(content_hash, blob_path, image_url, bib_numbers, marathon_id, ocr_record)
+
+            derivatives = None
+            if cached and bib_numbers is not None:
+                # The first copy was OCR'd, so its derivatives exist (or are
+                # about to: with inline OCR they are rendered just after)
+                derivatives = derivative_urls(bucket, blob_path, current_app.config['DERIVATIVE_WIDTHS'])
             
+            # Store image data in Firestore; OCR and indexing happen in the worker
             try:
-                image_ref = current_app.config['db'].collection('images').document()
-                image_ref.set(image_data)
-                logger.info(f"Successfully stored image data in Firestore for {filename}")
+                image_ref, status = create_image_doc(
+                    blob_path, image_url, marathon_id, session['user_id'],
+                    content_hash=content_hash, bib_numbers=bib_numbers, derivatives=derivatives, ocr=ocr_record)
             except Exception as db_error:
                 logger.error(f"Firestore error for {filename}: {str(db_error)}")
                 logger.exception("Full traceback for Firestore error:")
                 return {'error': 'Failed to store image data'}, 500
             
-            return {'message': 'File uploaded successfully', 'image_id': image_ref.id}, 200
+            return {'message': 'File uploaded successfully', 'image_id': image_ref.id, 'status': status}, 202
         except exceptions.PermissionDenied as e:
             handle_api_error(e, "Google Cloud API")
             return {'error': str(e)}, 500
         except Exception as e:
             logger.error(f"Error uploading file: {str(e)}")
-            if os.path.exists(temp_path):
+            if temp_path and os.path.exists(temp_path):
                 os.remove(temp_path)
             return {'error': str(e)}, 500
 
     return {'error': 'Invalid file type'}, 400
 
+@bp.route('/upload_photos/signed_urls', methods=['POST'])
+@login_required
+def signed_upload_urls():
+    """Hand out V4 signed PUT URLs so the browser uploads straight to the bucket."""
+    bucket = current_app.config.get('storage')
+    if not bucket:
+        return {'error': 'Storage not configured'}, 500
+
+    files = (request.get_json(silent=True) or {}).get('files') or []
+    max_files = current_app.config['SIGNED_URL_MAX_FILES']
+    if not files:
+        return {'error': 'No files'}, 400
+    if len(files) > max_files:
+        return {'error': f'At most {max_files} files per request'}, 400
+
+    uploads = []
+    for item in files:
+        name = item.get('name', '')
+        if not allowed_file(name):
+            uploads.append({'name': name, 'error': 'Invalid file type'})
+            continue
+        try:
+            with span('storage.sign_url'):
+                upload = signed_upload(bucket, new_object_name(name),
+                                       item.get('content_type') or 'application/octet-stream',
+                                       session['user_id'], current_app.config['SIGNED_URL_EXPIRATION'])
+        except Exception as e:
+            logger.error(f"Error signing upload URL for {name}: {str(e)}")
+            return {'error': f'Storage error: {str(e)}'}, 500
+        uploads.append({'name': name, **upload})
+    return {'uploads': uploads}, 200
+
+@bp.route('/upload_photos/finalize', methods=['POST'])
+@login_required
+def finalize_uploads():
+    """Register objects the browser uploaded with signed URLs and queue their OCR."""
+    bucket = current_app.config.get('storage')
+    if not bucket or not current_app.config.get('db'):
+        return {'error': 'Storage not configured'}, 500
+
+    payload = request.get_json(silent=True) or {}
+    marathon_id = payload.get('marathon_id')
+    results = []
+    for object_name in payload.get('object_names') or []:
+        # Only objects under images/ that were signed for this user can be claimed
+        valid_name = isinstance(object_name, str) and object_name.startswith('images/')
+        try:
+            blob = bucket.get_blob(object_name) if valid_name else None
+        except Throttled as e:
+            return throttled_response(e)
+        uploader = (blob.metadata or {}).get(UPLOADER_METADATA_KEY) if blob else None
+        if uploader != session['user_id']:
+            results.append({'object_name': object_name, 'error': 'Upload not found'})
+            continue
+        try:
+            # A retried finalize gets back the doc an earlier attempt created
+            with span('firestore.find_image'):
+                existing = find_image_doc(object_name, session['user_id'])
+            image_ref, status = existing or create_image_doc(object_name, blob.public_url, marathon_id,
+                                                             session['user_id'])
+        except Exception as e:
+            logger.error(f"Firestore error for {object_name}: {str(e)}")
+            results.append({'object_name': object_name, 'error': 'Failed to store image data'})
+            continue
+        results.append({'object_name': object_name, 'image_id': image_ref.id, 'status': status})
+
+    failed = sum(1 for result in results if 'error' in result)
+    return {'results': results, 'failed': failed}, 207 if failed else 202
+
+@bp.route('/upload_photos/chunked', methods=['POST'])
+@login_required
+def chunked_upload_init():
+    """Start a chunked upload backed by a GCS resumable session."""
+    bucket = current_app.config.get('storage')
+    if not bucket or not current_app.config.get('db'):
+        return {'error': 'Storage not configured'}, 500
+
+    payload = request.get_json(silent=True) or {}
+    name = payload.get('name', '')
+    size = payload.get('size')
+    content_type = payload.get('content_type') or 'application/octet-stream'
+    if not allowed_file(name):
+        return {'error': 'Invalid file type'}, 400
+    if not isinstance(size, int) or not 0 < size <= current_app.config['UPLOAD_MAX_SIZE']:
+        return {'error': 'Invalid file size'}, 400
+
+    object_name = new_object_name(name)
+    try:
+        blob = bucket.blob(object_name)
+        blob.metadata = {UPLOADER_METADATA_KEY: session['user_id']}
+        session_url = start_session(blob, content_type, size)
+        with span('firestore.save_upload'):
+            upload_id = save_session_url(current_app.config['db'], session_url, session['user_id'])
+    except Throttled as e:
+        return throttled_response(e)
+    except Exception as e:
+        logger.error(f"Error starting resumable upload for {name}: {str(e)}")
+        return {'error': f'Storage error: {str(e)}'}, 500
+
+    token = encode_upload_token(current_app.config['SECRET_KEY'], upload_id, object_name, size,
+                                content_type, session['user_id'])
+    return {
+        'upload_token': token,
+        'object_name': object_name,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE'],
+        'offset': 0,
+    }, 201
+
+def _load_upload(token):
+    state = decode_upload_token(current_app.config['SECRET_KEY'], token)
+    if state['user_id'] != session['user_id'] or 'upload_id' not in state:
+        raise ResumableUploadError('Invalid upload token')
+    return state
+
+def _session_url(state):
+    with span('firestore.load_upload'):
+        return load_session_url(current_app.config['db'], state['upload_id'])
+
+@bp.route('/upload_photos/chunked/<token>', methods=['GET'])
+@login_required
+def chunked_upload_status(token):
+    """Report how many bytes are persisted, so the browser can resume from there."""
+    try:
+        state = _load_upload(token)
+        with span('storage.query_offset'):
+            offset = current_app.config['quota'].call('storage', query_offset,
+                                                      (_session_url(state), state['size']))
+    except ResumableUploadError as e:
+        return {'error': str(e)}, 400
+    except Throttled as e:
+        return throttled_response(e)
+    except Exception as e:
+        logger.error(f"Error querying resumable upload: {str(e)}")
+        return {'error': f'Storage error: {str(e)}'}, 502
+    return {'offset': offset, 'size': state['size'], 'complete': offset >= state['size']}, 200
+
+@bp.route('/upload_photos/chunked/<token>', methods=['PUT'])
+@login_required
+def chunked_upload_append(token):
+    """Stream one chunk of the request body straight into the resumable session."""
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or not length:
+        return {'error': 'offset and a non-empty body are required'}, 400
+
+    try:
+        state = _load_upload(token)
+        session_url = _session_url(state)
+        # Like the bucket's own calls; the request stream cannot be replayed
+        with span('storage.put_chunk'):
+            committed = current_app.config['quota'].call(
+                'storage', put_chunk, (session_url, request.stream, offset, length, state['size']), retry=False)
+    except ResumableUploadError as e:
+        return {'error': str(e)}, 400
+    except Throttled as e:
+        return throttled_response(e)
+    except Exception as e:
+        logger.error(f"Error appending chunk at offset {offset}: {str(e)}")
+        return {'error': f'Storage error: {str(e)}'}, 502
+    return {'offset': committed, 'size': state['size'], 'complete': committed >= state['size']}, 200
+
+@bp.route('/upload_photos/chunked/<token>/complete', methods=['POST'])
+@login_required
+def chunked_upload_complete(token):
+    """Check the finished object and register it like any other upload."""
+    if not current_app.config.get('db'):
+        return {'error': 'Database not configured'}, 500
+    try:
+        state = _load_upload(token)
+    except ResumableUploadError as e:
+        return {'error': str(e)}, 400
+
+    try:
+        blob = current_app.config['storage'].get_blob(state['object_name'])
+    except Throttled as e:
+        return throttled_response(e)
+    if blob is None or blob.size != state['size']:
+        return {'error': 'Upload is not complete'}, 409
+
+    marathon_id = (request.get_json(silent=True) or {}).get('marathon_id')
+    try:
+        # A retried complete gets back the doc an earlier attempt created
+        with span('firestore.find_image'):
+            existing = find_image_doc(state['object_name'], session['user_id'])
+        image_ref, status = existing or create_image_doc(state['object_name'], blob.public_url, marathon_id,
+                                                         session['user_id'])
+    except Exception as e:
+        logger.error(f"Firestore error for {state['object_name']}: {str(e)}")
+        return {'error': 'Failed to store image data'}, 500
+    # The object is final; its session URL is no longer needed (expires_at covers failures here)
+    try:
+        delete_session_url(current_app.config['db'], state['upload_id'])
+    except Exception as e:
+        logger.error(f"Error removing upload session {state['upload_id']}: {str(e)}")
+    return {'message': 'File uploaded successfully', 'image_id': image_ref.id, 'status': status}, 202
+
+def fuzzy_gallery_page(marathon_id, numbers, page, per_page):
+    """One page of images whose bibs are within edit distance 1 of a searched number, best match first.
+
+    Returns the page's image dicts (with ``match_score`` and ``matched_bib``)
+    and the total number of matches.
+    """
+    db = current_app.config['db']
+    with span('bib_index.fuzzy_search'):
+        matches = current_app.config['bib_index'].get(db, marathon_id).fuzzy_search(numbers, max_distance=1)
+    page_matches = matches[(page - 1) * per_page:page * per_page]
+
+    refs = [db.collection('images').document(image_id) for image_id, _, _ in page_matches]
+    with span('firestore.gallery_docs'):
+        docs = {doc.id: doc for doc in db.get_all(refs, field_paths=GALLERY_FIELDS) if doc.exists}
+    images = []
+    for image_id, score, bib in page_matches:
+        if image_id in docs:
+            images.append({**docs[image_id].to_dict(), 'id': image_id, 'match_score': score, 'matched_bib': bib})
+    return images, len(matches)
+
+def parse_gallery_args(args):
+    """Read the gallery filters from a query string.
+
+    Returns ``(marathon_id, search_numbers, numbers, fuzzy, cursor, page)``.
+    Fuzzy matching needs a marathon and at least one number and is dropped
+    otherwise. Raises ValueError on a malformed page token.
+    """
+    marathon_id = args.get('marathon_id') or None
+    search_numbers = args.get('search_numbers', '')
+    numbers = parse_bib_list(search_numbers)
+    fuzzy = args.get('fuzzy') == '1' and bool(marathon_id and numbers)
+
+    cursor, page = None, 1
+    if fuzzy:
+        # Matches are ranked, not time ordered, so fuzzy pages are offsets
+        page = max(args.get('page', 1, type=int), 1)
+    elif args.get('page_token'):
+        cursor, page = decode_page_token(args['page_token'])
+    return marathon_id, search_numbers, numbers, fuzzy, cursor, page
+
+def query_gallery(marathon_id, numbers, fuzzy, cursor, page, per_page):
+    """Run the gallery queries for one page.
+
+    Returns a dict with the page's ``images`` plus ``next_page_token`` (time
+    ordered results) or ``next_page`` (fuzzy results) and ``total``, which is
+    None when it could not be counted. ``complete`` is False when any query
+    failed, in which case the result must not be cached.
+    """
+    complete = True
+    # Query images from Firestore
+    images_ref = current_app.config['db'].collection('images')
+    query = images_ref
+    
+    if marathon_id:
+        query = query.where('marathon_id', '==', marathon_id)
+    
+    if fuzzy:
+        queries = []
+    elif numbers:
+        # Exact bib match on the indexed array field, one query per chunk of
+        # values the array_contains_any filter accepts.
+        chunk_size = current_app.config['BIB_QUERY_CHUNK_SIZE']
+        queries = [query.where('bib_numbers', 'array_contains_any', chunk)
+                   for chunk in chunked(numbers, chunk_size)]
+    else:
+        queries = [query]
+
+    # Read one page (plus one row to know whether there is a next page)
+    # per query, keyed on (upload_time, doc id) so cursors are stable.
+    images_by_id = {}
+    try:
+        for chunk_query in queries:
+            page_query = (chunk_query.select(GALLERY_FIELDS)
+                          .order_by('upload_time', direction=firestore.Query.DESCENDING)
+                          .order_by('__name__', direction=firestore.Query.DESCENDING))
+            if cursor:
+                page_query = page_query.start_after(list(cursor))
+            with span('firestore.gallery_query'):
+                for doc in page_query.limit(per_page + 1).stream():
+                    data = doc.to_dict()
+                    data['id'] = doc.id  # Add document ID to the data
+                    images_by_id[doc.id] = data
+    except Exception as e:
+        logger.error(f"Error fetching images: {str(e)}")
+        logger.exception("Full traceback for image fetch error:")
+        complete = False
+
+    images = sorted(images_by_id.values(), key=sort_key, reverse=True)
+    images_page = images[:per_page]
+
+    next_page_token = None
+    if len(images) > per_page:
+        last = images_page[-1]
+        next_page_token = encode_page_token(last.get('upload_time'), last['id'], page + 1)
+
+    # Count with an aggregation query instead of reading every document.
+    # With several bib chunks a photo matching more than one chunk is
+    # counted once per chunk, so the total is an upper bound.
+    total = None
+    next_page = None
+    if fuzzy:
+        try:
+            images_page, total = fuzzy_gallery_page(marathon_id, numbers, page, per_page)
+            next_page = page + 1 if page * per_page < total else None
+        except Exception as e:
+            logger.error(f"Error running fuzzy search: {str(e)}")
+            logger.exception("Full traceback for fuzzy search error:")
+            complete = False
+    elif marathon_id and not numbers:
+        # The whole marathon: its stats doc already has the count
+        try:
+            with span('firestore.marathon_stats'):
+                total = get_marathon_stats(current_app.config['db'], [marathon_id],
+                                           current_app.config['MARATHON_STATS_SHARDS'])[marathon_id]['images']
+        except Exception as e:
+            logger.error(f"Error reading marathon stats: {str(e)}")
+            complete = False
+    else:
+        try:
+            with span('firestore.gallery_count'):
+                total = sum(chunk_query.count().get()[0][0].value for chunk_query in queries)
+        except Exception as e:
+            logger.error(f"Error counting images: {str(e)}")
+            complete = False
+
+    return {'images': images_page, 'next_page_token': next_page_token, 'next_page': next_page,
+            'total': total, 'complete': complete}
+
 @bp.route('/gallery')
 @login_required
 def gallery():
@@ -254,62 +614,69 @@ def gallery():
             flash("Database connection is not configured. Please check your Firebase settings.", "error")
             return redirect(url_for('main.index'))
 
-        marathon_id = request.args.get('marathon_id')
-        search_numbers = request.args.get('search_numbers', '')
-        page = request.args.get('page', 1, type=int)
-        
-        # Query images from Firestore
-        images_ref = current_app.config['db'].collection('images')
-        query = images_ref
-        
-        if marathon_id:
-            query = query.where('marathon_id', '==', marathon_id)
-        
-        # Get all images that match the criteria
-        images = []
+        args = request.args
         try:
-            docs = query.order_by('upload_time', direction=firestore.Query.DESCENDING).stream()
-            for doc in docs:
-                data = doc.to_dict()
-                data['id'] = doc.id  # Add document ID to the data
-                images.append(data)
-        except Exception as e:
-            logger.error(f"Error fetching images: {str(e)}")
-            logger.exception("Full traceback for image fetch error:")
-        
-        # Filter by numbers if search_numbers is provided
-        if search_numbers:
-            numbers = [n.strip() for n in search_numbers.split(',')]
-            images = [
-                img for img in images 
-                if img.get('detected_numbers') and 
-                any(number in img['detected_numbers'] for number in numbers)
-            ]
-        
-        # Simple pagination
-        per_page = 24
-        total = len(images)
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        images_page = images[start_idx:end_idx]
-        
+            marathon_id, search_numbers, numbers, fuzzy, cursor, page = parse_gallery_args(args)
+        except ValueError as e:
+            logger.warning(str(e))
+            flash('Invalid page link, showing the first page')
+            args = args.copy()
+            args.pop('page_token')
+            marathon_id, search_numbers, numbers, fuzzy, cursor, page = parse_gallery_args(args)
+        if args.get('fuzzy') == '1' and numbers and not fuzzy:
+            flash('Select a marathon to search with fuzzy matching')
+
+        # The results fragment only depends on the filters and the marathon's
+        # gallery version, so it is shared across users and requests until
+        # an image of the marathon changes
+        page_cache = current_app.config.get('page_cache')
+        cache_key = None
+        results_html = None
+        if page_cache and marathon_id:
+            try:
+                with span('firestore.marathon_version'):
+                    generation = get_marathon_version(current_app.config['db'], marathon_id,
+                                                      current_app.config['MARATHON_STATS_SHARDS'])
+                cache_key = page_cache.key(marathon_id, generation, ','.join(numbers), fuzzy,
+                                           args.get('page_token', ''), page)
+                with span('page_cache.get'):
+                    results_html = page_cache.get(cache_key)
+            except Exception as e:
+                logger.error(f"Error reading gallery version of marathon {marathon_id}: {str(e)}")
+
+        if results_html is None:
+            per_page = current_app.config['GALLERY_PAGE_SIZE']
+            result = query_gallery(marathon_id, numbers, fuzzy, cursor, page, per_page)
+            total = result['total']
+            # The fragment is shared by every spelling of the same search, so
+            # its links carry the normalized numbers the cache key uses
+            results_html = render_template('_gallery_results.html',
+                                           images=result['images'],
+                                           selected_marathon=marathon_id,
+                                           search_numbers=','.join(numbers),
+                                           fuzzy=fuzzy,
+                                           page=page,
+                                           next_page_token=result['next_page_token'],
+                                           next_page=result['next_page'],
+                                           total_pages=(total + per_page - 1) // per_page if total is not None else None)
+            if cache_key and result['complete']:
+                page_cache.set(cache_key, results_html)
+
         # Get marathons for filter dropdown
         marathons = []
         try:
-            marathons_ref = current_app.config['db'].collection('marathons')
-            marathon_docs = marathons_ref.where('is_active', '==', True).stream()
-            marathons = [doc.to_dict() for doc in marathon_docs]
+            with span('firestore.marathons'):
+                marathons = current_app.config['marathon_cache'].active(current_app.config['db'])
         except Exception as e:
             logger.error(f"Error fetching marathons: {str(e)}")
             logger.exception("Full traceback for marathon fetch error:")
         
         return render_template('gallery.html',
-                            images=images_page,
+                            results_html=results_html,
                             marathons=marathons,
                             selected_marathon=marathon_id,
                             search_numbers=search_numbers,
-                            page=page,
-                            total_pages=(total + per_page - 1) // per_page)
+                            fuzzy=fuzzy)
     except exceptions.PermissionDenied as e:
         handle_api_error(e, "Cloud Firestore API")
         return redirect(url_for('main.index'))
@@ -319,5 +686,134 @@ def gallery():
         flash('Error loading gallery')
         return redirect(url_for('main.index'))
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
+def gallery_image_json(image):
+    """JSON form of a gallery image, with the smallest JPEG derivative as its thumbnail."""
+    derivatives = image.get('derivatives') or {}
+    jpeg = derivatives.get('jpeg') or {}
+    upload_time = image.get('upload_time')
+    data = {
+        'id': image['id'],
+        'url': image.get('url'),
+        'thumbnail_url': jpeg[min(jpeg, key=int)] if jpeg else image.get('url'),
+        'derivatives': derivatives,
+        'detected_numbers': image.get('detected_numbers', ''),
+        'status': image.get('status', STATUS_INDEXED),
+        'upload_time': upload_time.isoformat() if isinstance(upload_time, datetime) else None,
+    }
+    if 'match_score' in image:
+        data['match_score'] = image['match_score']
+        data['matched_bib'] = image['matched_bib']
+    return data
+
+def set_gallery_cache_headers(response, etag):
+    # Responses sit behind login, so only the browser may cache them
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['GALLERY_CACHE_MAX_AGE']
+    response.vary.add('Cookie')
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+@bp.route('/gallery/images')
+@login_required
+def gallery_images():
+    """JSON page of the gallery (same filters as /gallery) for infinite scroll and API clients.
+
+    Responses for one marathon carry a weak ETag derived from its gallery
+    version, so a matching If-None-Match is answered with 304 after one
+    batched read of its stats shards and before any query runs.
+    """
+    if not current_app.config.get('db'):
+        return {'error': 'Database not configured'}, 500
+    try:
+        marathon_id, search_numbers, numbers, fuzzy, cursor, page = parse_gallery_args(request.args)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    etag = None
+    version = None
+    if marathon_id:
+        try:
+            with span('firestore.marathon_version'):
+                version = get_marathon_version(current_app.config['db'], marathon_id,
+                                               current_app.config['MARATHON_STATS_SHARDS'])
+            etag = hashlib.sha1(f'{version}:{request.full_path}'.encode('utf-8')).hexdigest()
+        except Exception as e:
+            logger.error(f"Error reading gallery version of marathon {marathon_id}: {str(e)}")
+        if etag and request.if_none_match.contains_weak(etag):
+            return set_gallery_cache_headers(current_app.response_class(status=304), etag)
+
+    try:
+        result = query_gallery(marathon_id, numbers, fuzzy, cursor, page,
+                               current_app.config['GALLERY_PAGE_SIZE'])
+    except exceptions.PermissionDenied as e:
+        logger.error(f"Cloud Firestore API error: {str(e)}")
+        return {'error': 'Gallery is unavailable'}, 503
+
+    response = jsonify({
+        'images': [gallery_image_json(image) for image in result['images']],
+        'next_page_token': result['next_page_token'],
+        'next_page': result['next_page'],
+        'page': page,
+        'total': result['total'],
+        'version': version,
+    })
+    return set_gallery_cache_headers(response, etag)
+
+@bp.route('/gallery/cache_stats')
+@login_required
+def cache_stats():
+    """Hit ratios and sizes of this process's gallery caches."""
+    page_cache = current_app.config.get('page_cache')
+    return {
+        'pid': os.getpid(),
+        'page_cache': page_cache.stats() if page_cache else None,
+        'bib_index': current_app.config['bib_index'].stats(),
+        'marathon_cache': current_app.config['marathon_cache'].stats(),
+    }
+
+@bp.route('/gallery/bibs')
+@login_required
+def bib_suggestions():
+    """Typeahead for the gallery search box: bibs in a marathon starting with ``prefix``, with photo counts."""
+    if not current_app.config.get('db'):
+        return {'error': 'Database not configured'}, 500
+
+    marathon_id = request.args.get('marathon_id')
+    prefix = normalize_bib(request.args.get('prefix', ''))
+    limit = min(max(request.args.get('limit', 10, type=int), 1), current_app.config['BIB_SUGGEST_MAX'])
+    if not marathon_id:
+        return {'error': 'marathon_id is required'}, 400
+    if not prefix:
+        return {'marathon_id': marathon_id, 'prefix': prefix, 'bibs': []}
+
+    try:
+        with span('bib_index.load'):
+            index = current_app.config['bib_index'].get(current_app.config['db'], marathon_id)
+    except Exception as e:
+        logger.error(f"Error loading bib index for marathon {marathon_id}: {str(e)}")
+        return {'error': 'Suggestions are unavailable'}, 503
+    return {
+        'marathon_id': marathon_id,
+        'prefix': prefix,
+        'bibs': [{'bib': bib, 'photos': count} for bib, count in index.prefix_search(prefix, limit)],
+    }
+
+@bp.route('/images/<image_id>/status')
+@login_required
+def image_status(image_id):
+    if not current_app.config.get('db'):
+        return {'error': 'Database not configured'}, 500
+
+    with span('firestore.image_status'):
+        doc = current_app.config['db'].collection('images').document(image_id).get(
+            field_paths=['status', 'detected_numbers', 'error'])
+    if not doc.exists:
+        return {'error': 'Image not found'}, 404
+    data = doc.to_dict()
+    return {
+        'image_id': image_id,
+        'status': data.get('status', STATUS_INDEXED),
+        'detected_numbers': data.get('detected_numbers', ''),
+        'error': data.get('error'),
+    }, 200
@@ -0,0 +1,82 @@
+from cachetools import TTLCache
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_KEY = ('active',)
+
+
+class MarathonCache:
+    """Process-local, short-TTL cache of marathon lists.
+
+    Holds the active-marathon list shown on the upload and gallery pages and
+    each user's list for manage_marathons. Writes through the app call
+    ``invalidate``; with ``listen=True`` a Firestore snapshot listener also
+    drops the cache whenever any marathon document changes, which covers
+    writes made by other processes.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, listen=False):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._listen = listen
+        self._watch = None
+        self._watch_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def active(self, db):
+        return self._get(db, ACTIVE_KEY, lambda: db.collection('marathons').where('is_active', '==', True))
+
+    def for_user(self, db, user_id):
+        return self._get(db, ('user', user_id),
+                         lambda: db.collection('marathons').where('user_id', '==', user_id))
+
+    def invalidate(self, user_id=None):
+        """Drop the active list and ``user_id``'s list, or everything when no user is given."""
+        with self._lock:
+            if user_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(ACTIVE_KEY, None)
+                self._cache.pop(('user', user_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache),
+                    'listening': self._watch is not None and self._watch_pid == os.getpid()}
+
+    def _get(self, db, key, build_query):
+        self._ensure_listener(db)
+        with self._lock:
+            marathons = self._cache.get(key)
+            if marathons is not None:
+                self.hits += 1
+                return marathons
+            self.misses += 1
+
+        marathons = [{**doc.to_dict(), 'id': doc.id} for doc in build_query().stream()]
+        with self._lock:
+            self._cache[key] = marathons
+        return marathons
+
+    def _ensure_listener(self, db):
+        # Listener threads do not survive a fork, so start one per process
+        if not self._listen or self._watch_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watch_pid == os.getpid():
+                return
+            self._watch_pid = os.getpid()
+        try:
+            self._watch = db.collection('marathons').on_snapshot(self._on_snapshot)
+            logger.info("Marathon cache snapshot listener started")
+        except Exception as e:
+            logger.error(f"Error starting marathon snapshot listener: {str(e)}")
+            self._watch = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        if changes:
+            self.invalidate()
@@ -0,0 +1,207 @@
+from collections import Counter
+from firebase_admin import firestore
+import logging
+import random
+
+from app.batch_writes import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# marathon_stats/<marathon_id>/shards/<n> hold the counters; writers pick a
+# random shard so bulk uploads into one marathon do not contend on a single
+# document, and readers sum all of them. marathon_stats/<marathon_id>/bibs/<bib>
+# exists while some image has the bib and counts them in MARKER_IMAGES, so
+# distinct_bibs goes down again when re-extraction drops a bib. Image docs
+# carry stats_indexed / stats_failed flags so each image is counted at most
+# once, in at most one of indexed and failed, and stats_bibs, the bibs it
+# adds to the markers.
+STATS_COLLECTION = 'marathon_stats'
+COUNTERS = ('images', 'indexed', 'failed', 'distinct_bibs')
+MARKER_IMAGES = 'images'
+
+# Summed like the counters, but only ever incremented: every image write of
+# the marathon bumps it in the same transaction, so gallery responses can be
+# validated against it without a hot per-marathon document
+VERSION_FIELD = 'version'
+
+
+def _stats_ref(db, marathon_id):
+    return db.collection(STATS_COLLECTION).document(marathon_id)
+
+
+def _shard_refs(db, marathon_id, shards):
+    return [_stats_ref(db, marathon_id).collection('shards').document(str(n)) for n in range(shards)]
+
+
+@firestore.transactional
+def _write_image(transaction, db, marathon_id, image_ref, data, created, bib_numbers, shards, failed=False):
+    data = dict(data)
+    increments = {}
+
+    # Transactions need every read before the first write
+    flags = {}
+    if not created and (bib_numbers is not None or failed):
+        snapshot = image_ref.get(field_paths=['stats_indexed', 'stats_failed', 'stats_bibs'],
+                                 transaction=transaction)
+        flags = (snapshot.to_dict() or {}) if snapshot.exists else {}
+    # Indexing a failed image moves it from failed to indexed, and back
+    counted, uncounted = ('failed', 'indexed') if failed else ('indexed', 'failed')
+    if bib_numbers is not None or failed:
+        if not flags.get(f'stats_{counted}'):
+            increments[counted] = 1
+            data[f'stats_{counted}'] = True
+        if flags.get(f'stats_{uncounted}'):
+            increments[uncounted] = -1
+            data[f'stats_{uncounted}'] = False
+    markers = {}
+    added = removed = set()
+    if bib_numbers is not None:
+        old_bibs = set(flags.get('stats_bibs') or [])
+        added, removed = set(bib_numbers) - old_bibs, old_bibs - set(bib_numbers)
+        data['stats_bibs'] = list(bib_numbers)
+        if added or removed:
+            bibs_ref = _stats_ref(db, marathon_id).collection('bibs')
+            refs = [bibs_ref.document(bib) for bib in sorted(added | removed)]
+            markers = {snapshot.id: snapshot for snapshot in transaction.get_all(refs)}
+    if created:
+        increments['images'] = 1
+
+    if created:
+        transaction.set(image_ref, data)
+    else:
+        transaction.update(image_ref, data)
+    distinct = 0
+    for bib in added:
+        marker = markers[bib]
+        if marker.exists:
+            transaction.update(marker.reference, {MARKER_IMAGES: firestore.Increment(1)})
+        else:
+            transaction.set(marker.reference, {'first_seen': firestore.SERVER_TIMESTAMP, MARKER_IMAGES: 1})
+            distinct += 1
+    for bib in removed:
+        marker = markers[bib]
+        if not marker.exists:
+            continue
+        if (marker.to_dict() or {}).get(MARKER_IMAGES, 1) > 1:
+            transaction.update(marker.reference, {MARKER_IMAGES: firestore.Increment(-1)})
+        else:
+            transaction.delete(marker.reference)
+            distinct -= 1
+    if distinct:
+        increments['distinct_bibs'] = distinct
+    shard = {name: firestore.Increment(value) for name, value in increments.items()}
+    shard[VERSION_FIELD] = firestore.Increment(1)
+    if created:
+        shard['last_upload'] = firestore.SERVER_TIMESTAMP
+    transaction.set(random.choice(_shard_refs(db, marathon_id, shards)), shard, merge=True)
+
+
+def create_image(db, image_ref, image_data, shards):
+    """Create an image doc and count it towards its marathon's stats in one transaction.
+
+    An image created as already indexed (``bib_numbers`` set) is counted as
+    OCR-complete too.
+    """
+    marathon_id = image_data.get('marathon_id')
+    if not marathon_id:
+        image_ref.set(image_data)
+        return
+    bib_numbers = image_data['bib_numbers'] if image_data.get('status') == 'indexed' else None
+    _write_image(db.transaction(), db, marathon_id, image_ref, image_data, True, bib_numbers, shards)
+
+
+def index_image(db, image_ref, marathon_id, update, bib_numbers, shards):
+    """Apply the indexing ``update`` to an image doc and its marathon's stats in one transaction.
+
+    Each image is counted as OCR-complete once, however often it is re-indexed,
+    and stops counting as failed.
+    """
+    if not marathon_id:
+        image_ref.update(update)
+        return
+    _write_image(db.transaction(), db, marathon_id, image_ref, update, False, bib_numbers, shards)
+
+
+def fail_image(db, image_ref, marathon_id, update, shards):
+    """Apply the failure ``update`` to an image doc and count it as failed in its marathon's stats.
+
+    The image stops counting as OCR-complete if it was.
+    """
+    if not marathon_id:
+        image_ref.update(update)
+        return
+    _write_image(db.transaction(), db, marathon_id, image_ref, update, False, None, shards, failed=True)
+
+
+def get_marathon_version(db, marathon_id, shards):
+    return get_marathon_stats(db, [marathon_id], shards)[marathon_id][VERSION_FIELD]
+
+
+def get_marathon_stats(db, marathon_ids, shards):
+    """Return ``{marathon_id: {'images', 'indexed', 'failed', 'distinct_bibs', 'version', 'last_upload'}}``.
+
+    All marathons are read with one batched read of their shards.
+    """
+    marathon_ids = [marathon_id for marathon_id in marathon_ids if marathon_id]
+    stats = {marathon_id: {**{name: 0 for name in COUNTERS + (VERSION_FIELD,)}, 'last_upload': None}
+             for marathon_id in marathon_ids}
+    refs = [ref for marathon_id in marathon_ids for ref in _shard_refs(db, marathon_id, shards)]
+    if not refs:
+        return stats
+    for snapshot in db.get_all(refs):
+        if not snapshot.exists:
+            continue
+        marathon_stats = stats[snapshot.reference.parent.parent.id]
+        data = snapshot.to_dict()
+        for name in COUNTERS + (VERSION_FIELD,):
+            marathon_stats[name] += data.get(name, 0)
+        last_upload = data.get('last_upload')
+        if last_upload and (marathon_stats['last_upload'] is None or last_upload > marathon_stats['last_upload']):
+            marathon_stats['last_upload'] = last_upload
+    return stats
+
+
+def rebuild_marathon_stats(db, marathon_id, shards):
+    """Recompute a marathon's stats, bib markers and image flags from its image docs.
+
+    Needed once for data written before the counters or the markers' image
+    counts existed. Not safe to run while images of the marathon are being ingested.
+    """
+    write = BatchWriter(db)
+    stats_ref = _stats_ref(db, marathon_id)
+    markers = {marker.id for marker in stats_ref.collection('bibs').select([]).stream()}
+
+    images = indexed = failed = 0
+    last_upload = None
+    bibs = Counter()
+    query = db.collection('images').where('marathon_id', '==', marathon_id)
+    for doc in query.select(['status', 'bib_numbers', 'upload_time']).stream():
+        data = doc.to_dict()
+        images += 1
+        upload_time = data.get('upload_time')
+        if upload_time and (last_upload is None or upload_time > last_upload):
+            last_upload = upload_time
+        indexed_now = data.get('status') == 'indexed'
+        image_bibs = list(dict.fromkeys(data.get('bib_numbers') or [])) if indexed_now else []
+        indexed += indexed_now
+        bibs.update(image_bibs)
+        failed_now = data.get('status') == 'failed'
+        failed += failed_now
+        write('update', doc.reference,
+              {'stats_indexed': indexed_now, 'stats_failed': failed_now, 'stats_bibs': image_bibs})
+
+    for bib in markers - bibs.keys():
+        write('delete', stats_ref.collection('bibs').document(bib))
+    for bib, count in bibs.items():
+        marker = {MARKER_IMAGES: count}
+        if bib not in markers:
+            marker['first_seen'] = firestore.SERVER_TIMESTAMP
+        write('set', stats_ref.collection('bibs').document(bib), marker, merge=True)
+    totals = {'images': images, 'indexed': indexed, 'failed': failed, 'distinct_bibs': len(bibs),
+              'last_upload': last_upload}
+    # Merged so the version is kept (and bumped), never reset to an old value
+    for n, shard_ref in enumerate(_shard_refs(db, marathon_id, shards)):
+        shard = {**totals, VERSION_FIELD: firestore.Increment(1)} if n == 0 else {name: 0 for name in COUNTERS}
+        write('set', shard_ref, shard, merge=True)
+    write.flush()
+    return totals
@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+import os
+import re
+import time
+
+# Seconds; uploads and Vision batches run into tens of seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Under gunicorn every worker writes its samples to files in this directory
+# (set before prometheus_client is imported) and /metrics adds them up
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+# Characters allowed in a Server-Timing metric name (an HTTP token)
+_NON_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+SPAN_SECONDS = Histogram('foteam_span_seconds', 'Time spent in an external call or request phase',
+                         ['span'], buckets=BUCKETS)
+SPAN_ERRORS = Counter('foteam_span_errors_total', 'External calls or request phases that raised', ['span'])
+SPANS_IN_FLIGHT = Gauge('foteam_spans_in_flight', 'External calls or request phases in progress', ['span'],
+                        multiprocess_mode='livesum')
+REQUEST_SECONDS = Histogram('foteam_request_seconds', 'Time to produce a response', ['endpoint', 'method'],
+                            buckets=BUCKETS)
+REQUESTS = Counter('foteam_requests_total', 'Responses sent', ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('foteam_requests_in_flight', 'Requests being handled', ['endpoint'],
+                           multiprocess_mode='livesum')
+TOKEN_CACHE = Counter('foteam_auth_token_cache_total', 'Firebase ID-token cache hits, misses and invalidations',
+                      ['result'])
+TOKEN_CACHE_ENTRIES = Gauge('foteam_auth_token_cache_entries', 'Verified ID tokens cached',
+                            multiprocess_mode='livesum')
+# Count is the number of batch_annotate_images calls, sum the images sent
+VISION_BATCH_IMAGES = Histogram('foteam_vision_batch_images', 'Images per Vision batch request',
+                                buckets=(1, 2, 4, 8, 12, 16))
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as ``name`` in the span metrics and the request's Server-Timing header.
+
+    Works outside requests (worker jobs, batcher threads) too; those only
+    feed the metrics.
+    """
+    in_flight = SPANS_IN_FLIGHT.labels(name)
+    in_flight.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        SPAN_ERRORS.labels(name).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        in_flight.dec()
+        SPAN_SECONDS.labels(name).observe(elapsed)
+        if has_request_context():
+            _record_timing(name, elapsed)
+
+
+def _record_timing(name, elapsed):
+    timings = g.setdefault('span_timings', {})
+    total, count = timings.get(name, (0.0, 0))
+    timings[name] = (total + elapsed, count + 1)
+
+
+def server_timing(timings, total):
+    """Server-Timing header value: one entry per span (summed over repeated calls) plus the total."""
+    entries = []
+    for name, (elapsed, count) in timings.items():
+        entry = f'{_NON_TOKEN.sub("_", name)};dur={elapsed * 1000:.1f}'
+        if count > 1:
+            entry += f';desc="{count} calls"'
+        entries.append(entry)
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(_endpoint()).inc()
+
+
+def _finish_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.labels(_endpoint(), request.method).observe(elapsed)
+    REQUESTS.labels(_endpoint(), request.method, str(response.status_code)).inc()
+    if current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = server_timing(g.get('span_timings', {}), elapsed)
+    return response
+
+
+def _end_request(exc):
+    # Teardown runs even when the response could not be built
+    if g.pop('request_started', None) is not None:
+        REQUESTS_IN_FLIGHT.labels(_endpoint()).dec()
+
+
+def _render_started(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    stack = g.get('render_started')
+    if not stack:
+        return
+    name = f'render.{template.name}'
+    elapsed = time.perf_counter() - stack.pop()
+    SPAN_SECONDS.labels(name).observe(elapsed)
+    if has_request_context():
+        _record_timing(name, elapsed)
+
+
+def metrics():
+    """Prometheus exposition of this host's web workers (and any process sharing the multiprocess directory)."""
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return current_app.response_class(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Time every request and template render, and serve the metrics at METRICS_PATH."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    if app.config['METRICS_PATH']:
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', metrics)
@@ -0,0 +1,126 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from google.cloud import vision
+from google.rpc import code_pb2
+import logging
+import threading
+import time
+
+from app.metrics import VISION_BATCH_IMAGES, span
+from app.quota import Throttled
+
+logger = logging.getLogger(__name__)
+
+# batch_annotate_images accepts at most 16 images per synchronous call
+VISION_BATCH_LIMIT = 16
+
+# Keep batches of inline image bytes under the API's request size limit
+VISION_BATCH_MAX_BYTES = 8 * 1024 * 1024
+
+
+class BatchingOCR:
+    """Coalesce concurrent text detection requests into batch_annotate_images calls.
+
+    Callers block in ``detect_text`` while their image waits in the current
+    batch. A batch is sent as soon as it holds ``batch_size`` images (or
+    ``max_bytes`` of inline image content) or its oldest image has waited
+    ``max_wait`` seconds, so a lone upload is delayed by at most
+    ``max_wait``. Each caller gets back its own ``AnnotateImageResponse``.
+    With a ``governor`` every batch waits for quota for all of its images;
+    callers whose image could not be sent within quota get Throttled.
+    """
+
+    def __init__(self, client, batch_size=VISION_BATCH_LIMIT, max_wait=0.2, max_in_flight=4,
+                 max_bytes=VISION_BATCH_MAX_BYTES, governor=None):
+        self.client = client
+        self.governor = governor
+        self.batch_size = max(1, min(batch_size, VISION_BATCH_LIMIT))
+        self.max_wait = max_wait
+        self.max_bytes = max_bytes
+        self._pending = []
+        self._pending_bytes = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._thread = None
+
+    def submit(self, image):
+        """Queue a ``vision.Image`` for text detection and return a Future for its response."""
+        request = vision.AnnotateImageRequest(
+            image=image,
+            features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+        )
+        future = Future()
+        size = len(image.content)
+        with self._cond:
+            self._ensure_thread()
+            self._pending.append((request, future, time.monotonic(), size))
+            self._pending_bytes += size
+            self._cond.notify()
+        return future
+
+    def detect_text(self, image, timeout=None):
+        return self.submit(image).result(timeout=timeout)
+
+    def _ensure_thread(self):
+        # Started lazily so a batcher built before a fork gets its own
+        # thread in each child process.
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='ocr-batcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = self._pending[0][2] + self.max_wait
+                while len(self._pending) < self.batch_size and self._pending_bytes < self.max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+            self._executor.submit(self._send, batch)
+
+    def _take_batch(self):
+        # Always take at least one image, even if it alone exceeds max_bytes
+        count, size = 0, 0
+        for *_, item_size in self._pending[:self.batch_size]:
+            if count and size + item_size > self.max_bytes:
+                break
+            count += 1
+            size += item_size
+        batch = self._pending[:count]
+        del self._pending[:count]
+        self._pending_bytes -= size
+        return batch
+
+    def _send(self, batch):
+        requests = [request for request, *_ in batch]
+        try:
+            with span('vision.batch_annotate'):
+                if self.governor:
+                    response = self.governor.call('vision', self.client.batch_annotate_images,
+                                                  kwargs={'requests': requests}, cost=len(batch))
+                else:
+                    response = self.client.batch_annotate_images(requests=requests)
+        except Exception as e:
+            logger.error(f"Vision batch of {len(batch)} images failed: {str(e)}")
+            for _, future, *_ in batch:
+                future.set_exception(e)
+            return
+
+        VISION_BATCH_IMAGES.observe(len(batch))
+        # Quota errors can also come back per image inside a successful batch
+        backoff = 0
+        exhausted = any(image_response.error.code == code_pb2.RESOURCE_EXHAUSTED
+                        for image_response in response.responses)
+        if exhausted and self.governor:
+            backoff = self.governor.report_quota_error('vision')
+        for (_, future, *_), image_response in zip(batch, response.responses):
+            if image_response.error.code == code_pb2.RESOURCE_EXHAUSTED:
+                future.set_exception(Throttled(f"Vision quota exceeded: {image_response.error.message}",
+                                               delay=backoff))
+            elif image_response.error.message:
+                future.set_exception(RuntimeError(f"Vision API error: {image_response.error.message}"))
+            else:
+                future.set_result(image_response)
@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import hashlib
+import json
+import sqlite3
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def save_with_hash(stream, path, chunk_size=CHUNK_SIZE):
+    """Copy ``stream`` to ``path`` and return the SHA-256 hex digest of the bytes written."""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+class ContentHashCache:
+    """Persistent content hash -> (blob path, public URL, bibs, OCR record) cache with LRU eviction.
+
+    Stored in a local SQLite file so every gunicorn and worker process on the
+    host shares entries and hit/miss counters. ``bib_numbers`` is None until
+    the OCR for the first copy of a photo has finished; ``marathon_id`` is the
+    marathon whose registration list they were scored against, and ``ocr``
+    the OCR fields (text, annotation path) stored on that copy's image doc.
+    """
+
+    def __init__(self, path, max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS content_hashes (
+                    sha256 TEXT PRIMARY KEY,
+                    blob_path TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    bib_numbers TEXT,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            # Columns added after the first release; existing files gain them here
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(content_hashes)')}
+            for column in ('marathon_id', 'ocr'):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE content_hashes ADD COLUMN {column} TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_content_hashes_last_used ON content_hashes (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _count(self, conn, name):
+        conn.execute('INSERT INTO cache_counters (name, value) VALUES (?, 1) '
+                     'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+    def get(self, sha256, count=True):
+        """Return the cached entry as a dict, or None. Counts a hit or a miss unless ``count`` is False."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT blob_path, url, bib_numbers, marathon_id, ocr FROM content_hashes '
+                               'WHERE sha256 = ?', (sha256,)).fetchone()
+            if row is None:
+                if count:
+                    self._count(conn, 'misses')
+                return None
+            conn.execute('UPDATE content_hashes SET last_used = ? WHERE sha256 = ?', (time.time(), sha256))
+            if count:
+                self._count(conn, 'hits')
+        return {
+            'blob_path': row['blob_path'],
+            'url': row['url'],
+            'bib_numbers': json.loads(row['bib_numbers']) if row['bib_numbers'] is not None else None,
+            'marathon_id': row['marathon_id'],
+            'ocr': json.loads(row['ocr']) if row['ocr'] is not None else None,
+        }
+
+    def put(self, sha256, blob_path, url, bib_numbers=None, marathon_id=None, ocr=None):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO content_hashes '
+                '(sha256, blob_path, url, bib_numbers, marathon_id, ocr, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sha256, blob_path, url, json.dumps(bib_numbers) if bib_numbers is not None else None,
+                 marathon_id, json.dumps(ocr) if ocr else None, time.time()))
+            self._evict(conn)
+
+    def set_bib_numbers(self, sha256, bib_numbers, marathon_id=None, ocr=None):
+        """Record bibs scored for ``marathon_id``; the stored OCR record is kept unless ``ocr`` replaces it."""
+        with self._connect() as conn:
+            conn.execute('UPDATE content_hashes SET bib_numbers = ?, marathon_id = ?, ocr = COALESCE(?, ocr) '
+                         'WHERE sha256 = ?',
+                         (json.dumps(bib_numbers), marathon_id, json.dumps(ocr) if ocr else None, sha256))
+
+    def _evict(self, conn):
+        size = conn.execute('SELECT COUNT(*) FROM content_hashes').fetchone()[0]
+        if size > self.max_entries:
+            conn.execute('DELETE FROM content_hashes WHERE sha256 IN ('
+                         'SELECT sha256 FROM content_hashes ORDER BY last_used LIMIT ?)',
+                         (size - self.max_entries,))
+            conn.execute('INSERT INTO cache_counters (name, value) VALUES (?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                         ('evictions', size - self.max_entries))
+
+    def stats(self):
+        with self._connect() as conn:
+            counters = {row['name']: row['value']
+                        for row in conn.execute('SELECT name, value FROM cache_counters')}
+            size = conn.execute('SELECT COUNT(*) FROM content_hashes').fetchone()[0]
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {
+            'entries': size,
+            'max_entries': self.max_entries,
+            'hits': hits,
+            'misses': misses,
+            'evictions': counters.get('evictions', 0),
+            'hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+        }
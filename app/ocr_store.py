@@ -0,0 +1,249 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import numpy as np
+import os
+import posixpath
+
+from app.bib_scoring import select_bibs
+
+logger = logging.getLogger(__name__)
+
+# Compact OCR annotations are stored beside each photo as
+# ocr/<photo filename>.json.gz: the full text plus every word with its box
+# (x0, y0, x1, y1 in pixels of the EXIF-oriented original) and confidence
+ANNOTATION_PREFIX = 'ocr'
+ANNOTATION_VERSION = 1
+
+
+def annotation_path(blob_path):
+    return posixpath.join(ANNOTATION_PREFIX, posixpath.basename(blob_path) + '.json.gz')
+
+
+def _box(vertices, transform):
+    xs = [vertex.x for vertex in vertices] or [0]
+    ys = [vertex.y for vertex in vertices] or [0]
+    scale = transform['scale']
+    offset_x, offset_y = transform['offset']
+    return [round(offset_x + min(xs) * scale, 1), round(offset_y + min(ys) * scale, 1),
+            round(offset_x + max(xs) * scale, 1), round(offset_y + max(ys) * scale, 1)]
+
+
+def annotation_from_response(response, transform):
+    """Reduce a Vision text detection response to the compact annotation that is stored.
+
+    Word confidences only come with ``full_text_annotation``; words taken
+    from ``text_annotations`` alone get None. ``frame`` is the size of the
+    region Vision saw, in original pixels, when the response reports it.
+    """
+    texts = response.text_annotations
+    words, boxes, confidence = [], [], []
+    frame = None
+    pages = response.full_text_annotation.pages
+    if pages:
+        frame = [round(pages[0].width * transform['scale']), round(pages[0].height * transform['scale'])]
+        for page in pages:
+            for block in page.blocks:
+                for paragraph in block.paragraphs:
+                    for word in paragraph.words:
+                        words.append(''.join(symbol.text for symbol in word.symbols))
+                        boxes.append(_box(word.bounding_box.vertices, transform))
+                        confidence.append(round(word.confidence, 3))
+    else:
+        for word in texts[1:]:
+            words.append(word.description)
+            boxes.append(_box(word.bounding_poly.vertices, transform))
+            confidence.append(None)
+    return {
+        'version': ANNOTATION_VERSION,
+        'text': texts[0].description if texts else '',
+        'transform': transform,
+        'frame': frame,
+        'words': words,
+        'boxes': boxes,
+        'confidence': confidence,
+    }
+
+
+def save_annotation(bucket, blob_path, annotation):
+    """Upload ``annotation`` beside the photo at ``blob_path`` and return its path."""
+    path = annotation_path(blob_path)
+    data = gzip.compress(json.dumps(annotation, separators=(',', ':')).encode('utf-8'))
+    bucket.blob(path).upload_from_string(data, content_type='application/gzip')
+    return path
+
+
+def load_annotation(bucket, path):
+    return json.loads(gzip.decompress(bucket.blob(path).download_as_bytes()))
+
+
+def bibs_from_annotation(annotation, threshold, registered=None):
+    """Derive bibs from a stored annotation, keeping candidates that score at least ``threshold``."""
+    return OCRArchive.from_annotations([('', annotation)]).bibs(threshold, registered)[0]
+
+
+class OCRArchive:
+    """Columnar file with the OCR annotations of a whole marathon (a NumPy ``.npz``).
+
+    Words of every image live in flat arrays; image ``i`` owns the words in
+    ``offsets[i]:offsets[i + 1]``, so bulk passes over millions of photos
+    work on a few large arrays instead of millions of small blobs.
+    """
+
+    def __init__(self, image_ids, texts, transforms, frames, offsets, words, boxes, confidence):
+        self.image_ids = image_ids
+        self.texts = texts
+        self.transforms = transforms
+        self.frames = frames
+        self.offsets = offsets
+        self.words = words
+        self.boxes = boxes
+        self.confidence = confidence
+        self._positions = None
+
+    @classmethod
+    def from_annotations(cls, items):
+        """Build an archive from ``(image_id, annotation)`` pairs."""
+        image_ids, texts, transforms, frames, offsets = [], [], [], [], [0]
+        words, boxes, confidence = [], [], []
+        for image_id, annotation in items:
+            image_ids.append(image_id)
+            texts.append(annotation['text'])
+            transform = annotation['transform']
+            transforms.append([transform['scale'], *transform['offset']])
+            frames.append(annotation.get('frame') or [0, 0])
+            words.extend(annotation['words'])
+            boxes.extend(annotation['boxes'])
+            confidence.extend(math.nan if value is None else value for value in annotation['confidence'])
+            offsets.append(len(words))
+        return cls(
+            np.array(image_ids, dtype=str),
+            np.array(texts, dtype=str),
+            np.array(transforms, dtype=np.float64).reshape(-1, 3),
+            np.array(frames, dtype=np.int32).reshape(-1, 2),
+            np.array(offsets, dtype=np.int64),
+            np.array(words, dtype=str),
+            np.array(boxes, dtype=np.float32).reshape(-1, 4),
+            np.array(confidence, dtype=np.float32),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(*(data[name] for name in ('image_ids', 'texts', 'transforms', 'frames', 'offsets',
+                                                  'words', 'boxes', 'confidence')))
+
+    def save(self, path):
+        # Through a temporary file, so a killed export never leaves half an archive
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, image_ids=self.image_ids, texts=self.texts, transforms=self.transforms,
+                                frames=self.frames, offsets=self.offsets, words=self.words, boxes=self.boxes,
+                                confidence=self.confidence)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def annotation(self, i):
+        """The annotation of the ``i``-th image, in the form ``annotation_from_response`` returns."""
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        scale, offset_x, offset_y = self.transforms[i].tolist()
+        frame = self.frames[i].tolist()
+        return {
+            'version': ANNOTATION_VERSION,
+            'text': str(self.texts[i]),
+            'transform': {'scale': scale, 'offset': [offset_x, offset_y]},
+            'frame': frame if any(frame) else None,
+            'words': self.words[start:stop].tolist(),
+            'boxes': self.boxes[start:stop].tolist(),
+            'confidence': [None if math.isnan(value) else round(value, 3)
+                           for value in self.confidence[start:stop].tolist()],
+        }
+
+    def get(self, image_id):
+        if self._positions is None:
+            self._positions = {image_id: i for i, image_id in enumerate(self.image_ids.tolist())}
+        i = self._positions.get(image_id)
+        return self.annotation(i) if i is not None else None
+
+    def __iter__(self):
+        for i, image_id in enumerate(self.image_ids.tolist()):
+            yield image_id, self.annotation(i)
+
+    def bibs(self, threshold, registered=None, start=0, stop=None):
+        """Bibs of images ``start:stop``, all of their candidates scored in one vectorized pass."""
+        stop = len(self) if stop is None else stop
+        first, last = self.offsets[start], self.offsets[stop]
+        return select_bibs(self.texts[start:stop], self.words[first:last], self.boxes[first:last],
+                           self.offsets[start:stop + 1] - first, self.frames[start:stop], threshold, registered)
+
+
+_worker_archive = None
+_worker_scoring = None
+
+
+def _load_worker_archive(path, threshold, registered):
+    global _worker_archive, _worker_scoring
+    _worker_archive = OCRArchive.load(path)
+    _worker_scoring = (threshold, registered)
+
+
+def _extract_range(start, stop):
+    return list(zip(_worker_archive.image_ids[start:stop].tolist(),
+                    _worker_archive.bibs(*_worker_scoring, start=start, stop=stop)))
+
+
+def extract_archive(path, threshold, registered=None, processes=None, chunk_size=5000):
+    """Re-derive the bibs of every image in the archive at ``path``; returns ``{image_id: bibs}``.
+
+    Each worker process loads the archive once and scores index ranges of
+    it, so nothing but the results crosses process boundaries.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        total = len(data['image_ids'])
+    results = {}
+    if not total:
+        return results
+    starts = range(0, total, chunk_size)
+    stops = [min(start + chunk_size, total) for start in starts]
+    # Spawned, not forked: the parent holds gRPC channels and threads
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes or os.cpu_count() or 1, mp_context=context,
+                             initializer=_load_worker_archive, initargs=(path, threshold, registered)) as pool:
+        for chunk in pool.map(_extract_range, starts, stops):
+            results.update(chunk)
+    return results
+
+
+def export_marathon_archive(db, bucket, marathon_id, path, concurrency=32):
+    """Collect the stored annotations of a marathon's images into an ``OCRArchive`` at ``path``.
+
+    Returns the number of images archived and the number without a stored
+    annotation (OCR'd before annotations were kept; ``reprocess-ocr`` gives
+    them one).
+    """
+    query = db.collection('images').where('marathon_id', '==', marathon_id).select(['ocr_annotation'])
+    refs, missing = [], 0
+    for doc in query.stream():
+        annotation = (doc.to_dict() or {}).get('ocr_annotation')
+        if annotation:
+            refs.append((doc.id, annotation))
+        else:
+            missing += 1
+
+    def fetch(ref):
+        image_id, annotation = ref
+        try:
+            return image_id, load_annotation(bucket, annotation)
+        except Exception as e:
+            logger.error(f"Error loading OCR annotation {annotation}: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        archive = OCRArchive.from_annotations(item for item in executor.map(fetch, refs) if item)
+    archive.save(path)
+    return len(archive), missing + len(refs) - len(archive)
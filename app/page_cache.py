@@ -0,0 +1,285 @@
+from cachetools import TLRUCache
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_STORES = {}
+
+# Disk entries start with their expiry time (0.0 = never) as a big-endian double
+_EXPIRY = struct.Struct('>d')
+
+
+def cache_store(name):
+    def decorator(cls):
+        CACHE_STORES[name] = cls
+        return cls
+    return decorator
+
+
+class CacheStore:
+    """Byte-string key/value store with the subset of the Redis API the page cache uses.
+
+    ``get(key)`` returns bytes or None and ``set(key, value, ex=None)``
+    expires the entry after ``ex`` seconds, matching ``redis.Redis``.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ex=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def memory_usage(self):
+        """Bytes held by this store, or None if it cannot tell."""
+        return None
+
+
+@cache_store('memory')
+class MemoryStore(CacheStore):
+    """Per-process LRU bounded by the total size of the stored values."""
+
+    def __init__(self, max_bytes):
+        self._cache = TLRUCache(
+            maxsize=max_bytes,
+            ttu=lambda _key, entry, now: entry[1] if entry[1] else float('inf'),
+            timer=time.time,
+            getsizeof=lambda entry: len(entry[0]),
+        )
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['PAGE_CACHE_MAX_BYTES'])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, ex=None):
+        if len(value) > self._cache.maxsize:
+            return False
+        with self._lock:
+            self._cache[key] = (value, time.time() + ex if ex else 0)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def memory_usage(self):
+        with self._lock:
+            return self._cache.currsize
+
+
+@cache_store('disk')
+class DiskStore(CacheStore):
+    """Files under a local directory, shared by every process on the host.
+
+    Writes go through a temporary file and ``os.replace`` so readers never
+    see partial entries. When the directory grows past ``max_bytes`` the
+    least recently written entries are removed.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = self._scan_size()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['PAGE_CACHE_DIR'], config['PAGE_CACHE_MAX_BYTES'])
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(root, name)
+
+    def _scan_size(self):
+        size = 0
+        for path in self._entries():
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < _EXPIRY.size:
+            return None
+        expires, = _EXPIRY.unpack_from(data)
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return data[_EXPIRY.size:]
+
+    def set(self, key, value, ex=None):
+        if len(value) > self.max_bytes:
+            return False
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_EXPIRY.pack(time.time() + ex if ex else 0.0))
+            f.write(value)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += _EXPIRY.size + len(value)
+            if self._size > self.max_bytes:
+                self._evict()
+        return True
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _evict(self):
+        # Other processes write here too, so re-measure instead of trusting
+        # our running total, then trim the oldest entries to 90% of the limit
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * 0.9
+        for _, entry_size, path in sorted(entries):
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except OSError:
+                pass
+        self._size = size
+
+    def memory_usage(self):
+        # Disk bytes; entries live outside the process heap
+        return self._size
+
+
+@cache_store('redis')
+class RedisStore(CacheStore):
+    """Shared Redis (or compatible) server; needs the optional ``redis`` package."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_config(cls, config):
+        import redis
+        return cls(redis.Redis.from_url(config['PAGE_CACHE_REDIS_URL']))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ex=None):
+        return self.client.set(key, value, ex=ex)
+
+    def delete(self, key):
+        return bool(self.client.delete(key))
+
+    def memory_usage(self):
+        return self.client.info('memory').get('used_memory')
+
+
+class PageCache:
+    """Cache of rendered gallery results keyed by marathon, generation and request filters.
+
+    The generation is the marathon's gallery version, which changes whenever
+    one of its images is created, indexed or fails; it is part of the key,
+    so stale entries are never looked up again and simply age out.
+    """
+
+    def __init__(self, store, ttl=3600):
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(marathon_id, generation, *parts):
+        digest = hashlib.sha1('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+        return f'gallery:{marathon_id}:{generation}:{digest}'
+
+    def get(self, key):
+        try:
+            value = self.store.get(key)
+        except Exception as e:
+            logger.error(f"Page cache read failed: {str(e)}")
+            value = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, html):
+        try:
+            self.store.set(key, html.encode('utf-8'), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Page cache write failed: {str(e)}")
+            with self._lock:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'backend': type(self.store).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+        try:
+            stats['bytes'] = self.store.memory_usage()
+        except Exception as e:
+            logger.error(f"Error measuring page cache: {str(e)}")
+            stats['bytes'] = None
+        return stats
+
+
+def create_page_cache(config):
+    """Build the page cache configured by PAGE_CACHE_BACKEND, or None when it is 'none'."""
+    backend = config['PAGE_CACHE_BACKEND']
+    if backend == 'none':
+        return None
+    if backend not in CACHE_STORES:
+        raise ValueError(f"Unknown page cache backend: {backend}")
+    return PageCache(CACHE_STORES[backend].from_config(config), ttl=config['PAGE_CACHE_TTL'])
@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+
+def encode_page_token(upload_time, doc_id, page):
+    """Pack the last row of a page into an opaque, URL safe cursor token."""
+    payload = {
+        't': upload_time.isoformat() if upload_time else None,
+        'id': doc_id,
+        'p': page,
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_page_token(token):
+    """Return ``(cursor_values, page)`` for a token built by encode_page_token.
+
+    ``cursor_values`` lines up with an ``order_by('upload_time').order_by('__name__')``
+    query and can be passed straight to ``start_after``. Raises ValueError on a
+    malformed token.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(payload, dict):
+            raise ValueError('not an object')
+        upload_time = datetime.fromisoformat(payload['t']) if payload.get('t') else None
+        doc_id = payload['id']
+        page = int(payload.get('p', 1))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid page token: {e}') from e
+    if upload_time is None or not isinstance(doc_id, str):
+        raise ValueError('Invalid page token: missing cursor fields')
+    if page < 1:
+        raise ValueError(f'Invalid page token: page {page}')
+    return [upload_time, doc_id], page
+
+
+def sort_key(image):
+    """Ordering used when merging several cursor queries: newest first, then by doc id."""
+    upload_time = image.get('upload_time') or datetime.min.replace(tzinfo=timezone.utc)
+    return upload_time, image['id']
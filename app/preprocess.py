@@ -0,0 +1,76 @@
+from PIL import Image, ImageOps
+import io
+
+# EXIF Orientation; 1 means the pixels are already upright
+ORIENTATION_TAG = 0x0112
+
+
+class OCRInput:
+    """Reduced image bytes sent to Vision, plus how to map its pixels back.
+
+    A point ``(x, y)`` in the OCR image corresponds to
+    ``(offset_x + x * scale, offset_y + y * scale)`` in the EXIF-oriented
+    original.
+    """
+
+    def __init__(self, content, scale=1.0, offset=(0, 0)):
+        self.content = content
+        self.scale = scale
+        self.offset = offset
+
+    def to_original(self, x, y):
+        return self.offset[0] + x * self.scale, self.offset[1] + y * self.scale
+
+    def transform(self):
+        """Serializable form stored on the image doc."""
+        return {'scale': self.scale, 'offset': list(self.offset)}
+
+
+def parse_crop(value):
+    """Parse 'left,top,right,bottom' fractions of the frame (e.g. '0,0.2,1,1'); '' means no crop."""
+    if not value:
+        return None
+    left, top, right, bottom = (float(part) for part in value.split(','))
+    if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+        raise ValueError(f"Invalid OCR crop box: {value}")
+    return left, top, right, bottom
+
+
+def prepare_for_ocr(source, max_edge, crop=None, quality=85):
+    """Downscale (and optionally crop) image bytes for OCR.
+
+    JPEGs are decoded with ``draft()`` so the decoder skips most of the
+    full-resolution work, EXIF orientation is applied, and the result is
+    re-encoded as a JPEG whose long edge is at most ``max_edge``. Photos that
+    are already small enough, upright and need no crop are passed through
+    untouched; rotated ones are re-encoded upright so their OCR boxes are in
+    the same frame as every other photo's.
+    """
+    with Image.open(io.BytesIO(source)) as original:
+        upright = original.getexif().get(ORIENTATION_TAG, 1) == 1
+        if crop is None and upright and max(original.size) <= max_edge:
+            return OCRInput(source)
+
+        full_width = original.size[0]
+        original.draft('RGB', (max_edge, max_edge))
+        draft_scale = full_width / original.size[0]
+        image = ImageOps.exif_transpose(original).convert('RGB')
+        # exif_transpose may swap the axes; the draft factor applies to both
+        width, height = image.size
+
+    offset = (0, 0)
+    if crop:
+        left, top, right, bottom = crop
+        box = (round(left * width), round(top * height), round(right * width), round(bottom * height))
+        image = image.crop(box)
+        offset = (box[0] * draft_scale, box[1] * draft_scale)
+
+    resize_scale = 1.0
+    if max(image.size) > max_edge:
+        resize_scale = max(image.size) / max_edge
+        image = image.resize((max(1, round(image.size[0] / resize_scale)),
+                              max(1, round(image.size[1] / resize_scale))), Image.LANCZOS)
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality)
+    return OCRInput(out.getvalue(), scale=draft_scale * resize_scale, offset=offset)
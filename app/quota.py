@@ -0,0 +1,286 @@
+from contextlib import contextmanager
+from google.api_core import exceptions
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from app.jobs import RetryLater, backoff_delay
+from app.metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Blob methods that call the Cloud Storage API; everything else on a blob
+# (names, URLs, signing) is local
+GOVERNED_BLOB_METHODS = frozenset({
+    'create_resumable_upload_session', 'delete', 'download_as_bytes', 'download_to_filename', 'exists',
+    'make_public', 'patch', 'reload', 'upload_from_file', 'upload_from_filename', 'upload_from_string',
+})
+
+# Longest single sleep while waiting for a token, so waiters notice tokens
+# freed by other processes promptly
+MAX_POLL_INTERVAL = 0.25
+
+
+class Throttled(RetryLater):
+    """A Google API call could not be made within its quota; the work should be requeued, not dropped."""
+
+    def __init__(self, message, delay=0):
+        super().__init__(message, delay=delay)
+
+
+def is_quota_error(error):
+    # ResourceExhausted (gRPC) subclasses TooManyRequests (HTTP 429)
+    return isinstance(error, exceptions.TooManyRequests)
+
+
+class QuotaGovernor:
+    """Host-wide token buckets and in-flight caps for Google API calls.
+
+    Every gunicorn and worker process on the host shares one SQLite file:
+    ``acquire`` takes tokens from the named bucket (refilled at ``rate`` per
+    second up to ``burst``) and an in-flight slot (a lease row, so slots of
+    a killed process expire). A quota error pushes the bucket's
+    ``blocked_until`` out by an exponential, jittered delay that every
+    process honours. Limits are per host: set rates to the project quota
+    divided by the number of hosts.
+    """
+
+    def __init__(self, path, limits, max_wait=30, max_retries=4, backoff_base=1.0, backoff_max=60,
+                 lease_seconds=600):
+        self.path = path
+        self.limits = limits
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.throttled = 0
+        self.quota_errors = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS quota_buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS quota_leases (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_quota_leases_name ON quota_leases (name, expires)')
+
+    @classmethod
+    def from_config(cls, config):
+        limits = {
+            'vision': (config['VISION_RATE'], config['VISION_BURST'], config['VISION_MAX_IN_FLIGHT']),
+            'storage': (config['STORAGE_RATE'], config['STORAGE_BURST'], config['STORAGE_MAX_IN_FLIGHT']),
+        }
+        return cls(config['QUOTA_DB_PATH'], limits, max_wait=config['QUOTA_MAX_WAIT'],
+                   max_retries=config['QUOTA_MAX_RETRIES'], backoff_base=config['QUOTA_BACKOFF_BASE'],
+                   backoff_max=config['QUOTA_BACKOFF_MAX'])
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _try_acquire(self, name, cost):
+        """Take ``cost`` tokens and a slot: ``(None, lease)`` on success, else ``(seconds to wait, None)``."""
+        rate, burst, max_in_flight = self.limits[name]
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT tokens, updated, blocked_until FROM quota_buckets WHERE name = ?',
+                                   (name,)).fetchone()
+                tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated']) * rate)
+                blocked_until = row['blocked_until'] if row else 0
+                conn.execute('DELETE FROM quota_leases WHERE name = ? AND expires <= ?', (name, now))
+                in_flight = conn.execute('SELECT COUNT(*) FROM quota_leases WHERE name = ? AND expires > ?',
+                                         (name, now)).fetchone()[0]
+                if blocked_until > now:
+                    wait = blocked_until - now
+                elif max_in_flight and in_flight >= max_in_flight:
+                    wait = MAX_POLL_INTERVAL
+                elif rate and tokens < cost:
+                    wait = (cost - tokens) / rate
+                else:
+                    wait = None
+                    tokens -= cost if rate else 0
+                    lease = conn.execute('INSERT INTO quota_leases (name, expires) VALUES (?, ?)',
+                                         (name, now + self.lease_seconds)).lastrowid
+                conn.execute('''
+                    INSERT INTO quota_buckets (name, tokens, updated) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+                ''', (name, tokens, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return (None, lease) if wait is None else (wait, None)
+
+    def acquire(self, name, cost=1):
+        """Block until ``name`` has ``cost`` tokens and a free slot; returns a lease id for ``release``.
+
+        Raises Throttled after ``max_wait`` seconds.
+        """
+        # A cost above the burst size could never be met
+        cost = min(cost, self.limits[name][1]) if self.limits[name][0] else cost
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait, lease = self._try_acquire(name, cost)
+            if wait is None:
+                return lease
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    self.throttled += 1
+                raise Throttled(f"{name} quota exhausted", delay=wait)
+            time.sleep(min(wait, remaining, MAX_POLL_INTERVAL) * random.uniform(0.8, 1.2))
+
+    def release(self, lease):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM quota_leases WHERE id = ?', (lease,))
+
+    def _record_result(self, name, quota_error):
+        """Reset the bucket's failure streak, or block it for a backoff delay after a quota error."""
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT failures FROM quota_buckets WHERE name = ?', (name,)).fetchone()
+                failures = (row['failures'] if row else 0) + 1 if quota_error else 0
+                blocked_until = (time.time() + backoff_delay(failures, self.backoff_base, self.backoff_max)
+                                 if quota_error else 0)
+                conn.execute('''
+                    INSERT INTO quota_buckets (name, tokens, updated, blocked_until, failures) VALUES (?, 0, ?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET failures = excluded.failures,
+                        blocked_until = MAX(blocked_until, excluded.blocked_until)
+                ''', (name, time.time(), blocked_until, failures))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return blocked_until
+
+    def report_quota_error(self, name):
+        """Back the whole host off ``name`` after a quota error; returns the backoff in seconds."""
+        with self._lock:
+            self.quota_errors += 1
+        return max(0, self._record_result(name, True) - time.time())
+
+    @contextmanager
+    def slot(self, name, cost=1):
+        with span(f'quota.{name}'):
+            lease = self.acquire(name, cost)
+        try:
+            yield
+        finally:
+            self.release(lease)
+
+    def call(self, name, func, args=(), kwargs=None, cost=1, retry=True):
+        """Call ``func(*args, **kwargs)`` within ``name``'s quota.
+
+        Quota errors (RESOURCE_EXHAUSTED / HTTP 429) back the whole host
+        off and, with ``retry``, the call is made again up to
+        ``max_retries`` times; then Throttled is raised so the caller
+        requeues the work. Calls that are not safe to repeat (uploads from a
+        stream) pass ``retry=False``.
+        """
+        kwargs = kwargs or {}
+        if name not in self.limits:
+            return func(*args, **kwargs)
+        attempts = 0
+        while True:
+            attempts += 1
+            with self.slot(name, cost):
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    if not is_quota_error(e):
+                        raise
+                    backoff = self.report_quota_error(name)
+                    logger.warning(f"{name} quota exceeded, backing off for {backoff:.1f}s: {str(e)}")
+                    if not retry or attempts > self.max_retries:
+                        with self._lock:
+                            self.throttled += 1
+                        raise Throttled(f"{name} quota exceeded: {str(e)}", delay=backoff) from e
+                    continue
+            if attempts > 1:
+                self._record_result(name, False)
+            return result
+
+    def stats(self):
+        now = time.time()
+        with self._connect() as conn:
+            buckets = {row['name']: dict(row) for row in conn.execute('SELECT * FROM quota_buckets')}
+            in_flight = dict(conn.execute('SELECT name, COUNT(*) FROM quota_leases WHERE expires > ? GROUP BY name',
+                                          (now,)).fetchall())
+        with self._lock:
+            stats = {'throttled': self.throttled, 'quota_errors': self.quota_errors, 'pid': os.getpid()}
+        for name, (rate, burst, max_in_flight) in self.limits.items():
+            bucket = buckets.get(name, {})
+            stats[name] = {
+                'rate': rate,
+                'tokens': min(burst, bucket.get('tokens', burst) + (now - bucket.get('updated', now)) * rate),
+                'in_flight': in_flight.get(name, 0),
+                'max_in_flight': max_in_flight,
+                'blocked_for': max(0.0, bucket.get('blocked_until', 0) - now),
+            }
+        return stats
+
+
+class GovernedBlob:
+    """Blob proxy whose Cloud Storage API calls go through the quota governor and are timed as spans."""
+
+    def __init__(self, blob, governor):
+        object.__setattr__(self, '_blob', blob)
+        object.__setattr__(self, '_governor', governor)
+
+    def __getattr__(self, name):
+        attr = getattr(self._blob, name)
+        if name not in GOVERNED_BLOB_METHODS:
+            return attr
+
+        def governed(*args, **kwargs):
+            # A stream that has been read cannot be replayed
+            retry = name != 'upload_from_file'
+            with span(f'storage.{name}'):
+                return self._governor.call('storage', attr, args, kwargs, retry=retry)
+        return governed
+
+    def __setattr__(self, name, value):
+        setattr(self._blob, name, value)
+
+
+class GovernedBucket:
+    """Bucket proxy handing out GovernedBlobs."""
+
+    def __init__(self, bucket, governor):
+        self._bucket = bucket
+        self._governor = governor
+
+    def blob(self, *args, **kwargs):
+        return GovernedBlob(self._bucket.blob(*args, **kwargs), self._governor)
+
+    def get_blob(self, *args, **kwargs):
+        with span('storage.get_blob'):
+            blob = self._governor.call('storage', self._bucket.get_blob, args, kwargs)
+        return GovernedBlob(blob, self._governor) if blob is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from firebase_admin import firestore
+import logging
+import posixpath
+import threading
+import time
+
+from app.bibs import extract_bibs
+from app.ingest import STATUS_INDEXED, detect_bibs, registered_bibs
+from app.marathon_stats import index_image
+from app.ocr_store import bibs_from_annotation, extract_archive, load_annotation
+
+logger = logging.getLogger(__name__)
+
+REPROCESS_FIELDS = ['filename', 'bib_numbers', 'ocr_text', 'ocr_annotation', 'content_hash']
+
+
+class OCRReprocessor:
+    """Re-run bib detection over every image of a marathon.
+
+    Image docs are read a page at a time with a ``__name__`` cursor. With
+    ``reuse_text`` bibs are re-extracted locally from the stored OCR output:
+    the image's entry in the ``archive`` built by ``export-ocr`` (all of
+    them extracted up front in a process pool), else its stored annotation,
+    else its OCR text. Vision is only called for images that have none;
+    otherwise every image is downloaded and OCR'd again, ``concurrency`` at
+    a time (the shared BatchingOCR groups those calls into Vision batches).
+    Each changed doc is written through ``index_image``, the stats
+    transaction ingest uses, so the marathon's counters and gallery version
+    stay right while uploads continue; unchanged docs are not written.
+    """
+
+    def __init__(self, app, marathon_id, reuse_text=False, concurrency=16, page_size=300, dry_run=False,
+                 archive=None, echo=print):
+        self.app = app
+        self.marathon_id = marathon_id
+        self.reuse_text = reuse_text
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.echo = echo
+        self.archive = archive
+        self.archived = {}
+        self.registered = None
+        self.counts = {'images': 0, 'changed': 0, 'ocr_calls': 0, 'reextracted': 0, 'failed': 0}
+        self._counts_lock = threading.Lock()
+
+    def _count(self, name, value=1):
+        with self._counts_lock:
+            self.counts[name] += value
+
+    def run(self):
+        db = self.app.config['db']
+        query = (db.collection('images').where('marathon_id', '==', self.marathon_id)
+                 .select(REPROCESS_FIELDS).order_by('__name__').limit(self.page_size))
+        started = time.monotonic()
+        with self.app.app_context():
+            self.registered = registered_bibs(self.marathon_id)
+        if self.reuse_text and self.archive:
+            self.archived = extract_archive(self.archive, self.app.config['BIB_SCORE_THRESHOLD'], self.registered)
+            self.echo(f"Re-extracted {len(self.archived)} archived images in {time.monotonic() - started:.0f}s")
+        last = None
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while True:
+                docs = list((query.start_after(last) if last else query).stream())
+                if not docs:
+                    break
+                last = docs[-1]
+                changed = sum(executor.map(self._process, docs))
+                self._count('images', len(docs))
+                self._count('changed', changed)
+                self._report(started)
+        return self.counts
+
+    def _process(self, doc):
+        """Re-detect the image's bibs and write them back if they or its OCR changed; returns whether they did."""
+        data = doc.to_dict()
+        try:
+            with self.app.app_context():
+                ocr = None
+                if self.reuse_text and doc.id in self.archived:
+                    bib_numbers = self.archived[doc.id]
+                    self._count('reextracted')
+                elif self.reuse_text and data.get('ocr_annotation'):
+                    annotation = load_annotation(self.app.config['storage'], data['ocr_annotation'])
+                    bib_numbers = bibs_from_annotation(annotation, self.app.config['BIB_SCORE_THRESHOLD'],
+                                                       self.registered)
+                    self._count('reextracted')
+                elif self.reuse_text and data.get('ocr_text') is not None:
+                    bib_numbers = extract_bibs(data['ocr_text'])
+                    self._count('reextracted')
+                else:
+                    blob = self.app.config['storage'].blob(posixpath.join('images', data['filename']))
+                    bib_numbers, ocr = detect_bibs(blob.download_as_bytes(), blob.name, self.marathon_id)
+                    self._count('ocr_calls')
+
+                if data.get('content_hash') and not self.dry_run:
+                    self.app.config['ocr_cache'].set_bib_numbers(data['content_hash'], bib_numbers,
+                                                                  self.marathon_id, ocr)
+        except Exception as e:
+            logger.error(f"Error reprocessing image {doc.id}: {str(e)}")
+            self._count('failed')
+            return False
+
+        if ocr is None and bib_numbers == data.get('bib_numbers'):
+            return False
+        update = {
+            'bib_numbers': bib_numbers,
+            'detected_numbers': ','.join(bib_numbers),
+            'status': STATUS_INDEXED,
+            'indexed_at': firestore.SERVER_TIMESTAMP,
+        }
+        if ocr:
+            update.update(ocr)
+        if not self.dry_run:
+            try:
+                index_image(self.app.config['db'], doc.reference, self.marathon_id, update, bib_numbers,
+                            self.app.config['MARATHON_STATS_SHARDS'])
+            except Exception as e:
+                logger.error(f"Error writing reprocessed image {doc.id}: {str(e)}")
+                self._count('failed')
+                return False
+        return True
+
+    def _report(self, started):
+        with self._counts_lock:
+            counts = dict(self.counts)
+        elapsed = time.monotonic() - started
+        self.echo(f"{counts['images']} images, {counts['changed']} changed, {counts['ocr_calls']} OCR calls, "
+                  f"{counts['reextracted']} re-extracted, {counts['failed']} failed "
+                  f"in {elapsed:.0f}s ({counts['images'] / elapsed if elapsed else 0:.1f} images/s)")
@@ -0,0 +1,151 @@
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone
+from google.api_core import exceptions
+from itsdangerous import URLSafeSerializer, BadSignature
+import logging
+import re
+import requests
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# GCS requires every chunk but the last to be a multiple of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
+
+# chunked_uploads/<upload_id> holds the session URL: whoever has it can write
+# the object, so it never goes into the (signed, not encrypted) upload token.
+# GCS sessions last a week; a Firestore TTL policy on expires_at removes
+# abandoned ones.
+UPLOADS_COLLECTION = 'chunked_uploads'
+SESSION_LIFETIME = timedelta(days=7)
+
+_session_urls = TTLCache(maxsize=4096, ttl=3600)
+_session_urls_lock = threading.Lock()
+
+_RANGE_RE = re.compile(r'bytes=0-(\d+)')
+
+
+class ResumableUploadError(Exception):
+    pass
+
+
+class _SizedStream:
+    """File-like wrapper with a known length, so requests sends Content-Length instead of chunked encoding."""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+def _serializer(secret_key):
+    return URLSafeSerializer(secret_key, salt='chunked-upload')
+
+
+def encode_upload_token(secret_key, upload_id, object_name, size, content_type, user_id):
+    """Sign the upload state into the token the browser sends back with every chunk.
+
+    Keeping the state in the token (and the session URL in Firestore) means
+    any app process can serve any chunk.
+    """
+    return _serializer(secret_key).dumps({
+        'upload_id': upload_id,
+        'object_name': object_name,
+        'size': size,
+        'content_type': content_type,
+        'user_id': user_id,
+    })
+
+
+def decode_upload_token(secret_key, token):
+    try:
+        return _serializer(secret_key).loads(token)
+    except BadSignature as e:
+        raise ResumableUploadError('Invalid upload token') from e
+
+
+def start_session(blob, content_type, size, origin=None):
+    """Open a GCS resumable upload session for ``blob`` and return its URL."""
+    return blob.create_resumable_upload_session(content_type=content_type, size=size, origin=origin)
+
+
+def save_session_url(db, session_url, user_id):
+    """Keep ``session_url`` server-side and return the opaque id the upload token carries."""
+    upload_id = uuid.uuid4().hex
+    db.collection(UPLOADS_COLLECTION).document(upload_id).set({
+        'session_url': session_url,
+        'user_id': user_id,
+        'expires_at': datetime.now(timezone.utc) + SESSION_LIFETIME,
+    })
+    with _session_urls_lock:
+        _session_urls[upload_id] = session_url
+    return upload_id
+
+
+def load_session_url(db, upload_id):
+    """The session URL saved under ``upload_id`` (cached per process)."""
+    with _session_urls_lock:
+        if upload_id in _session_urls:
+            return _session_urls[upload_id]
+    doc = db.collection(UPLOADS_COLLECTION).document(upload_id).get(field_paths=['session_url'])
+    if not doc.exists:
+        raise ResumableUploadError('Upload session not found')
+    session_url = doc.to_dict()['session_url']
+    with _session_urls_lock:
+        _session_urls[upload_id] = session_url
+    return session_url
+
+
+def delete_session_url(db, upload_id):
+    with _session_urls_lock:
+        _session_urls.pop(upload_id, None)
+    db.collection(UPLOADS_COLLECTION).document(upload_id).delete()
+
+
+def _committed_offset(response, size):
+    if response.status_code == 429:
+        # Raised as the API client would, so the quota governor backs off
+        raise exceptions.TooManyRequests(f'Storage rate limit: {response.text[:200]}')
+    if response.status_code in (200, 201):
+        return size
+    if response.status_code == 308:
+        match = _RANGE_RE.match(response.headers.get('Range', ''))
+        return int(match.group(1)) + 1 if match else 0
+    raise ResumableUploadError(f'Storage responded with {response.status_code}: {response.text[:200]}')
+
+
+def query_offset(session_url, size, timeout=30):
+    """Ask GCS how many bytes of the session have been persisted."""
+    response = requests.put(session_url, headers={'Content-Range': f'bytes */{size}'}, timeout=timeout)
+    return _committed_offset(response, size)
+
+
+def put_chunk(session_url, stream, offset, length, size, timeout=120):
+    """Stream ``length`` bytes from ``stream`` into the session at ``offset``.
+
+    Returns the committed offset reported by GCS, which equals ``size`` once
+    the object is complete.
+    """
+    if length <= 0:
+        raise ResumableUploadError('Empty chunk')
+    last = offset + length == size
+    if not last and length % CHUNK_GRANULARITY:
+        raise ResumableUploadError(f'Chunks must be a multiple of {CHUNK_GRANULARITY} bytes')
+    if offset + length > size:
+        raise ResumableUploadError('Chunk runs past the end of the file')
+
+    response = requests.put(
+        session_url,
+        data=_SizedStream(stream, length),
+        headers={
+            'Content-Range': f'bytes {offset}-{offset + length - 1}/{size}',
+        },
+        timeout=timeout,
+    )
+    return _committed_offset(response, size)
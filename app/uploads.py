@@ -0,0 +1,31 @@
+from datetime import timedelta
+import uuid
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+# Custom metadata header the browser must send with a signed PUT; the
+# finalize step checks it so users can only claim objects signed for them.
+UPLOADER_METADATA_KEY = 'uploader'
+UPLOADER_HEADER = f'x-goog-meta-{UPLOADER_METADATA_KEY}'
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def new_object_name(filename):
+    """Server-chosen blob path for an upload, keeping only the original extension."""
+    return f"images/{uuid.uuid4()}.{filename.rsplit('.', 1)[1].lower()}"
+
+
+def signed_upload(bucket, object_name, content_type, user_id, expires_in):
+    """Return the V4 signed PUT URL plus the headers the browser has to send with it."""
+    headers = {'Content-Type': content_type, UPLOADER_HEADER: user_id}
+    url = bucket.blob(object_name).generate_signed_url(
+        version='v4',
+        expiration=timedelta(seconds=expires_in),
+        method='PUT',
+        content_type=content_type,
+        headers={UPLOADER_HEADER: user_id},
+    )
+    return {'object_name': object_name, 'upload_url': url, 'headers': headers}
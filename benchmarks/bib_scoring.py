@@ -0,0 +1,99 @@
+"""Measure bib-candidate scoring against plain regex extraction on labelled photos.
+
+Reports, per threshold, the numbers indexed per photo, precision and recall
+against the labels, and scoring throughput for the whole sample set in one
+vectorized batch versus one photo at a time. The sample directory holds the
+photos plus a ``labels.csv`` with ``filename,bibs`` rows, bibs separated by
+spaces. Each photo is OCR'd once and its annotation cached beside it as
+``<photo>.ocr.json.gz``, so later runs need no Vision calls.
+
+Usage (from the repository root, with Google credentials configured):
+
+    python -m benchmarks.bib_scoring samples/ --thresholds 0.4,0.5,0.6 --registered bibs.txt
+"""
+from google.cloud import vision
+import argparse
+import gzip
+import json
+import os
+import time
+
+from app.bibs import unique_bibs
+from app.ocr_store import OCRArchive, annotation_from_response
+from app.preprocess import prepare_for_ocr
+from benchmarks.ocr_downscale import load_samples
+
+
+def load_annotations(directory, samples, client, max_edge):
+    annotations = []
+    for filename, source, labels in samples:
+        cache_path = os.path.join(directory, filename + '.ocr.json.gz')
+        if os.path.exists(cache_path):
+            with gzip.open(cache_path, 'rt') as f:
+                annotation = json.load(f)
+        else:
+            ocr_input = prepare_for_ocr(source, max_edge)
+            response = client.text_detection(image=vision.Image(content=ocr_input.content))
+            annotation = annotation_from_response(response, ocr_input.transform())
+            with gzip.open(cache_path, 'wt') as f:
+                json.dump(annotation, f)
+        annotations.append((filename, annotation, labels))
+    return annotations
+
+
+def evaluate(archive, labels, threshold, registered):
+    started = time.perf_counter()
+    selected = archive.bibs(threshold, registered)
+    batch_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(len(archive)):
+        archive.bibs(threshold, registered, start=i, stop=i + 1)
+    single_seconds = time.perf_counter() - started
+
+    indexed = correct = expected = 0
+    for bibs, expected_bibs in zip(selected, labels):
+        indexed += len(bibs)
+        correct += len(expected_bibs & set(bibs))
+        expected += len(expected_bibs)
+    return {
+        'per_photo': indexed / len(labels),
+        'precision': correct / indexed if indexed else 0.0,
+        'recall': correct / expected if expected else 0.0,
+        'batch_rate': len(labels) / batch_seconds if batch_seconds else 0.0,
+        'single_rate': len(labels) / single_seconds if single_seconds else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('samples', help='Directory with photos and labels.csv')
+    parser.add_argument('--thresholds', default='0.3,0.4,0.5,0.6,0.7')
+    parser.add_argument('--registered', help='File with the registered bibs, whitespace or comma separated')
+    parser.add_argument('--max-edge', type=int, default=1600, help='OCR_MAX_EDGE used for uncached photos')
+    args = parser.parse_args()
+
+    samples = list(load_samples(args.samples))
+    cached = all(os.path.exists(os.path.join(args.samples, name + '.ocr.json.gz')) for name, _, _ in samples)
+    client = None if cached else vision.ImageAnnotatorClient()
+    annotations = load_annotations(args.samples, samples, client, args.max_edge)
+    archive = OCRArchive.from_annotations((filename, annotation) for filename, annotation, _ in annotations)
+    labels = [labels for _, _, labels in annotations]
+
+    registered = None
+    if args.registered:
+        with open(args.registered) as f:
+            registered = frozenset(unique_bibs(f.read().replace(',', ' ').split()))
+
+    print(f"{len(samples)} photos, {sum(len(photo_labels) for photo_labels in labels)} labelled bibs, "
+          f"{len(archive.words)} OCR words")
+    print(f"{'threshold':>10} {'per photo':>9} {'precision':>9} {'recall':>7} {'batch/s':>9} {'single/s':>9}")
+    variants = [('regex', 0.0)] + [(threshold, float(threshold)) for threshold in args.thresholds.split(',')]
+    for name, threshold in variants:
+        result = evaluate(archive, labels, threshold, registered)
+        print(f"{name:>10} {result['per_photo']:>9.2f} {result['precision']:>9.1%} {result['recall']:>7.1%} "
+              f"{result['batch_rate']:>9.0f} {result['single_rate']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compare OCR throughput and latency across batch sizes using the fake Vision client.
+
+Usage (from the repository root):
+
+    python -m benchmarks.ocr_batch --images 2000 --batch-sizes 1,4,8,16
+"""
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import vision
+import argparse
+import statistics
+import time
+
+from app.fakes import FakeVisionClient
+from app.ocr import BatchingOCR
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(batch_size, args):
+    client = FakeVisionClient(call_latency=args.call_latency, per_image_latency=args.per_image_latency)
+    ocr = BatchingOCR(client, batch_size=batch_size, max_wait=args.max_wait, max_in_flight=args.max_in_flight)
+    latencies = []
+
+    def detect(i):
+        image = vision.Image()
+        image.source.image_uri = f'gs://bench/images/{i}.jpg'
+        started = time.perf_counter()
+        ocr.detect_text(image)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(detect, range(args.images)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'batch_size': batch_size,
+        'calls': client.calls,
+        'seconds': elapsed,
+        'images_per_s': args.images / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--batch-sizes', default='1,4,8,16')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent callers (worker threads)')
+    parser.add_argument('--max-wait', type=float, default=0.2)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    parser.add_argument('--call-latency', type=float, default=0.15, help='Fake per-call round trip (s)')
+    parser.add_argument('--per-image-latency', type=float, default=0.02, help='Fake per-image cost (s)')
+    args = parser.parse_args()
+
+    print(f"{'batch':>5} {'calls':>6} {'secs':>7} {'img/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        result = run(batch_size, args)
+        print(f"{result['batch_size']:>5} {result['calls']:>6} {result['seconds']:>7.2f} "
+              f"{result['images_per_s']:>8.1f} {result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compare Vision OCR on full-size photos against downscaled/cropped copies.
+
+Reports bytes sent, preprocessing and OCR latency, and bib recall against a
+labelled local sample set. The sample directory holds the photos plus a
+``labels.csv`` with ``filename,bibs`` rows, bibs separated by spaces.
+
+Usage (from the repository root, with Google credentials configured):
+
+    python -m benchmarks.ocr_downscale samples/ --max-edges 1024,1600,2048 --crop 0,0.2,1,1
+"""
+from google.cloud import vision
+import argparse
+import csv
+import os
+import statistics
+import time
+
+from app.bibs import normalize_bib
+from app.fakes import FakeVisionClient
+from app.ingest import bibs_from_response
+from app.preprocess import OCRInput, parse_crop, prepare_for_ocr
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def load_samples(directory):
+    with open(os.path.join(directory, 'labels.csv'), newline='') as labels:
+        for row in csv.reader(labels):
+            if not row or row[0] == 'filename':
+                continue
+            with open(os.path.join(directory, row[0]), 'rb') as photo:
+                yield row[0], photo.read(), {normalize_bib(bib) for bib in row[1].split()}
+
+
+def run(client, samples, max_edge, crop, quality):
+    sent, prep_times, ocr_times = [], [], []
+    expected = found = 0
+    for _, source, labels in samples:
+        started = time.perf_counter()
+        ocr_input = OCRInput(source) if max_edge is None else prepare_for_ocr(source, max_edge, crop, quality)
+        prep_times.append(time.perf_counter() - started)
+        sent.append(len(ocr_input.content))
+
+        started = time.perf_counter()
+        response = client.text_detection(image=vision.Image(content=ocr_input.content))
+        ocr_times.append(time.perf_counter() - started)
+
+        expected += len(labels)
+        found += len(labels & set(bibs_from_response(response)))
+
+    return {
+        'kb_sent': statistics.mean(sent) / 1024,
+        'prep_ms': statistics.mean(prep_times) * 1000,
+        'p50_ms': statistics.median(ocr_times) * 1000,
+        'p95_ms': percentile(ocr_times, 95) * 1000,
+        'recall': found / expected if expected else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('samples', help='Directory with photos and labels.csv')
+    parser.add_argument('--max-edges', default='1024,1600,2048')
+    parser.add_argument('--crop', default='', help="Optional 'left,top,right,bottom' fractions")
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--fake', action='store_true',
+                        help='Use the fake Vision client (sizes and timings only; recall is meaningless)')
+    args = parser.parse_args()
+
+    samples = list(load_samples(args.samples))
+    client = FakeVisionClient() if args.fake else vision.ImageAnnotatorClient()
+    crop = parse_crop(args.crop)
+
+    print(f"{len(samples)} photos, {sum(len(labels) for _, _, labels in samples)} labelled bibs")
+    print(f"{'variant':>10} {'KB sent':>8} {'prep ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+    variants = [('full', None)] + [(str(int(edge)), int(edge)) for edge in args.max_edges.split(',')]
+    for name, max_edge in variants:
+        result = run(client, samples, max_edge, crop, args.quality)
+        print(f"{name:>10} {result['kb_sent']:>8.0f} {result['prep_ms']:>8.1f} "
+              f"{result['p50_ms']:>8.0f} {result['p95_ms']:>8.0f} {result['recall']:>7.1%}")
+
+
+if __name__ == '__main__':
+    main()
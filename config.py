@@ -18,4 +18,135 @@ class Config:
         'databaseURL': 'https://foteam-py-default-rtdb.firebaseio.com'
     }
     
-    FIREBASE_ADMIN_CREDENTIALS = os.environ.get('FIREBASE_ADMIN_CREDENTIALS')
\ No newline at end of file
+    FIREBASE_ADMIN_CREDENTIALS = os.environ.get('FIREBASE_ADMIN_CREDENTIALS')
+
+    # Firestore accepts at most 10 (legacy) / 30 values per array_contains_any filter
+    BIB_QUERY_CHUNK_SIZE = int(os.environ.get('BIB_QUERY_CHUNK_SIZE', 10))
+    GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE', 24))
+
+    # In-memory per-marathon bib index behind the gallery's fuzzy search:
+    # how often (s) it picks up newly indexed photos and how many marathons
+    # each process keeps loaded
+    BIB_INDEX_REFRESH = int(os.environ.get('BIB_INDEX_REFRESH', 30))
+    BIB_INDEX_MAX_MARATHONS = int(os.environ.get('BIB_INDEX_MAX_MARATHONS', 64))
+    # Most suggestions the bib typeahead returns per request
+    BIB_SUGGEST_MAX = int(os.environ.get('BIB_SUGGEST_MAX', 20))
+    # Browser cache lifetime (s) of JSON gallery pages; after that they are
+    # revalidated with their ETag
+    GALLERY_CACHE_MAX_AGE = int(os.environ.get('GALLERY_CACHE_MAX_AGE', 30))
+
+    # Cache of rendered gallery results: 'memory' (per process), 'disk'
+    # (shared by the processes on a host), 'redis' or 'none'. MAX_BYTES
+    # bounds the memory or disk store.
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 3600))
+    PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join(basedir, 'page_cache'))
+    PAGE_CACHE_REDIS_URL = os.environ.get('PAGE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Counter shards per marathon stats doc; each sustains about one write per
+    # second, so size this to the expected ingest rate per marathon
+    MARATHON_STATS_SHARDS = int(os.environ.get('MARATHON_STATS_SHARDS', 10))
+
+    # Background job queue
+    JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'sqlite')
+    JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', os.path.join(basedir, 'jobs.sqlite3'))
+    # The SQL app (app.py) has its own queue: the package worker has no
+    # handler for its jobs and would fail them
+    SQL_JOB_QUEUE_PATH = os.environ.get('SQL_JOB_QUEUE_PATH', os.path.join(basedir, 'sql-jobs.sqlite3'))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_BASE_DELAY = float(os.environ.get('JOB_RETRY_BASE_DELAY', 2))
+    JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', 300))
+    JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+    # Keep this at least OCR_BATCH_SIZE so the worker can fill a Vision batch
+    WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 16))
+
+    # Vision OCR batching (batch_annotate_images takes at most 16 images)
+    OCR_BATCH_SIZE = int(os.environ.get('OCR_BATCH_SIZE', 16))
+    OCR_BATCH_MAX_WAIT = float(os.environ.get('OCR_BATCH_MAX_WAIT', 0.2))
+    OCR_MAX_IN_FLIGHT = int(os.environ.get('OCR_MAX_IN_FLIGHT', 4))
+
+    # Photos are downscaled to this long edge (px) before OCR; bib digits stay
+    # legible well below camera resolution. OCR_CROP optionally limits OCR to
+    # a 'left,top,right,bottom' fraction of the frame, e.g. '0,0.25,1,1'.
+    OCR_MAX_EDGE = int(os.environ.get('OCR_MAX_EDGE', 1600))
+    OCR_CROP = os.environ.get('OCR_CROP', '')
+    OCR_JPEG_QUALITY = int(os.environ.get('OCR_JPEG_QUALITY', 85))
+    # Numbers in a photo are scored on their word boxes (size, shape, digit
+    # count, registration list, neighbouring text) and only those scoring at
+    # least this much are indexed; 0 indexes every number in the OCR text
+    BIB_SCORE_THRESHOLD = float(os.environ.get('BIB_SCORE_THRESHOLD', 0.5))
+
+    # Host-wide quota governor for Google API calls, coordinated by all local
+    # processes through a SQLite file. Rates are per second (Vision counts
+    # images) and apply per host, so divide project quotas by the host count;
+    # a rate of 0 removes the limit. Calls that cannot get quota within
+    # QUOTA_MAX_WAIT seconds, or keep hitting RESOURCE_EXHAUSTED after
+    # QUOTA_MAX_RETRIES backoffs, are requeued rather than dropped.
+    QUOTA_DB_PATH = os.environ.get('QUOTA_DB_PATH', os.path.join(basedir, 'quota.sqlite3'))
+    VISION_RATE = float(os.environ.get('VISION_RATE', 25))
+    VISION_BURST = int(os.environ.get('VISION_BURST', 32))
+    VISION_MAX_IN_FLIGHT = int(os.environ.get('VISION_MAX_IN_FLIGHT', 8))
+    STORAGE_RATE = float(os.environ.get('STORAGE_RATE', 200))
+    STORAGE_BURST = int(os.environ.get('STORAGE_BURST', 400))
+    STORAGE_MAX_IN_FLIGHT = int(os.environ.get('STORAGE_MAX_IN_FLIGHT', 64))
+    QUOTA_MAX_WAIT = float(os.environ.get('QUOTA_MAX_WAIT', 30))
+    QUOTA_MAX_RETRIES = int(os.environ.get('QUOTA_MAX_RETRIES', 4))
+    QUOTA_BACKOFF_BASE = float(os.environ.get('QUOTA_BACKOFF_BASE', 1))
+    QUOTA_BACKOFF_MAX = float(os.environ.get('QUOTA_BACKOFF_MAX', 60))
+
+    # Google clients are created per process; the Vision channel pings idle
+    # connections so load balancers do not drop them, and the Storage HTTP
+    # pool keeps this many connections for concurrent uploads. With
+    # CLIENT_WARMUP, gunicorn workers and `flask worker` connect at startup.
+    GRPC_KEEPALIVE_MS = int(os.environ.get('GRPC_KEEPALIVE_MS', 30000))
+    GRPC_KEEPALIVE_TIMEOUT_MS = int(os.environ.get('GRPC_KEEPALIVE_TIMEOUT_MS', 10000))
+    STORAGE_POOL_SIZE = int(os.environ.get('STORAGE_POOL_SIZE', 32))
+    CLIENT_WARMUP = os.environ.get('CLIENT_WARMUP', 'true').lower() == 'true'
+
+    # Request, template and external-call timings, exposed to Prometheus at
+    # METRICS_PATH ('' disables it) and to browser devtools as a Server-Timing
+    # header. gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a directory
+    # the workers share; give `flask worker` the same variable to include its
+    # Vision and Storage calls.
+    METRICS_PATH = os.environ.get('METRICS_PATH', '/metrics')
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+
+    # Content-hash cache of stored blobs and OCR results for duplicate uploads
+    OCR_CACHE_PATH = os.environ.get('OCR_CACHE_PATH', os.path.join(basedir, 'ocr_cache.sqlite3'))
+    OCR_CACHE_MAX_ENTRIES = int(os.environ.get('OCR_CACHE_MAX_ENTRIES', 200000))
+
+    # Thumbnail / preview widths (px) generated for every ingested photo
+    DERIVATIVE_WIDTHS = [int(w) for w in os.environ.get('DERIVATIVE_WIDTHS', '320,1024').split(',')]
+    DERIVATIVE_QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', 82))
+
+    # Browser upload flow: 'chunked' (resumable, via the app), 'direct'
+    # (V4 signed URLs straight to the bucket) or 'form' (one POST per photo)
+    UPLOAD_MODE = os.environ.get('UPLOAD_MODE', 'chunked')
+    UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 3))
+    UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 50 * 1024 * 1024))
+    # Must be a multiple of 256 KiB for GCS resumable sessions
+    UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    SIGNED_URL_EXPIRATION = int(os.environ.get('SIGNED_URL_EXPIRATION', 900))
+    SIGNED_URL_MAX_FILES = int(os.environ.get('SIGNED_URL_MAX_FILES', 100))
+
+    # 'gcs', or 'fake' to keep blobs in a local directory (development/testing)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gcs')
+    FAKE_STORAGE_DIR = os.environ.get('FAKE_STORAGE_DIR', os.path.join(basedir, 'fake_bucket'))
+    FAKE_STORAGE_URL = os.environ.get('FAKE_STORAGE_URL', 'http://localhost:5001/_fake_gcs')
+
+    # Firebase ID-token verification cache (per process)
+    AUTH_TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 10000))
+    # Drop cached claims this many seconds before the token's exp
+    AUTH_TOKEN_CACHE_SKEW = int(os.environ.get('AUTH_TOKEN_CACHE_SKEW', 60))
+    # Check for revoked tokens on every request (slower, bypasses the cache)
+    AUTH_CHECK_REVOKED = os.environ.get('AUTH_CHECK_REVOKED', 'false').lower() == 'true'
+
+    # Process-local cache of marathon lists
+    MARATHON_CACHE_TTL = int(os.environ.get('MARATHON_CACHE_TTL', 60))
+    # Also invalidate through a Firestore snapshot listener (one per process)
+    MARATHON_CACHE_LISTENER = os.environ.get('MARATHON_CACHE_LISTENER', 'false').lower() == 'true'
+
+    # Upload mode for the form endpoint: run OCR on the uploaded bytes while
+    # they are written to storage, instead of leaving OCR to the worker
+    INLINE_OCR = os.environ.get('INLINE_OCR', 'false').lower() == 'true'
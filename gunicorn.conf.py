@@ -0,0 +1,41 @@
+"""Gunicorn settings, read from the working directory by ``gunicorn wsgi:app``."""
+import glob
+import os
+
+# Workers write their metrics here and /metrics adds them up. Set before the
+# app (and so prometheus_client) is imported; an explicit value wins.
+METRICS_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics'))
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def on_starting(server):
+    # Drop the files of processes from a previous run; a `flask worker`
+    # sharing the directory keeps its own
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.db')):
+        pid = os.path.basename(path)[:-len('.db')].rsplit('_', 1)[-1]
+        if not pid.isdigit() or not _process_alive(int(pid)):
+            os.remove(path)
+
+
+def post_worker_init(worker):
+    # Connect this worker's Google clients before it accepts its first request
+    app = worker.wsgi
+    if app.config.get('CLIENT_WARMUP'):
+        app.config['clients'].warm_up()
+
+
+def child_exit(server, worker):
+    # A dead worker's in-flight gauges must not keep counting
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
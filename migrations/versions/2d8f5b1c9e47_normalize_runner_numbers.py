@@ -0,0 +1,74 @@
+"""Normalize runner_numbers into (marathon_id, number, image_id) rows
+
+Revision ID: 2d8f5b1c9e47
+Revises: 7c1e9a2f4b3d
+Create Date: 2026-10-18 11:04:27.193550
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d8f5b1c9e47'
+down_revision = '7c1e9a2f4b3d'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _bibs(detected_numbers):
+    # Same normalization as app.bibs, frozen here so the migration never changes
+    seen = []
+    for value in (detected_numbers or '').split(','):
+        digits = ''.join(ch for ch in value if ch.isdigit())
+        bib = (digits.lstrip('0') or '0') if digits else ''
+        if bib and bib not in seen:
+            seen.append(bib)
+    return seen
+
+
+def upgrade():
+    # The old table keyed rows by number alone, so a bib could only point at
+    # one image; nothing worth keeping is lost by rebuilding it.
+    op.drop_table('runner_numbers')
+    runner_numbers = op.create_table('runner_numbers',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('marathon_id', sa.Integer(), nullable=True),
+    sa.Column('number', sa.String(length=20), nullable=False),
+    sa.Column('image_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['image_id'], ['images.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['marathon_id'], ['marathons.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    # Backfill from the comma-joined strings before building the indexes
+    connection = op.get_bind()
+    images = connection.execute(sa.text(
+        "SELECT id, marathon_id, detected_numbers FROM images "
+        "WHERE detected_numbers IS NOT NULL AND detected_numbers != ''"))
+    rows = []
+    for image_id, marathon_id, detected_numbers in images:
+        rows.extend({'marathon_id': marathon_id, 'number': bib, 'image_id': image_id}
+                    for bib in _bibs(detected_numbers))
+        if len(rows) >= BACKFILL_BATCH_SIZE:
+            op.bulk_insert(runner_numbers, rows)
+            rows = []
+    if rows:
+        op.bulk_insert(runner_numbers, rows)
+
+    with op.batch_alter_table('runner_numbers', schema=None) as batch_op:
+        batch_op.create_index('ix_runner_numbers_marathon_number', ['marathon_id', 'number', 'image_id'], unique=True)
+        batch_op.create_index('ix_runner_numbers_number_image', ['number', 'image_id'], unique=False)
+        batch_op.create_index('ix_runner_numbers_image_id', ['image_id'], unique=False)
+
+
+def downgrade():
+    op.drop_table('runner_numbers')
+    op.create_table('runner_numbers',
+    sa.Column('number', sa.String(length=50), nullable=False),
+    sa.Column('image_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['image_id'], ['images.id'], ),
+    sa.PrimaryKeyConstraint('number')
+    )
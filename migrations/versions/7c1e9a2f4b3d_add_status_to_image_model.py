@@ -0,0 +1,27 @@
+"""Add processing status to Image model
+
+Revision ID: 7c1e9a2f4b3d
+Revises: ebec82d70356
+Create Date: 2026-10-18 09:12:40.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e9a2f4b3d'
+down_revision = 'ebec82d70356'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows were OCR'd synchronously at upload time
+    with op.batch_alter_table('images', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='indexed'))
+
+
+def downgrade():
+    with op.batch_alter_table('images', schema=None) as batch_op:
+        batch_op.drop_column('status')
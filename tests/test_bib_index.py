@@ -0,0 +1,30 @@
+import random
+
+from app.bib_index import BKTree, edit_distance
+
+
+def test_edit_distance():
+    assert edit_distance('1234', '1234') == 0
+    assert edit_distance('1234', '124') == 1
+    assert edit_distance('1234', '1243') == 2
+    assert edit_distance('', '12') == 2
+
+
+def test_search_matches_a_linear_scan():
+    rng = random.Random(7)
+    words = {str(rng.randrange(10000)) for _ in range(500)}
+    tree = BKTree()
+    for word in words:
+        assert tree.add(word)
+    assert not tree.add(next(iter(words)))
+    assert len(tree) == len(words)
+
+    for query in ['1234', '7', '99999', '501']:
+        for max_distance in (0, 1, 2):
+            expected = {(word, edit_distance(query, word)) for word in words
+                        if edit_distance(query, word) <= max_distance}
+            assert set(tree.search(query, max_distance)) == expected
+
+
+def test_empty_tree():
+    assert BKTree().search('12', 1) == []
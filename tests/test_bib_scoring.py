@@ -0,0 +1,53 @@
+from config import Config
+from app.bib_scoring import DIGIT_SCORES, UNKNOWN_REGISTERED, WEIGHTS, select_bibs
+
+FRAME = (2000, 3000)
+
+
+def word(text, x, y, height):
+    """A word box whose digits have a typical printed aspect of 0.6."""
+    return text, (x, y, x + 0.6 * height * len(text), y + height)
+
+
+def select(images, threshold=Config.BIB_SCORE_THRESHOLD, registered=None):
+    words, boxes, offsets = [], [], [0]
+    for image in images:
+        for text, box in image:
+            words.append(text)
+            boxes.append(box)
+        offsets.append(len(words))
+    texts = [' '.join(text for text, _ in image) for image in images]
+    return select_bibs(texts, words, boxes, offsets, [FRAME] * len(images), threshold, registered)
+
+
+def test_large_bib_is_kept():
+    assert select([[word('1234', 800, 1500, 120)]]) == [['1234']]
+
+
+def test_small_glyph_year_is_rejected_by_default():
+    # A 6 px "2026" in a 3000 px frame, alone or beside a real bib
+    assert select([[word('2026', 100, 100, 6)]]) == [[]]
+    assert select([[word('2026', 100, 100, 6), word('1234', 800, 1500, 120)]]) == [['1234']]
+
+
+def test_small_sponsor_number_is_rejected_by_default():
+    assert select([[word('555', 1500, 2800, 12)]]) == [[]]
+
+
+def test_prior_alone_stays_below_default_threshold():
+    best_digits = WEIGHTS['digits'] * DIGIT_SCORES.max()
+    assert WEIGHTS['aspect'] + best_digits + WEIGHTS['registered'] * UNKNOWN_REGISTERED < Config.BIB_SCORE_THRESHOLD
+
+
+def test_registration_list_decides_mid_sized_candidates():
+    image = [word('77', 900, 800, 120), word('1234', 800, 1500, 36), word('4321', 200, 1500, 36)]
+    assert select([image], registered=frozenset({'77', '1234'})) == [['77', '1234']]
+
+
+def test_images_without_boxes_fall_back_to_the_text():
+    no_boxes = [('RUN', (0, 0, 0, 0)), ('0042', (0, 0, 0, 0))]
+    assert select([no_boxes, [word('1234', 800, 1500, 120)]]) == [['42'], ['1234']]
+
+
+def test_zero_threshold_indexes_every_number():
+    assert select([[word('2026', 100, 100, 6)]], threshold=0) == [['2026']]
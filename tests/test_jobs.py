@@ -0,0 +1,70 @@
+from flask import Flask
+import pytest
+
+from app.jobs import RetryLater, SQLiteJobQueue, job_handler, run_job
+
+LEASE_SECONDS = 60
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteJobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(JOB_MAX_ATTEMPTS=2, JOB_RETRY_BASE_DELAY=0, JOB_RETRY_MAX_DELAY=0)
+    return app
+
+
+def claim_one(queue):
+    jobs = queue.claim(1, LEASE_SECONDS)
+    assert len(jobs) == 1
+    return jobs[0]
+
+
+def test_retry_uses_up_an_attempt_and_defer_gives_it_back(queue):
+    queue.enqueue('test', {'n': 1})
+    job = claim_one(queue)
+    assert (job.payload, job.attempts) == ({'n': 1}, 1)
+
+    queue.retry(job, 0, 'boom')
+    job = claim_one(queue)
+    assert job.attempts == 2
+
+    queue.defer(job, 0, 'throttled')
+    assert claim_one(queue).attempts == 2
+
+
+def test_delayed_and_claimed_jobs_are_not_handed_out(queue):
+    queue.enqueue('test', {}, delay=60)
+    queue.enqueue('test', {})
+    claim_one(queue)
+    assert queue.claim(5, LEASE_SECONDS) == []
+
+
+def test_throttled_jobs_never_run_out_of_attempts(app, queue):
+    @job_handler('test_throttled')
+    def handler(payload):
+        raise RetryLater('quota', delay=0)
+
+    queue.enqueue('test_throttled', {})
+    for _ in range(app.config['JOB_MAX_ATTEMPTS'] + 2):
+        run_job(app, queue, claim_one(queue))
+    assert queue.stats() == {'queued': 1}
+
+
+def test_failing_jobs_fail_after_max_attempts(app, queue):
+    failures = []
+
+    @job_handler('test_failing')
+    def handler(payload):
+        raise ValueError('broken')
+
+    handler.on_failure = lambda payload, error: failures.append((payload, error))
+    queue.enqueue('test_failing', {'id': 'a'})
+    for _ in range(app.config['JOB_MAX_ATTEMPTS']):
+        run_job(app, queue, claim_one(queue))
+    assert queue.stats() == {'failed': 1}
+    assert failures == [({'id': 'a'}, 'ValueError: broken')]
@@ -0,0 +1,153 @@
+from firebase_admin import firestore
+import pytest
+
+from app import marathon_stats
+from app.marathon_stats import get_marathon_stats
+
+MARATHON = 'm1'
+
+
+class Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self.exists else None
+
+
+class CollectionRef:
+    def __init__(self, db, path, parent=None):
+        self.db = db
+        self.path = path
+        self.parent = parent
+
+    def document(self, doc_id):
+        return DocumentRef(self.db, self.path + (doc_id,), self)
+
+
+class DocumentRef:
+    def __init__(self, db, path, parent):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+        self.parent = parent
+
+    def collection(self, name):
+        return CollectionRef(self.db, self.path + (name,), self)
+
+    def get(self, field_paths=None, transaction=None):
+        return Snapshot(self, self.db.docs.get(self.path))
+
+
+class Transaction:
+    """Applies writes straight away; enough for the single-threaded tests here."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+    def set(self, ref, data, merge=False):
+        current = dict(self.db.docs.get(ref.path) or {}) if merge else {}
+        self.db.docs[ref.path] = self._apply(current, data)
+
+    def update(self, ref, data):
+        assert ref.path in self.db.docs, f'update of missing doc {ref.path}'
+        self.db.docs[ref.path] = self._apply(dict(self.db.docs[ref.path]), data)
+
+    def delete(self, ref):
+        self.db.docs.pop(ref.path, None)
+
+    @staticmethod
+    def _apply(current, data):
+        for name, value in data.items():
+            if isinstance(value, firestore.Increment):
+                value = current.get(name, 0) + value.value
+            current[name] = value
+        return current
+
+
+class FakeDB:
+    def __init__(self):
+        self.docs = {}
+
+    def collection(self, name):
+        return CollectionRef(self, (name,))
+
+    def transaction(self):
+        return Transaction(self)
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+    def markers(self):
+        prefix = (marathon_stats.STATS_COLLECTION, MARATHON, 'bibs')
+        return {path[-1]: data[marathon_stats.MARKER_IMAGES] for path, data in self.docs.items()
+                if path[:-1] == prefix}
+
+
+@pytest.fixture
+def db():
+    return FakeDB()
+
+
+def write(db, image_id, data, created=False, bib_numbers=None, failed=False):
+    image_ref = db.collection('images').document(image_id)
+    # Unwrapped from firestore.transactional, which needs a real client
+    marathon_stats._write_image.to_wrap(db.transaction(), db, MARATHON, image_ref, data, created, bib_numbers, 1,
+                                        failed=failed)
+    return image_ref
+
+
+def stats(db):
+    return get_marathon_stats(db, [MARATHON], 1)[MARATHON]
+
+
+def test_queued_image_is_counted_once_indexed(db):
+    write(db, 'a', {'status': 'queued'}, created=True)
+    assert (stats(db)['images'], stats(db)['indexed']) == (1, 0)
+
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=['12'])
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=['12'])
+    assert (stats(db)['images'], stats(db)['indexed'], stats(db)['distinct_bibs']) == (1, 1, 1)
+
+
+def test_failed_image_moves_to_indexed_and_back(db):
+    write(db, 'a', {'status': 'queued'}, created=True)
+
+    write(db, 'a', {'status': 'failed'}, failed=True)
+    write(db, 'a', {'status': 'failed'}, failed=True)
+    assert (stats(db)['indexed'], stats(db)['failed']) == (0, 1)
+
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=[])
+    assert (stats(db)['indexed'], stats(db)['failed']) == (1, 0)
+
+    write(db, 'a', {'status': 'failed'}, failed=True)
+    assert (stats(db)['indexed'], stats(db)['failed']) == (0, 1)
+
+
+def test_every_write_bumps_the_version(db):
+    write(db, 'a', {'status': 'queued'}, created=True)
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=['12'])
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=['12'])
+    assert stats(db)['version'] == 3
+
+
+def test_dropped_bibs_release_their_markers(db):
+    write(db, 'a', {'status': 'indexed'}, created=True, bib_numbers=['12', '2026'])
+    write(db, 'b', {'status': 'indexed'}, created=True, bib_numbers=['12'])
+    assert db.markers() == {'12': 2, '2026': 1}
+    assert stats(db)['distinct_bibs'] == 2
+
+    # Re-extraction drops the false positive from a and then 12 from b
+    write(db, 'a', {'status': 'indexed'}, bib_numbers=['12'])
+    assert db.markers() == {'12': 2}
+    assert stats(db)['distinct_bibs'] == 1
+
+    write(db, 'b', {'status': 'indexed'}, bib_numbers=['34'])
+    assert db.markers() == {'12': 1, '34': 1}
+    assert stats(db)['distinct_bibs'] == 2
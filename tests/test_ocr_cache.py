@@ -0,0 +1,30 @@
+import sqlite3
+
+from app.ocr_cache import ContentHashCache
+
+OCR = {'ocr_text': 'RUN 42', 'ocr_annotation': 'ocr/images/a.jpg.json.gz'}
+
+
+def test_entry_keeps_its_ocr_record_and_marathon(tmp_path):
+    cache = ContentHashCache(str(tmp_path / 'cache.sqlite3'))
+    cache.put('h', 'images/a.jpg', 'https://example/a.jpg')
+    assert cache.get('h')['bib_numbers'] is None
+
+    cache.set_bib_numbers('h', ['42'], 'm1', OCR)
+    # Rescored for another marathon from the same annotation
+    cache.set_bib_numbers('h', ['42', '7'], 'm2')
+    entry = cache.get('h')
+    assert (entry['bib_numbers'], entry['marathon_id'], entry['ocr']) == (['42', '7'], 'm2', OCR)
+
+
+def test_files_from_before_the_ocr_columns_are_upgraded(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE content_hashes (sha256 TEXT PRIMARY KEY, blob_path TEXT NOT NULL, url TEXT NOT NULL, '
+                 'bib_numbers TEXT, last_used REAL NOT NULL)')
+    conn.execute("INSERT INTO content_hashes VALUES ('h', 'images/a.jpg', 'u', '[\"42\"]', 0)")
+    conn.commit()
+    conn.close()
+
+    entry = ContentHashCache(path).get('h')
+    assert (entry['bib_numbers'], entry['marathon_id'], entry['ocr']) == (['42'], None, None)
@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+import base64
+import json
+import pytest
+
+from app.pagination import decode_page_token, encode_page_token
+
+UPLOAD_TIME = datetime(2026, 4, 12, 9, 30, tzinfo=timezone.utc)
+
+
+def token_for(payload):
+    raw = json.dumps(payload).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def test_round_trip():
+    cursor, page = decode_page_token(encode_page_token(UPLOAD_TIME, 'abc', 3))
+    assert cursor == [UPLOAD_TIME, 'abc']
+    assert page == 3
+
+
+@pytest.mark.parametrize('token', [
+    'W10',  # []
+    'MQ',  # 1
+    'bnVsbA',  # null
+    'not base64!',
+    'é',
+    token_for({'id': 'abc', 'p': 2}),
+    token_for({'t': UPLOAD_TIME.isoformat(), 'p': 2}),
+    token_for({'t': 'yesterday', 'id': 'abc'}),
+    token_for({'t': UPLOAD_TIME.isoformat(), 'id': 7}),
+    token_for({'t': UPLOAD_TIME.isoformat(), 'id': 'abc', 'p': 'two'}),
+    token_for({'t': UPLOAD_TIME.isoformat(), 'id': 'abc', 'p': 0}),
+    token_for({'t': UPLOAD_TIME.isoformat(), 'id': 'abc', 'p': -4}),
+])
+def test_malformed_tokens_raise_value_error(token):
+    with pytest.raises(ValueError):
+        decode_page_token(token)
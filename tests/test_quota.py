@@ -0,0 +1,56 @@
+from google.api_core import exceptions
+import pytest
+
+from app import quota as quota_module
+from app.quota import QuotaGovernor, Throttled
+
+
+def governor(tmp_path, rate=1, burst=2, max_in_flight=0, **kwargs):
+    return QuotaGovernor(str(tmp_path / 'quota.sqlite3'), {'vision': (rate, burst, max_in_flight)}, max_wait=0,
+                         **kwargs)
+
+
+def test_burst_is_spent_then_callers_are_throttled(tmp_path):
+    quota = governor(tmp_path, rate=0.01, burst=2)
+    quota.release(quota.acquire('vision'))
+    quota.release(quota.acquire('vision'))
+    with pytest.raises(Throttled) as raised:
+        quota.acquire('vision')
+    assert raised.value.delay > 0
+    assert quota.stats()['throttled'] == 1
+
+
+def test_cost_is_capped_at_the_burst(tmp_path):
+    quota = governor(tmp_path, rate=0.01, burst=4)
+    quota.release(quota.acquire('vision', cost=16))
+    with pytest.raises(Throttled):
+        quota.acquire('vision')
+
+
+def test_in_flight_slots_are_released(tmp_path):
+    quota = governor(tmp_path, rate=100, burst=100, max_in_flight=1)
+    lease = quota.acquire('vision')
+    with pytest.raises(Throttled):
+        quota.acquire('vision')
+    quota.release(lease)
+    quota.release(quota.acquire('vision'))
+
+
+def test_quota_errors_block_the_host_and_raise_throttled(tmp_path, monkeypatch):
+    # No jitter, so the backoff cannot come out as zero
+    monkeypatch.setattr(quota_module, 'backoff_delay', lambda attempts, base, cap: min(cap, base))
+    quota = governor(tmp_path, rate=100, burst=100, max_retries=0, backoff_base=30, backoff_max=30)
+
+    def exhausted():
+        raise exceptions.ResourceExhausted('quota')
+
+    with pytest.raises(Throttled):
+        quota.call('vision', exhausted)
+    assert quota.stats()['quota_errors'] == 1
+    # Every process sharing the file now waits out the backoff
+    with pytest.raises(Throttled):
+        governor(tmp_path, rate=100, burst=100).acquire('vision')
+
+
+def test_unlimited_names_pass_through(tmp_path):
+    assert governor(tmp_path).call('storage', lambda: 'ok') == 'ok'